@@ -2,9 +2,16 @@ import paho.mqtt.client as mqtt
 
 import os
 import sys
+import time
+import typing
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mqtt_connection import MqttConnection, get_connection
+from common.scheduler import PeriodicTask, get_scheduler
 
 class Actuator:
-    def __init__(self):
+    def __init__(self, module_name: typing.Optional[str] = None, connection: typing.Optional[MqttConnection] = None):
         if os.environ.get('MQTT_ADDRESS') == None or os.environ.get('MQTT_PORT') == None:
             print('Env. variables for MQTT do not exist', flush=True, file=sys.stdout)
             exit(1)
@@ -13,48 +20,94 @@ class Actuator:
             print('Env. variables SERVER_ID does not exist', flush=True, file=sys.stdout)
             exit(1)
 
-        if os.environ.get('MODULE_NAME') == None:
+        if module_name == None and os.environ.get('MODULE_NAME') == None:
             print('Env. variables MODULE_NAME does not exist', flush=True, file=sys.stdout)
             exit(1)
 
-        self.module_name = os.environ['MODULE_NAME']
+        self.module_name = module_name if module_name != None else os.environ['MODULE_NAME']
         self.server_id = os.environ.get('SERVER_ID')
         self.mqtt_client_id = f'{self.server_id}_{self.module_name}'
         self.mqtt_status_topic = f'{self.server_id}/{self.module_name}_status'
         self.mqtt_control_topic = f'{self.server_id}/{self.module_name}_control'
         self.log_file = open(f'./logs/{self.server_id}_{self.module_name}_log.txt', 'w')
-        self.client = mqtt.Client(self.mqtt_client_id, clean_session=True)
+        #Actuators (and sensors) of the same process share
+        #one connection to the broker, see common/mqtt_connection.py
+        if connection == None:
+            connection = get_connection(self.mqtt_client_id, os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+        self.connection = connection
+        self.client = connection.client
+        self.control_fun = None
         self.connected = False
+        self.task: typing.Optional[PeriodicTask] = None
         return 
     
     def set_control(self, control_fun):
-        self.client.on_message = control_fun
+        self.control_fun = control_fun
+
+    def _handle_control(self, client, userdata, msg: mqtt.MQTTMessage):
+        if self.control_fun != None:
+            self.control_fun(client, userdata, msg)
     
     def connect(self):
-        def on_connect(client: mqtt.Client, userdata, flags, reason_code):
-            print('Connected', flush=True, file=self.log_file)
-            client.subscribe(self.mqtt_control_topic)
-
-        self.client.on_connect = on_connect
-        self.client.connect(os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+        self.connection.acquire()
+        self.connection.subscribe(self.mqtt_control_topic, self._handle_control)
+        print('Connected', flush=True, file=self.log_file)
         self.connected = True
 
     def start(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.loop_start()
+        self.connection.start()
+
+    def schedule(self, callback: typing.Callable[[], typing.Any], period: float) -> PeriodicTask:
+        """
+        Runs 'callback' every 'period' seconds on the
+        process scheduler, like Sensor.schedule
+
+        :param callback: Step function
+        :param float period: Seconds between two calls
+        """
+        if self.task != None:
+            self.task.cancel()
+        self.task = get_scheduler().schedule(callback, period)
+        return self.task
 
     def stop(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.loop_stop()
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
 
     def disconnect(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.disconnect()
+        if self.task != None:
+            self.task.cancel()
+        self.connection.unsubscribe(self.mqtt_control_topic)
+        self.connection.release()
+        self.connected = False
 
     def update_status(self, data):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.publish(self.mqtt_status_topic, data)
\ No newline at end of file
+        self.client.publish(self.mqtt_status_topic, data)
+
+def run_device(create: typing.Callable[[Actuator], typing.Any]):
+    """
+    Runs an actuator plugin in its own process, used when
+    the module is started as a script
+
+    :param create: The 'create' function of the actuator module
+    """
+    actuator = Actuator()
+    device = create(actuator)
+    actuator.connect()
+    actuator.start()
+    actuator.schedule(device.step, device.period)
+
+    while device.running:
+        time.sleep(0.1)
+
+    actuator.stop()
+    actuator.disconnect()
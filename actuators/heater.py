@@ -1,36 +1,34 @@
-from actuator_class import Actuator
+from actuator_class import Actuator, run_device
 
 import paho.mqtt.client as mqtt
 
-import time
 import json
 
-actuator = Actuator()
-
-running: bool = True
-stop: bool = True
-
-def handle_control(client, userdata, msg: mqtt.MQTTMessage):
-    global running, actuator, stop
-    message = str(msg.payload.decode('utf-8')).upper()
-    if message == "STOP":
-        print("Received stop command", file=actuator.log_file, flush=True)
-        stop = True
-    if message == "START":
-        print("Received start command", file=actuator.log_file, flush=True)
-        stop = False
-    if message == "DISCONNECT":
-        print("Received disconnect command", file=actuator.log_file)
-        running = False
-
-
-actuator.set_control(handle_control)
-actuator.connect()
-actuator.start()
-
-while running:
-    time.sleep(5)
-    actuator.update_status(json.dumps({'is_on': not stop}))
-
-actuator.stop()
-actuator.disconnect()
\ No newline at end of file
+class Heater:
+    def __init__(self, actuator: Actuator):
+        self.actuator = actuator
+        self.period = 5.0
+        self.running = True
+        self.stop = True
+        actuator.set_control(self.handle_control)
+
+    def handle_control(self, client, userdata, msg: mqtt.MQTTMessage):
+        message = str(msg.payload.decode('utf-8')).upper()
+        if message == "STOP":
+            print("Received stop command", file=self.actuator.log_file, flush=True)
+            self.stop = True
+        if message == "START":
+            print("Received start command", file=self.actuator.log_file, flush=True)
+            self.stop = False
+        if message == "DISCONNECT":
+            print("Received disconnect command", file=self.actuator.log_file)
+            self.running = False
+
+    def step(self):
+        self.actuator.update_status(json.dumps({'is_on': not self.stop}))
+
+def create(actuator: Actuator):
+    return Heater(actuator)
+
+if __name__ == '__main__':
+    run_device(create)
@@ -3,6 +3,7 @@ from topo.topo_read import parse_file
 from topo.mininet_topo import Topology
 from app_detail.server_requests import *
 from app_detail.ryu_requests import *
+from app_detail.async_client import IotClient, ClientError
 
 from gui.gui_main import MainWindow
 
@@ -13,6 +14,7 @@ from mininet.node import Host, RemoteController, Node
 from PyQt5.QtWidgets import QApplication
 
 import traceback
+import asyncio
 import time
 import os
 
@@ -31,6 +33,20 @@ def waitfor_beat(server_url: str, max_attempts: int):
             max_attempts -= 1
     return False
 
+async def provision(server_url: str):
+    #Devices are added concurrently, the controller once they exist
+    async with IotClient(server_url) as client:
+        sensors, actuators = await asyncio.gather(
+            client.add_sensors([('H1', 'temp', 'first_room_temp'), ('H2', 'temp', 'second_room_temp'),
+                                ('H3', 'temp', 'third_room_temp'), ('H3', 'seismic', 'seismic_sensor')]),
+            client.add_actuators([('H2', 'heater', 'second_room_heater')]))
+        for item, exc in sensors.failed + actuators.failed:
+            print(f'Create device {item[2]} failed: {exc}')
+        try:
+            await client.add_controller('test_controller', 'test')
+        except ClientError as exc:
+            print(f'Add controller failed: {exc}')
+
 if __name__ == '__main__':
     use_remote_controller = False
 
@@ -88,7 +104,13 @@ if __name__ == '__main__':
                 exit(1)
 
         broker_exports = f'export MQTT_ADDRESS={BROKER_ADDRESS} && export MQTT_PORT={BROKER_PORT}'
-        main_server_cmd = f'{broker_exports} && export FLASK_APP=./server/main_server.py && flask run --host=0.0.0.0 &> ./logs/iot_server.txt'
+        if os.environ.get('SERVER_MODE') == 'async':
+            main_server_cmd = f'{broker_exports} && python3 ./server/async_main_server.py &> ./logs/iot_server.txt'
+        elif os.environ.get('SERVER_MODE') == 'workers':
+            workers = os.environ.get('SERVER_WORKERS', '4')
+            main_server_cmd = f'{broker_exports} && export STATE_BACKEND=shared && gunicorn -c ./server/gunicorn_conf.py --pythonpath ./server -w {workers} --threads 8 -b 0.0.0.0:5000 main_server:app &> ./logs/iot_server.txt'
+        else:
+            main_server_cmd = f'{broker_exports} && export FLASK_APP=./server/main_server.py && flask run --host=0.0.0.0 &> ./logs/iot_server.txt'
 
         server_url = f'http://{server_node.IP()}:5000'
         conn = server_node.popen(main_server_cmd, shell=True)
@@ -111,13 +133,7 @@ if __name__ == '__main__':
         publish_hosts(server_url, mininet_topo.ip_map)
         remove_hosts(server_url, [topo.server.name])
 
-        add_sensor(server_url, 'H1', 'temp', 'first_room_temp')
-        add_sensor(server_url, 'H2', 'temp', 'second_room_temp')
-        add_sensor(server_url, 'H3', 'temp', 'third_room_temp')
-        add_actuator(server_url, 'H2', 'heater', 'second_room_heater')
-        add_controller(server_url, 'test_controller', 'test')
-
-        add_sensor(server_url, 'H3', 'seismic', 'seismic_sensor')
+        asyncio.run(provision(server_url))
         
         app = QApplication(sys.argv)
         sensors = [('H1', 'first_room_temp'), ('H2', 'second_room_temp'), ('H3', 'third_room_temp')]
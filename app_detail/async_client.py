@@ -0,0 +1,373 @@
+import asyncio
+import typing
+import json
+
+from app_detail.server_requests import AsyncServerClient, CLIENT_TIMEOUT, CLIENT_RETRIES, httpx
+from common.codec import codec_from_description
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+#Requests sent at the same time by the bulk operations
+DEFAULT_CONCURRENCY = 32
+
+class ClientError(Exception):
+    """
+    Base class of the errors raised by IotClient
+    """
+    pass
+
+class ServerError(ClientError):
+    """
+    The main server answered with an error status (e.g. 'E_INV_ID')
+    """
+    def __init__(self, status: str, http_status: int, body: typing.Dict[str, typing.Any]):
+        super().__init__(f'{status} (HTTP {http_status})')
+        self.status = status
+        self.http_status = http_status
+        self.body = body
+
+class PartialError(ServerError):
+    """
+    A request involving every room host failed on some
+    of them, 'errors' maps those hosts to their error
+    and 'body' still holds the results of the others
+    """
+    def __init__(self, http_status: int, body: typing.Dict[str, typing.Any]):
+        super().__init__('E_PARTIAL', http_status, body)
+        self.errors: typing.Dict[str, str] = body.get('errors', {})
+
+class TransportError(ClientError):
+    """
+    The server could not be reached or did not answer in time
+    """
+    pass
+
+class SensorData:
+    def __init__(self, readings: typing.List[typing.Dict[str, typing.Any]], next_seq: int, missed: int):
+        self.readings = readings
+        #Cursor ('since') for the next read
+        self.next = next_seq
+        self.missed = missed
+
+class AggregateResult:
+    def __init__(self, field: str, window: float, source: str, aggregates: typing.Dict[str, typing.List[typing.Any]]):
+        self.field = field
+        self.window = window
+        #'rollup' or 'raw'
+        self.source = source
+        #'start' of each window and one column for each function
+        self.aggregates = aggregates
+
+class TelemetryResult:
+    def __init__(self, sensors: typing.List[typing.Dict[str, typing.Any]], actuators: typing.List[typing.Dict[str, typing.Any]]):
+        #One entry for each requested device, with its own 'status'
+        self.sensors = sensors
+        self.actuators = actuators
+
+class StreamEvent:
+    def __init__(self, event: str, data: typing.Any):
+        #'data', 'status' or 'dropped'
+        self.event = event
+        self.data = data
+
+class BulkResult:
+    def __init__(self):
+        self.succeeded: typing.List[typing.Any] = []
+        self.failed: typing.List[typing.Tuple[typing.Any, ClientError]] = []
+
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+class IotClient:
+    """
+    Asyncio client of the main server API. Every method
+    returns the result of its endpoint or raises a
+    ClientError, bulk operations run many requests at once
+    with bounded concurrency.
+
+    Use it as an async context manager, or call aclose()
+    """
+    def __init__(self, server_url: str, timeout: float = CLIENT_TIMEOUT, retries: int = CLIENT_RETRIES,
+                 pool_size: int = DEFAULT_CONCURRENCY):
+        self.http = AsyncServerClient(server_url, timeout, retries, pool_size)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def _send(self, method: str, path: str, payload: typing.Any = None,
+                    params: typing.Optional[typing.Dict[str, typing.Any]] = None) -> 'httpx.Response':
+        kwargs: typing.Dict[str, typing.Any] = {}
+        if payload != None:
+            kwargs['content'] = json.dumps(payload)
+            kwargs['headers'] = JSON_HEADERS
+        if params != None:
+            kwargs['params'] = {name: value for name, value in params.items() if value != None}
+        try:
+            return await self.http.request(method, path, **kwargs)
+        except httpx.HTTPError as exc:
+            raise TransportError(f'{method} {path} failed: {exc!r}') from exc
+
+    async def _call(self, method: str, path: str, payload: typing.Any = None,
+                    params: typing.Optional[typing.Dict[str, typing.Any]] = None) -> typing.Dict[str, typing.Any]:
+        res = await self._send(method, path, payload, params)
+        return check_response(res)
+
+    async def heartbeat(self) -> bool:
+        try:
+            await self._call('GET', '/heartbeat')
+            return True
+        except ClientError:
+            return False
+
+    #Room hosts
+
+    async def add_hosts(self, hosts: typing.Dict[str, str]):
+        """
+        :param hosts: Host id -> url of its room host server
+        """
+        await self._call('POST', '/devices', hosts)
+
+    async def get_hosts(self) -> typing.Dict[str, str]:
+        return json.loads((await self._call('GET', '/devices'))['devs'])
+
+    async def remove_hosts(self, host_ids: typing.List[str]):
+        await self._call('DELETE', '/devices', params={'devs': json.dumps(host_ids)})
+
+    #Sensors
+
+    async def add_sensor(self, host_id: str, module: str, instance_id: str, history: typing.Optional[int] = None,
+                         isolation: typing.Optional[str] = None):
+        body: typing.Dict[str, typing.Any] = {'module': module, 'instance_id': instance_id}
+        if history != None:
+            body['history'] = history
+        if isolation != None:
+            body['isolation'] = isolation
+        await self._call('POST', f'/dev/{host_id}/sensors', body)
+
+    async def get_all_sensors(self) -> typing.Dict[str, typing.List[str]]:
+        """
+        :raises PartialError: when some hosts failed, the others are in its body
+        """
+        return (await self._call('GET', '/dev/sensors/get_all'))['sensors']
+
+    async def remove_all_sensors(self):
+        await self._call('DELETE', '/dev/sensors/delete_all')
+
+    async def start_sensor(self, host_id: str, sensor_id: str):
+        await self._call('PUT', f'/dev/{host_id}/sensor_start', {'sensor_id': sensor_id})
+
+    async def stop_sensor(self, host_id: str, sensor_id: str):
+        await self._call('PUT', f'/dev/{host_id}/sensor_stop', {'sensor_id': sensor_id})
+
+    async def get_sensor_status(self, host_id: str, sensor_id: str) -> str:
+        return (await self._call('GET', f'/dev/{host_id}/sensor_status', {'sensor_id': sensor_id}))['sensor_status']
+
+    async def get_sensor_data(self, host_id: str, sensor_id: str, since: typing.Optional[int] = None,
+                              limit: typing.Optional[int] = None, packed: bool = False) -> SensorData:
+        """
+        Readings newer than the 'since' cursor
+
+        :param bool packed: Transfer the readings in the packed binary format
+        """
+        params = {'since': since, 'limit': limit, 'format': 'packed' if packed else None}
+        res = await self._send('GET', f'/dev/{host_id}/sensor_data', {'sensor_id': sensor_id}, params)
+        if packed and res.status_code == 200:
+            codec = codec_from_description(json.loads(res.headers['X-Codec']))
+            return SensorData(codec.decode(res.content), int(res.headers['X-Next']), int(res.headers['X-Missed']))
+        body = check_response(res)
+        return SensorData(body['sensor_data'], body['next'], body['missed'])
+
+    async def get_sensor_aggregate(self, host_id: str, sensor_id: str, field: str, window: str,
+                                   fns: typing.List[str] = ['mean'], start: typing.Optional[float] = None,
+                                   end: typing.Optional[float] = None) -> AggregateResult:
+        """
+        :param str window: Window length, e.g. '60s', '5m', '1h'
+        :param fns: Functions among mean, min, max, sum and count
+        """
+        params = {'field': field, 'window': window, 'fn': ','.join(fns), 'from': start, 'to': end}
+        body = await self._call('GET', f'/dev/{host_id}/sensor_data/aggregate', {'sensor_id': sensor_id}, params)
+        return AggregateResult(body['field'], body['window'], body['source'], body['aggregates'])
+
+    async def get_sensor_history(self, host_id: str, sensor_id: str, start: typing.Optional[float] = None,
+                                 end: typing.Optional[float] = None, limit: typing.Optional[int] = None) -> typing.List[typing.Dict[str, typing.Any]]:
+        params = {'from': start, 'to': end, 'limit': limit}
+        return (await self._call('GET', f'/dev/{host_id}/sensor_data/history', {'sensor_id': sensor_id}, params))['sensor_data']
+
+    #Actuators
+
+    async def add_actuator(self, host_id: str, module: str, instance_id: str, isolation: typing.Optional[str] = None):
+        body: typing.Dict[str, typing.Any] = {'module': module, 'instance_id': instance_id}
+        if isolation != None:
+            body['isolation'] = isolation
+        await self._call('POST', f'/dev/{host_id}/actuators', body)
+
+    async def get_all_actuators(self) -> typing.Dict[str, typing.List[str]]:
+        """
+        :raises PartialError: when some hosts failed, the others are in its body
+        """
+        return (await self._call('GET', '/dev/actuators/get_all'))['actuators']
+
+    async def remove_all_actuators(self):
+        await self._call('DELETE', '/dev/actuators/delete_all')
+
+    async def start_actuator(self, host_id: str, actuator_id: str):
+        await self._call('PUT', f'/dev/{host_id}/actuator_start', {'actuator_id': actuator_id})
+
+    async def stop_actuator(self, host_id: str, actuator_id: str):
+        await self._call('PUT', f'/dev/{host_id}/actuator_stop', {'actuator_id': actuator_id})
+
+    async def get_actuator_status(self, host_id: str, actuator_id: str) -> typing.Dict[str, typing.Any]:
+        body = await self._call('GET', f'/dev/{host_id}/actuator_status', {'actuator_id': actuator_id})
+        return json.loads(body['actuator_status'])
+
+    #Telemetry
+
+    async def get_telemetry_batch(self, sensors: typing.List[typing.Tuple[str, str, typing.Optional[int]]],
+                                  actuators: typing.List[typing.Tuple[str, str]]) -> TelemetryResult:
+        """
+        Readings and statuses of many devices with one request
+
+        :param sensors: (host id, sensor id, since cursor)
+        :param actuators: (host id, actuator id)
+        """
+        body = {
+            'sensors': [{'host_id': host_id, 'sensor_id': sensor_id, 'since': since} for host_id, sensor_id, since in sensors],
+            'actuators': [{'host_id': host_id, 'actuator_id': actuator_id} for host_id, actuator_id in actuators]
+        }
+        result = await self._call('POST', '/telemetry/batch', body)
+        for entry in result['actuators']:
+            if entry['status'] == 'E_OK':
+                entry['actuator_status'] = json.loads(entry['actuator_status'])
+        return TelemetryResult(result['sensors'], result['actuators'])
+
+    async def stream(self, topics: typing.List[str] = ['#'], queue_size: typing.Optional[int] = None) -> typing.AsyncIterator[StreamEvent]:
+        """
+        Events pushed by the server for the topics matching
+        the given filters, until the iteration is stopped
+        """
+        params = {'topics': ','.join(topics)}
+        if queue_size != None:
+            params['queue'] = queue_size
+        try:
+            #No read timeout, the server sends a heartbeat every 15 seconds
+            async with self.http.client.stream('GET', '/stream', params=params,
+                                               timeout=httpx.Timeout(CLIENT_TIMEOUT, read=None)) as res:
+                if res.status_code != 200:
+                    await res.aread()
+                    check_response(res)
+                event = 'message'
+                async for line in res.aiter_lines():
+                    if line.startswith('event:'):
+                        event = line[len('event:'):].strip()
+                    elif line.startswith('data:'):
+                        yield StreamEvent(event, json.loads(line[len('data:'):].strip()))
+                    elif line == '':
+                        event = 'message'
+        except httpx.HTTPError as exc:
+            raise TransportError(f'GET /stream failed: {exc!r}') from exc
+
+    async def readings(self, topics: typing.List[str] = ['#']) -> typing.AsyncIterator[typing.Tuple[str, int, typing.Dict[str, typing.Any]]]:
+        """
+        New sensor readings as (topic, seq, reading)
+        """
+        async for event in self.stream(topics):
+            if event.event == 'data':
+                yield event.data['topic'], event.data['seq'], event.data['reading']
+
+    #Controllers
+
+    async def add_controller(self, module: str, instance_id: str):
+        await self._call('POST', '/controllers/add', {'module': module, 'instance_id': instance_id})
+
+    async def remove_controller(self, instance_id: str):
+        await self._call('DELETE', '/controllers/remove', {'instance_id': instance_id})
+
+    async def get_all_controllers(self) -> typing.List[str]:
+        return (await self._call('GET', '/controllers/get_all'))['controllers']
+
+    async def remove_all_controllers(self):
+        await self._call('DELETE', '/controllers/remove_all')
+
+    #Stats
+
+    async def host_pool_stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        return (await self._call('GET', '/stats/host_pool'))['hosts']
+
+    async def ingest_stats(self) -> typing.Dict[str, typing.Any]:
+        return (await self._call('GET', '/stats/ingest'))['ingest']
+
+    async def metrics(self) -> str:
+        """
+        Metrics in the Prometheus text format
+        """
+        res = await self._send('GET', '/metrics')
+        if res.status_code != 200:
+            check_response(res)
+        return res.text
+
+    async def shutdown(self):
+        await self._call('POST', '/shutdown')
+
+    #Bulk operations
+
+    async def bulk(self, call: typing.Callable[..., typing.Awaitable[typing.Any]], items: typing.Iterable[typing.Tuple],
+                   concurrency: int = DEFAULT_CONCURRENCY) -> BulkResult:
+        """
+        Calls 'call(*item)' for every item, with at most
+        'concurrency' calls in flight (also bounded by the
+        pool size of the client). Failures do not stop the
+        other calls, they are collected in the result
+
+        :param call: A method of this client, e.g. client.add_sensor
+        :param items: Arguments of each call
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        result = BulkResult()
+
+        async def run(item: typing.Tuple):
+            async with semaphore:
+                try:
+                    await call(*item)
+                    result.succeeded.append(item)
+                except ClientError as exc:
+                    result.failed.append((item, exc))
+
+        await asyncio.gather(*[run(tuple(item)) for item in items])
+        return result
+
+    async def add_sensors(self, sensors: typing.Iterable[typing.Tuple], concurrency: int = DEFAULT_CONCURRENCY) -> BulkResult:
+        """
+        :param sensors: (host id, module, instance id[, history[, isolation]])
+        """
+        return await self.bulk(self.add_sensor, sensors, concurrency)
+
+    async def add_actuators(self, actuators: typing.Iterable[typing.Tuple], concurrency: int = DEFAULT_CONCURRENCY) -> BulkResult:
+        """
+        :param actuators: (host id, module, instance id[, isolation])
+        """
+        return await self.bulk(self.add_actuator, actuators, concurrency)
+
+def check_response(res: 'httpx.Response') -> typing.Dict[str, typing.Any]:
+    """
+    JSON body of a successful response
+
+    :raises ServerError: if the server returned an error status
+    """
+    try:
+        body = res.json()
+    except ValueError:
+        raise ServerError('E_RESPONSE', res.status_code, {'text': res.text})
+    if type(body) != type({}):
+        raise ServerError('E_RESPONSE', res.status_code, {'body': body})
+    status = body.get('status')
+    if status == 'E_PARTIAL':
+        raise PartialError(res.status_code, body)
+    #Some endpoints answer 'OK' instead of 'E_OK'
+    if res.status_code != 200 or status not in ('E_OK', 'OK'):
+        raise ServerError(status if status != None else 'E_HTTP', res.status_code, body)
+    return body
@@ -1,147 +1,398 @@
 import requests
+import threading
 import typing
 import json
+import os
 
-def publish_hosts(server_url: str, host_list: typing.Dict[str, str]):
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.codec import codec_from_description
+
+#Only needed by AsyncServerClient
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+#Defaults of the clients used by the functions of this module
+CLIENT_TIMEOUT = float(os.environ.get('SERVER_TIMEOUT', '5'))
+CLIENT_RETRIES = int(os.environ.get('SERVER_RETRIES', '2'))
+CLIENT_POOL_SIZE = int(os.environ.get('SERVER_POOL_SIZE', '8'))
+
+class ServerClient:
+    """
+    HTTP client for the main server API. Requests reuse
+    the keep-alive connections of a pooled session, every
+    request has a timeout (the default one or the 'timeout'
+    argument of the call) and failed connections are retried
+    with exponential backoff. Requests that are not idempotent
+    are only retried if they could not be sent at all
+    """
+    def __init__(self, server_url: str, timeout: float = CLIENT_TIMEOUT, retries: int = CLIENT_RETRIES,
+                 pool_size: int = CLIENT_POOL_SIZE, backoff: float = 0.1):
+        self.server_url = server_url
+        self.timeout = timeout
+        retry = Retry(total=retries, connect=retries, read=retries, status=0, backoff_factor=backoff)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        :param str method: HTTP method
+        :param str path: Path of the endpoint, e.g. '/devices'
+        :param kwargs: Arguments of requests.Session.request, a None timeout means the default one
+        """
+        if kwargs.get('timeout') == None:
+            kwargs['timeout'] = self.timeout
+        return self.session.request(method, f'{self.server_url}{path}', **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+class AsyncServerClient:
+    """
+    Asyncio version of ServerClient, based on httpx. Failed
+    connections are retried by the transport with backoff
+    """
+    def __init__(self, server_url: str, timeout: float = CLIENT_TIMEOUT, retries: int = CLIENT_RETRIES,
+                 pool_size: int = CLIENT_POOL_SIZE):
+        if httpx == None:
+            raise ImportError('AsyncServerClient requires httpx')
+        self.server_url = server_url
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        #With a custom transport the limits of the client are ignored
+        self.client = httpx.AsyncClient(base_url=server_url, timeout=timeout,
+                                        transport=httpx.AsyncHTTPTransport(retries=retries, limits=limits))
+
+    async def request(self, method: str, path: str, **kwargs) -> 'httpx.Response':
+        """
+        :param str method: HTTP method
+        :param str path: Path of the endpoint, e.g. '/devices'
+        :param kwargs: Arguments of httpx.AsyncClient.request (e.g. json, params, timeout)
+        """
+        return await self.client.request(method, path, **kwargs)
+
+    async def get(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request('DELETE', path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+clients: typing.Dict[str, ServerClient] = {}
+clients_lock = threading.Lock()
+
+def get_client(server_url: str) -> ServerClient:
+    """
+    Client shared by the functions of this module
+    for the given server
+    """
+    with clients_lock:
+        client = clients.get(server_url)
+        if client == None:
+            client = ServerClient(server_url)
+            clients[server_url] = client
+        return client
+
+def publish_hosts(server_url: str, host_list: typing.Dict[str, str], timeout: typing.Optional[float] = None):
     host_str = json.dumps(host_list)
-    res = requests.post(f'{server_url}/devices', headers={'Content-Type': 'application/json'}, data=host_str)
+    res = get_client(server_url).post('/devices', headers={'Content-Type': 'application/json'}, data=host_str, timeout=timeout)
     if res.status_code != 200:
         print(f'Host publish failed: {res.json()}')
         return False
     return True
 
-def remove_hosts(server_url: str, host_list: typing.List[str]):
+def remove_hosts(server_url: str, host_list: typing.List[str], timeout: typing.Optional[float] = None):
     host_str = json.dumps(host_list)
-    res = requests.delete(f'{server_url}/devices', params={'devs': host_str})
+    res = get_client(server_url).delete('/devices', params={'devs': host_str}, timeout=timeout)
     if res.status_code != 200:
         print(f'Host delete failed: {res.json()}')
         return False 
     return True
 
-def add_sensor(server_url: str, dev_id: str, module: str, name: str):
-    data = json.dumps({'module': module, 'instance_id': name})
-    res = requests.post(f'{server_url}/dev/{dev_id}/sensors', headers={'Content-Type': 'application/json'}, data=data)
+def add_sensor(server_url: str, dev_id: str, module: str, name: str, history: typing.Optional[int] = None, isolation: typing.Optional[str] = None, timeout: typing.Optional[float] = None):
+    body = {'module': module, 'instance_id': name}
+    if history != None:
+        body['history'] = history
+    if isolation != None:
+        body['isolation'] = isolation
+    data = json.dumps(body)
+    res = get_client(server_url).post(f'/dev/{dev_id}/sensors', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Create sensor failed: {res.json()}')
         return False 
     return True
 
-def remove_all_sensors(server_url: str):
-    res = requests.delete(f'{server_url}/dev/sensors/delete_all')
+def remove_all_sensors(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).delete('/dev/sensors/delete_all', timeout=timeout)
     if res.status_code != 200:
         print(f'Remove sensors failed: {res.json()}')
         return False 
+    if res.json()['status'] == 'E_PARTIAL':
+        print(f'Remove sensors failed on some hosts: {res.json()["errors"]}')
+        return False
     return True
 
-def get_all_sensors(server_url: str):
-    res = requests.get(f'{server_url}/dev/sensors/get_all')
+def get_all_sensors(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).get('/dev/sensors/get_all', timeout=timeout)
     if res.status_code != 200:
         return None 
+    if res.json()['status'] == 'E_PARTIAL':
+        print(f'Error getting sensors of some hosts: {res.json()["errors"]}')
     return res.json()['sensors']
 
-def stop_sensor(server_url: str, host_id: str, sensor_id: str):
+def stop_sensor(server_url: str, host_id: str, sensor_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'sensor_id': sensor_id})
-    res = requests.put(f'{server_url}/dev/{host_id}/sensor_stop', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).put(f'/dev/{host_id}/sensor_stop', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Stop sensor failed: {res.json()}')
         return False 
     return True
 
-def start_sensor(server_url: str, host_id: str, sensor_id: str):
+def start_sensor(server_url: str, host_id: str, sensor_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'sensor_id': sensor_id})
-    res = requests.put(f'{server_url}/dev/{host_id}/sensor_start', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).put(f'/dev/{host_id}/sensor_start', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Start sensor failed: {res.json()}')
         return False 
     return True
 
-def add_actuator(server_url: str, dev_id: str, module: str, name: str):
-    data = json.dumps({'module': module, 'instance_id': name})
-    res = requests.post(f'{server_url}/dev/{dev_id}/actuators', headers={'Content-Type': 'application/json'}, data=data)
+def add_actuator(server_url: str, dev_id: str, module: str, name: str, isolation: typing.Optional[str] = None, timeout: typing.Optional[float] = None):
+    body = {'module': module, 'instance_id': name}
+    if isolation != None:
+        body['isolation'] = isolation
+    data = json.dumps(body)
+    res = get_client(server_url).post(f'/dev/{dev_id}/actuators', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Create actuator failed: {res.json()}')
         return False 
     return True
 
-def get_all_actuators(server_url: str):
-    res = requests.get(f'{server_url}/dev/actuators/get_all')
+def get_all_actuators(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).get('/dev/actuators/get_all', timeout=timeout)
     if res.status_code != 200:
         print(f'Error getting all actuators: {res.json()}')
         return None 
+    if res.json()['status'] == 'E_PARTIAL':
+        print(f'Error getting actuators of some hosts: {res.json()["errors"]}')
     return res.json()['actuators']
 
-def remove_all_actuators(server_url: str):
-    res = requests.delete(f'{server_url}/dev/actuators/delete_all')
+def remove_all_actuators(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).delete('/dev/actuators/delete_all', timeout=timeout)
     if res.status_code != 200:
         print(f'Remove actuators failed: {res.json()}')
         return False 
+    if res.json()['status'] == 'E_PARTIAL':
+        print(f'Remove actuators failed on some hosts: {res.json()["errors"]}')
+        return False
     return True
 
-def stop_actuator(server_url: str, host_id: str, actuator_id: str):
+def stop_actuator(server_url: str, host_id: str, actuator_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'actuator_id': actuator_id})
-    res = requests.put(f'{server_url}/dev/{host_id}/actuator_stop', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).put(f'/dev/{host_id}/actuator_stop', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Stop actuator failed: {res.json()}')
         return False 
     return True
 
-def start_actuator(server_url: str, host_id: str, actuator_id: str):
+def start_actuator(server_url: str, host_id: str, actuator_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'actuator_id': actuator_id})
-    res = requests.put(f'{server_url}/dev/{host_id}/actuator_start', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).put(f'/dev/{host_id}/actuator_start', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Start actuator failed: {res.json()}')
         return False 
     return True
 
-def get_sensor_status(server_url: str, host_id: str, sensor_id: str):
+def get_sensor_status(server_url: str, host_id: str, sensor_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'sensor_id': sensor_id})
-    res = requests.get(f'{server_url}/dev/{host_id}/sensor_status', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).get(f'/dev/{host_id}/sensor_status', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Sensor get status failed: {res.json()}')
         return None
     return res.json()['sensor_status']
 
-def get_actuator_status(server_url: str, host_id: str, actuator_id: str):
+def get_actuator_status(server_url: str, host_id: str, actuator_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'actuator_id': actuator_id})
-    res = requests.get(f'{server_url}/dev/{host_id}/actuator_status', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).get(f'/dev/{host_id}/actuator_status', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Actuator get status failed: {res.json()}')
         return None
     return json.loads(res.json()['actuator_status'])
 
-def get_sensor_data(server_url: str, host_id: str, sensor_id: str):
+#Cursors of get_sensor_data, by (server_url, host_id, sensor_id)
+data_cursors: typing.Dict[typing.Tuple[str, str, str], int] = {}
+data_cursors_lock = threading.Lock()
+
+def get_sensor_data(server_url: str, host_id: str, sensor_id: str, timeout: typing.Optional[float] = None):
+    """
+    Readings of a sensor received since the previous call for
+    the same sensor (all the readings kept by the server on the
+    first call). Use poll_sensor_data to manage the cursor
+    """
+    key = (server_url, host_id, sensor_id)
+    with data_cursors_lock:
+        since = data_cursors.get(key)
+    result = poll_sensor_data(server_url, host_id, sensor_id, since, timeout=timeout)
+    if result == None:
+        return None
+    with data_cursors_lock:
+        data_cursors[key] = max(result[1], data_cursors.get(key, result[1]))
+    return result[0]
+
+def poll_sensor_data(server_url: str, host_id: str, sensor_id: str, since: typing.Optional[int] = None, limit: typing.Optional[int] = None, packed: bool = False, timeout: typing.Optional[float] = None):
     data = json.dumps({'sensor_id': sensor_id})
-    res = requests.get(f'{server_url}/dev/{host_id}/sensor_data', headers={'Content-Type': 'application/json'}, data=data)
+    params = {}
+    if since != None:
+        params['since'] = since
+    if limit != None:
+        params['limit'] = limit
+    if packed:
+        params['format'] = 'packed'
+    res = get_client(server_url).get(f'/dev/{host_id}/sensor_data', headers={'Content-Type': 'application/json'}, data=data, params=params, timeout=timeout)
     if res.status_code != 200:
         print(f'Sensor get data failed: {res.json()}')
         return None
-    return [json.loads(elem) for elem in res.json()['sensor_data']]
+    if packed:
+        codec = codec_from_description(json.loads(res.headers['X-Codec']))
+        return codec.decode(res.content), int(res.headers['X-Next'])
+    body = res.json()
+    return body['sensor_data'], body['next']
+
+def get_sensor_aggregate(server_url: str, host_id: str, sensor_id: str, field: str, window: str,
+                         fns: typing.List[str] = ['mean'], start: typing.Optional[float] = None, end: typing.Optional[float] = None, timeout: typing.Optional[float] = None):
+    """
+    Windowed aggregates of a sensor field computed by the server.
+    Returns a dict with the 'start' of each window and one list
+    for each function
+
+    :param str window: Window length, e.g. '60s', '5m', '1h'
+    :param fns: Functions among mean, min, max, sum and count
+    """
+    data = json.dumps({'sensor_id': sensor_id})
+    params = {'field': field, 'window': window, 'fn': ','.join(fns)}
+    if start != None:
+        params['from'] = start
+    if end != None:
+        params['to'] = end
+    res = get_client(server_url).get(f'/dev/{host_id}/sensor_data/aggregate', headers={'Content-Type': 'application/json'}, data=data, params=params, timeout=timeout)
+    if res.status_code != 200:
+        print(f'Sensor aggregate failed: {res.json()}')
+        return None
+    return res.json()['aggregates']
+
+def get_sensor_history(server_url: str, host_id: str, sensor_id: str, start: typing.Optional[float] = None,
+                       end: typing.Optional[float] = None, limit: typing.Optional[int] = None, timeout: typing.Optional[float] = None):
+    """
+    Readings of a sensor stored on disk by the server,
+    with timestamp between start and end
+    """
+    data = json.dumps({'sensor_id': sensor_id})
+    params = {}
+    if start != None:
+        params['from'] = start
+    if end != None:
+        params['to'] = end
+    if limit != None:
+        params['limit'] = limit
+    res = get_client(server_url).get(f'/dev/{host_id}/sensor_data/history', headers={'Content-Type': 'application/json'}, data=data, params=params, timeout=timeout)
+    if res.status_code != 200:
+        print(f'Sensor history failed: {res.json()}')
+        return None
+    return res.json()['sensor_data']
+
+def get_telemetry_batch(server_url: str, 
+                        sensors: typing.List[typing.Tuple[str, str, typing.Optional[int]]], 
+                        actuators: typing.List[typing.Tuple[str, str]], timeout: typing.Optional[float] = None):
+    body = {
+        'sensors': [{'host_id': host_id, 'sensor_id': sensor_id, 'since': since} for host_id, sensor_id, since in sensors],
+        'actuators': [{'host_id': host_id, 'actuator_id': actuator_id} for host_id, actuator_id in actuators]
+    }
+    res = get_client(server_url).post('/telemetry/batch', headers={'Content-Type': 'application/json'}, data=json.dumps(body), timeout=timeout)
+    if res.status_code != 200:
+        print(f'Telemetry batch failed: {res.json()}')
+        return None
+    result = res.json()
+    for entry in result['actuators']:
+        if entry['status'] == 'E_OK':
+            entry['actuator_status'] = json.loads(entry['actuator_status'])
+    return result['sensors'], result['actuators']
+
+def stream_events(server_url: str, topics: typing.List[str] = ['#'], queue_size: typing.Optional[int] = None, timeout: typing.Optional[float] = None):
+    """
+    Generator yielding (event, data) tuples pushed by the
+    server for the topics matching the given filters
+    """
+    params = {'topics': ','.join(topics)}
+    if queue_size != None:
+        params['queue'] = queue_size
+    with get_client(server_url).get('/stream', params=params, stream=True,
+                                     timeout=(CLIENT_TIMEOUT if timeout == None else timeout, None)) as res:
+        if res.status_code != 200:
+            print(f'Stream failed: {res.json()}')
+            return
+        event = 'message'
+        for line in res.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                yield event, json.loads(line[len('data:'):].strip())
+            elif line == '':
+                event = 'message'
 
-def add_controller(server_url: str, module: str, instance_id: str):
+def add_controller(server_url: str, module: str, instance_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'module': module, 'instance_id': instance_id})
-    res = requests.post(f'{server_url}/controllers/add', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).post('/controllers/add', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Add controller failed: {res.json()}')
         return False
     return True
 
-def remove_controller(server_url: str, instance_id: str):
+def remove_controller(server_url: str, instance_id: str, timeout: typing.Optional[float] = None):
     data = json.dumps({'instance_id': instance_id})
-    res = requests.delete(f'{server_url}/controllers/remove', headers={'Content-Type': 'application/json'}, data=data)
+    res = get_client(server_url).delete('/controllers/remove', headers={'Content-Type': 'application/json'}, data=data, timeout=timeout)
     if res.status_code != 200:
         print(f'Remove controller failed: {res.json()}')
         return False
     return True
 
-def get_all_controllers(server_url: str):
-    res = requests.get(f'{server_url}/controllers/get_all')
+def get_all_controllers(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).get('/controllers/get_all', timeout=timeout)
     if res.status_code != 200:
         print(f'Error getting all controllers: {res.json()}')
         return None 
     return res.json()['controllers']
 
-def remove_all_controllers(server_url: str):
-    res = requests.delete(f'{server_url}/controllers/remove_all')
+def remove_all_controllers(server_url: str, timeout: typing.Optional[float] = None):
+    res = get_client(server_url).delete('/controllers/remove_all', timeout=timeout)
     if res.status_code != 200:
         print(f'Error removing all controllers: {res.json()}')
         return False 
@@ -0,0 +1,169 @@
+import json
+import re
+import struct
+import typing
+
+#First byte of every packed message, never valid at the start of a JSON text
+PACKED_MAGIC = 0xB1
+PACKED_VERSION = 1
+#Same as version 1 with the publish time (double) after the header
+PACKED_VERSION_STAMPED = 2
+
+STAMP = struct.Struct('<d')
+
+FIELD_FORMAT = re.compile(r'^([1-9][0-9]*)?([bBhHiIqQfd?])$')
+
+Record = typing.Dict[str, typing.Any]
+
+class JsonCodec:
+    """
+    Default codec, each reading is a JSON object and
+    a batch of readings is a JSON array
+    """
+    name = 'json'
+
+    def describe(self) -> typing.Dict[str, typing.Any]:
+        return {'codec': self.name}
+
+    def encode(self, record: Record) -> bytes:
+        return json.dumps(record).encode()
+
+    def pack(self, pieces: typing.List[bytes]) -> bytes:
+        if len(pieces) == 1:
+            return pieces[0]
+        return b'[' + b','.join(pieces) + b']'
+
+    def pack_records(self, records: typing.List[Record], sent_at: typing.Optional[float] = None) -> bytes:
+        """
+        Encodes a message, 'sent_at' (publish time) is
+        added to every reading
+        """
+        if sent_at != None:
+            records = [dict(record, sent_at=sent_at) for record in records]
+        return self.pack([self.encode(record) for record in records])
+
+    def decode(self, payload: bytes) -> typing.List[Record]:
+        parsed = json.loads(payload)
+        if type(parsed) == type([]):
+            return parsed
+        return [parsed]
+
+class PackedCodec:
+    """
+    Fixed size binary records described by a per-sensor
+    schema, a list of [field name, struct format] where the
+    format is a single struct code optionally preceded by a
+    count for list fields (e.g. ['acceleration', '3f']).
+
+    A message is a 2 bytes header (magic, version), in
+    version 2 followed by the publish time as a double,
+    and then one or more records. Each record starts with
+    a bitmask of the fields present in the reading, missing
+    fields are packed as zeros
+    """
+    name = 'packed'
+
+    def __init__(self, schema: typing.List[typing.Tuple[str, str]]):
+        if len(schema) == 0 or len(schema) > 32:
+            raise ValueError("A packed schema must have from 1 to 32 fields")
+        self.schema: typing.List[typing.Tuple[str, str]] = []
+        self.counts: typing.List[int] = []
+        formats = ['I']
+        for name, fmt in schema:
+            match = FIELD_FORMAT.match(fmt)
+            if type(name) != str or match == None:
+                raise ValueError(f'Invalid packed field {name}: {fmt}')
+            count = int(match.group(1)) if match.group(1) != None else 0
+            self.schema.append((name, fmt))
+            self.counts.append(count)
+            formats.append(fmt)
+        self.record = struct.Struct('<' + ''.join(formats))
+
+    def describe(self) -> typing.Dict[str, typing.Any]:
+        return {'codec': self.name, 'schema': [list(field) for field in self.schema]}
+
+    def encode(self, record: Record) -> bytes:
+        mask = 0
+        values: typing.List[typing.Any] = []
+        for i, ((name, _), count) in enumerate(zip(self.schema, self.counts)):
+            value = record.get(name)
+            if value == None:
+                values.extend([0] * max(count, 1))
+                continue
+            mask |= 1 << i
+            if count > 0:
+                if len(value) != count:
+                    raise ValueError(f'Field {name} must have {count} elements')
+                values.extend(value)
+            else:
+                values.append(value)
+        return self.record.pack(mask, *values)
+
+    def pack(self, pieces: typing.List[bytes], sent_at: typing.Optional[float] = None) -> bytes:
+        if sent_at == None:
+            return bytes([PACKED_MAGIC, PACKED_VERSION]) + b''.join(pieces)
+        return bytes([PACKED_MAGIC, PACKED_VERSION_STAMPED]) + STAMP.pack(sent_at) + b''.join(pieces)
+
+    def pack_records(self, records: typing.List[Record], sent_at: typing.Optional[float] = None) -> bytes:
+        """
+        Encodes a message, 'sent_at' (publish time) is
+        stored in the header
+        """
+        return self.pack([self.encode(record) for record in records], sent_at)
+
+    def decode(self, payload: bytes) -> typing.List[Record]:
+        if len(payload) < 2 or payload[0] != PACKED_MAGIC or payload[1] not in (PACKED_VERSION, PACKED_VERSION_STAMPED):
+            raise ValueError('Invalid packed message header')
+        header = 2 if payload[1] == PACKED_VERSION else 2 + STAMP.size
+        if len(payload) < header:
+            raise ValueError('Invalid packed message header')
+        body = memoryview(payload)[header:]
+        if len(body) % self.record.size != 0:
+            raise ValueError('Packed message size does not match the schema')
+        records: typing.List[Record] = []
+        for values in self.record.iter_unpack(body):
+            mask = values[0]
+            pos = 1
+            record: Record = {}
+            for i, ((name, _), count) in enumerate(zip(self.schema, self.counts)):
+                width = max(count, 1)
+                if mask & (1 << i):
+                    record[name] = list(values[pos:pos + width]) if count > 0 else values[pos]
+                pos += width
+            records.append(record)
+        return records
+
+Codec = typing.Union[JsonCodec, PackedCodec]
+
+JSON_CODEC = JsonCodec()
+
+def is_packed(payload: bytes) -> bool:
+    return len(payload) > 0 and payload[0] == PACKED_MAGIC
+
+def packed_sent_at(payload: bytes) -> typing.Optional[float]:
+    """
+    Publish time in the header of a packed message, None
+    if the message is not stamped
+    """
+    if len(payload) < 2 + STAMP.size or payload[0] != PACKED_MAGIC or payload[1] != PACKED_VERSION_STAMPED:
+        return None
+    return STAMP.unpack_from(payload, 2)[0]
+
+def codec_from_description(description: typing.Any) -> Codec:
+    """
+    Builds a codec from the result of its describe(),
+    as announced by sensors on their '<topic>_codec' topic
+
+    :param description: Parsed codec description
+    """
+    if type(description) != type({}):
+        raise ValueError('Invalid codec description')
+    name = description.get('codec')
+    if name == JsonCodec.name:
+        return JSON_CODEC
+    if name == PackedCodec.name:
+        schema = description.get('schema')
+        if type(schema) != type([]) or not all(type(field) == type([]) and len(field) == 2 for field in schema):
+            raise ValueError('Invalid packed schema')
+        return PackedCodec([(field[0], field[1]) for field in schema])
+    raise ValueError(f'Unknown codec {name}')
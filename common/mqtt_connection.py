@@ -0,0 +1,135 @@
+import paho.mqtt.client as mqtt
+
+import threading
+import typing
+import traceback
+import sys
+
+Handler = typing.Callable[[mqtt.Client, typing.Any, mqtt.MQTTMessage], typing.Any]
+
+class MqttConnection:
+    """
+    One MQTT client and network loop thread shared by
+    many devices of the same process. Each user acquires
+    the connection and registers handlers for its own
+    topics, messages are dispatched through a topic->handler
+    table instead of a single on_message per client.
+    The connection is closed when the last user releases it
+    """
+    def __init__(self, client_id: str, address: str, port: int):
+        self.client_id = client_id
+        self.address = address
+        self.port = port
+        self.client = mqtt.Client(client_id, clean_session=True)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.handlers: typing.Dict[str, Handler] = {}
+        self.wildcard_handlers: typing.Dict[str, Handler] = {}
+        self.lock = threading.Lock()
+        self.users = 0
+        self.connected = False
+        self.looping = False
+
+    def acquire(self):
+        with self.lock:
+            if not self.connected:
+                self.client.connect(self.address, self.port)
+                self.connected = True
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0 or not self.connected:
+                return
+            self.client.disconnect()
+            if self.looping:
+                self.client.loop_stop()
+            self.connected = False
+            self.looping = False
+            _forget(self)
+
+    def start(self):
+        with self.lock:
+            if not self.looping:
+                self.client.loop_start()
+                self.looping = True
+
+    def subscribe(self, topic: str, handler: Handler, qos: int = 0):
+        with self.lock:
+            if '+' in topic or '#' in topic:
+                self.wildcard_handlers[topic] = handler
+            else:
+                self.handlers[topic] = handler
+        self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic: str):
+        with self.lock:
+            self.handlers.pop(topic, None)
+            self.wildcard_handlers.pop(topic, None)
+        self.client.unsubscribe(topic)
+
+    def subscribe_many(self, topics: typing.List[str], handler: Handler, qos: int = 0):
+        """
+        Subscribes to many topics with the same handler
+        using a single SUBSCRIBE
+        """
+        with self.lock:
+            for topic in topics:
+                if '+' in topic or '#' in topic:
+                    self.wildcard_handlers[topic] = handler
+                else:
+                    self.handlers[topic] = handler
+        self.client.subscribe([(topic, qos) for topic in topics])
+
+    def unsubscribe_many(self, topics: typing.List[str]):
+        with self.lock:
+            for topic in topics:
+                self.handlers.pop(topic, None)
+                self.wildcard_handlers.pop(topic, None)
+        self.client.unsubscribe(topics)
+
+    def publish(self, topic: str, payload: typing.Any, qos: int = 0, retain: bool = False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def _on_connect(self, client: mqtt.Client, userdata, flags, reason_code):
+        #Restore every subscription with a single SUBSCRIBE
+        with self.lock:
+            topics = list(self.handlers.keys()) + list(self.wildcard_handlers.keys())
+        if len(topics) > 0:
+            client.subscribe([(topic, 0) for topic in topics])
+
+    def _on_message(self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage):
+        handler = self.handlers.get(msg.topic)
+        if handler == None:
+            for sub, wildcard_handler in list(self.wildcard_handlers.items()):
+                if mqtt.topic_matches_sub(sub, msg.topic):
+                    handler = wildcard_handler
+                    break
+        if handler == None:
+            return
+        try:
+            handler(client, userdata, msg)
+        except:
+            print(traceback.format_exc(), flush=True, file=sys.stdout)
+
+connections: typing.Dict[typing.Tuple[str, int], MqttConnection] = {}
+connections_lock = threading.Lock()
+
+def get_connection(client_id: str, address: str, port: int) -> MqttConnection:
+    """
+    Returns the connection of this process to the
+    given broker, creating it with 'client_id' if it
+    does not exist yet
+    """
+    with connections_lock:
+        connection = connections.get((address, port))
+        if connection == None:
+            connection = MqttConnection(client_id, address, port)
+            connections[(address, port)] = connection
+        return connection
+
+def _forget(connection: MqttConnection):
+    with connections_lock:
+        if connections.get((connection.address, connection.port)) is connection:
+            del connections[(connection.address, connection.port)]
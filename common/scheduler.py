@@ -0,0 +1,213 @@
+import threading
+import typing
+import heapq
+import time
+import itertools
+import traceback
+import sys
+import math
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_PERIOD = 0.001
+MAX_PERIOD = 3600.0
+#Tasks with a period below SPIN_PERIOD get the last SPIN_THRESHOLD
+#seconds before their deadline spun instead of waited, Condition
+#waits can oversleep by a fraction of a millisecond. Slower tasks
+#simply wait until their deadline
+SPIN_PERIOD = 0.005
+SPIN_THRESHOLD = float(os.environ.get('SCHEDULER_SPIN', '0.0002'))
+
+MissedCallback = typing.Callable[['PeriodicTask', int], typing.Any]
+
+def check_period(period: float):
+    """
+    Raises ValueError unless 'period' is a finite number
+    of seconds between MIN_PERIOD and MAX_PERIOD. NaN
+    would break the ordering of the deadline heap and
+    infinity would stall the task forever
+    """
+    if not math.isfinite(period) or period < MIN_PERIOD or period > MAX_PERIOD:
+        raise ValueError(f'Period must be between {MIN_PERIOD} and {MAX_PERIOD} seconds')
+
+class PeriodicTask:
+    """
+    A callback run by a Scheduler every 'period' seconds.
+    Deadlines are computed from the previous deadline
+    (not from the end of the previous run) on the monotonic
+    clock, so the time spent in the callback does not make
+    the task drift. Deadlines that pass while the previous
+    run is still in progress, or that the timer could not
+    meet, are counted as missed and reported to 'on_missed'
+    """
+    def __init__(self, scheduler: 'Scheduler', callback: typing.Callable[[], typing.Any], period: float,
+                 first_deadline: float, on_missed: typing.Optional[MissedCallback]):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.period = period
+        self.next_deadline = first_deadline
+        self.on_missed = on_missed
+        self.version = 0
+        self.cancelled = False
+        self.busy = False
+        self.runs = 0
+        self.missed = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def set_period(self, period: float):
+        """
+        Changes the period, the next deadline becomes
+        one new period after the last one
+        """
+        self.scheduler.reschedule(self, period)
+
+    def mean_lateness(self) -> float:
+        return self.total_lateness / self.runs if self.runs > 0 else 0.0
+
+class Scheduler:
+    """
+    Runs many periodic tasks with a single timer thread.
+    Callbacks are executed on a bounded pool of workers,
+    a task whose previous run is still in progress when
+    its deadline expires skips that run
+    """
+    def __init__(self, workers: int = 4, name: str = 'scheduler'):
+        self.heap: typing.List[typing.Tuple[float, int, int, PeriodicTask]] = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def schedule(self, callback: typing.Callable[[], typing.Any], period: float, delay: typing.Optional[float] = None,
+                 on_missed: typing.Optional[MissedCallback] = None) -> PeriodicTask:
+        check_period(period)
+        if delay != None and (not math.isfinite(delay) or delay < 0):
+            raise ValueError('Delay must be a finite, non negative number of seconds')
+        first_deadline = time.monotonic() + (period if delay == None else delay)
+        task = PeriodicTask(self, callback, period, first_deadline, on_missed)
+        with self.cond:
+            self._push(task)
+            self.cond.notify()
+        return task
+
+    def reschedule(self, task: PeriodicTask, period: float):
+        check_period(period)
+        with self.cond:
+            task.next_deadline += period - task.period
+            task.period = period
+            #The old heap entry is skipped because of the new version
+            task.version += 1
+            self._push(task)
+            self.cond.notify()
+
+    def shutdown(self):
+        with self.cond:
+            self.running = False
+            self.heap.clear()
+            self.cond.notify()
+        self.executor.shutdown(wait=False)
+
+    def _push(self, task: PeriodicTask):
+        heapq.heappush(self.heap, (task.next_deadline, next(self.counter), task.version, task))
+
+    def _execute(self, task: PeriodicTask):
+        try:
+            task.callback()
+        except:
+            print(traceback.format_exc(), flush=True, file=sys.stdout)
+        finally:
+            task.runs += 1
+            task.busy = False
+
+    def _report_missed(self, task: PeriodicTask, count: int):
+        task.missed += count
+        if task.on_missed == None:
+            return
+        try:
+            task.on_missed(task, count)
+        except:
+            print(traceback.format_exc(), flush=True, file=sys.stdout)
+
+    def _wait_next(self) -> typing.Optional[float]:
+        """
+        Waits (with the condition held) until the first task
+        in the heap is due, or within SPIN_THRESHOLD seconds
+        of its deadline for a task faster than SPIN_PERIOD.
+        The task stays in the heap, so that a task scheduled
+        meanwhile with an earlier deadline is not delayed
+
+        :return: The deadline of the first task, None after shutdown
+        """
+        while self.running:
+            if len(self.heap) == 0:
+                self.cond.wait()
+                continue
+            deadline, _, version, task = self.heap[0]
+            if task.cancelled or version != task.version:
+                heapq.heappop(self.heap)
+                continue
+            window = SPIN_THRESHOLD if task.period < SPIN_PERIOD else 0.0
+            remaining = deadline - time.monotonic()
+            if remaining <= window:
+                return deadline
+            self.cond.wait(remaining - window)
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                deadline = self._wait_next()
+                if deadline == None:
+                    return
+
+            while time.monotonic() < deadline:
+                time.sleep(0)
+
+            with self.cond:
+                #The first entry may have changed while spinning, it is popped only when due
+                if len(self.heap) == 0 or self.heap[0][0] > time.monotonic():
+                    continue
+                deadline, _, version, task = heapq.heappop(self.heap)
+                if task.cancelled or version != task.version:
+                    continue
+                now = time.monotonic()
+                missed = 0
+                if task.busy:
+                    missed += 1
+                else:
+                    lateness = now - deadline
+                    task.max_lateness = max(task.max_lateness, lateness)
+                    task.total_lateness += lateness
+                    task.busy = True
+                    self.executor.submit(self._execute, task)
+
+                task.next_deadline = deadline + task.period
+                if task.next_deadline <= now:
+                    skipped = int((now - task.next_deadline) // task.period) + 1
+                    missed += skipped
+                    task.next_deadline += skipped * task.period
+                self._push(task)
+
+            if missed > 0:
+                self._report_missed(task, missed)
+
+scheduler: typing.Optional[Scheduler] = None
+scheduler_lock = threading.Lock()
+
+def get_scheduler(workers: int = 4) -> Scheduler:
+    """
+    Returns the scheduler shared by all the devices
+    of this process, creating it on the first call
+    """
+    global scheduler
+    with scheduler_lock:
+        if scheduler == None:
+            scheduler = Scheduler(workers=workers, name='devices')
+        return scheduler
@@ -14,6 +14,9 @@ def recv_message(controller: Controller, msg: MQTTMessage):
     print(f'{msg.topic} -> {content}', file=controller.log_file, flush=True)
     if msg.topic == 'H1/first_room_temp':
         data = json.loads(content)
+        if type(data) == type([]):
+            #Batched readings, the latest one decides
+            data = data[-1]
         temp = data['new_temp']
         if temp <= 15.0:
             print('Start heater', file=controller.log_file, flush=True)
@@ -1,25 +1,161 @@
 import sys
 import random
 import datetime
+import time
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.ticker import FuncFormatter
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from PyQt5.QtCore import QTimer, Qt, QSize
+from PyQt5.QtCore import QTimer, Qt, QSize, QObject, QRunnable, QThreadPool, pyqtSignal
 from PyQt5.QtGui import QIcon, QFont
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QSizePolicy, QScrollArea, QDialog, QLineEdit, QListWidget, QListWidgetItem, QAbstractItemView
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QSizePolicy, QScrollArea, QDialog, QLineEdit, QListWidget, QListWidgetItem, QAbstractItemView, QComboBox
 
 from app_detail.server_requests import *
 
 import typing
 
+#Maximum redraws per second of each box
+MAX_FPS = 20
+#Readings kept by each box
+HISTORY_CAPACITY = 200000
+#Time windows that can be shown by a box (label, seconds)
+HISTORY_WINDOWS = [('1 min', 60), ('10 min', 600), ('1 hour', 3600), ('6 hours', 21600), ('1 day', 86400), ('7 days', 604800)]
+DEFAULT_WINDOW = 600
+#Room left on the right of the x axis, as a fraction of the window
+AXIS_HEADROOM = 0.05
+
+class HistoryRing:
+    """
+    Fixed capacity ring buffer of (timestamp, value)
+    readings backed by NumPy arrays. Readings are kept
+    in chronological order, so that the readings of a
+    time window are found by binary search
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.total = 0
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def segments(self) -> typing.List[typing.Tuple[int, int]]:
+        """
+        The (at most two) contiguous index ranges of the
+        readings, oldest first
+        """
+        first = (self.total - len(self)) % self.capacity
+        if first + len(self) <= self.capacity:
+            return [(first, first + len(self))]
+        return [(first, self.capacity), (0, first + len(self) - self.capacity)]
+
+    def extend(self, times: typing.Sequence[float], values: typing.Sequence[float]):
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(times) == 0:
+            return
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            times, values = times[order], values[order]
+        if len(self) > 0 and times[0] < self.last_time():
+            #Late readings (rare), the whole ring is merged and laid out again
+            times = np.concatenate([self.times[a:b] for a, b in self.segments()] + [times])
+            values = np.concatenate([self.values[a:b] for a, b in self.segments()] + [values])
+            order = np.argsort(times, kind='stable')
+            times, values = times[order], values[order]
+            self.total = 0
+        times = times[-self.capacity:]
+        values = values[-self.capacity:]
+        pos = (self.total + np.arange(len(times))) % self.capacity
+        self.times[pos] = times
+        self.values[pos] = values
+        self.total += len(times)
+
+    def last_time(self) -> float:
+        return float(self.times[(self.total - 1) % self.capacity])
+
+    def since(self, start: float) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Readings with timestamp from 'start', oldest first.
+        Only the readings of the window are copied
+        """
+        times: typing.List[np.ndarray] = []
+        values: typing.List[np.ndarray] = []
+        for a, b in self.segments():
+            first = a + int(np.searchsorted(self.times[a:b], start, side='left'))
+            times.append(self.times[first:b])
+            values.append(self.values[first:b])
+        return np.concatenate(times), np.concatenate(values)
+
+def decimate(times: np.ndarray, values: np.ndarray, left: float, right: float, width: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduces the readings to the minimum and maximum of
+    each of the 'width' columns of pixels of [left, right),
+    so that the line looks the same with far fewer points
+    """
+    if len(times) <= 2 * width or right <= left:
+        return times, values
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    columns = np.clip(((times - left) / (right - left) * width).astype(np.int64), 0, width - 1)
+    starts = np.flatnonzero(np.concatenate(([True], columns[1:] != columns[:-1])))
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    centers = left + (columns[starts] + 0.5) * (right - left) / width
+    return np.repeat(centers, 2), np.column_stack((mins, maxs)).ravel()
+
+class TaskSignals(QObject):
+    done = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.cancelled = False
+
+class Task(QRunnable):
+    """
+    Runs a blocking call (e.g. a request to the server)
+    on the global thread pool, its result is delivered on
+    the Qt main thread by the 'done' signal. A cancelled
+    task skips the call if it did not start yet and never
+    delivers its result
+    """
+    def __init__(self, fn: typing.Callable[..., typing.Any], *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        #The runnable is deleted by the pool when it ends, the signals object is kept by the caller
+        self.signals = TaskSignals()
+
+    def run(self):
+        if self.signals.cancelled:
+            return
+        try:
+            result = self.fn(*self.args)
+        except:
+            result = None
+        if not self.signals.cancelled:
+            self.signals.done.emit(result)
+
+def run_task(fn: typing.Callable[..., typing.Any], *args, on_done: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None) -> TaskSignals:
+    task = Task(fn, *args)
+    if on_done != None:
+        task.signals.done.connect(on_done)
+    signals = task.signals
+    QThreadPool.globalInstance().start(task)
+    return signals
+
 class Box(QWidget):
     def __init__(self, text: str, heater: typing.Optional[typing.Tuple[str, str]], server_url: str):
         super().__init__()
         self.text = text
-        self.values = []
-        self.timestamps = []
+        self.history = HistoryRing(HISTORY_CAPACITY)
+        self.window = DEFAULT_WINDOW
         self.graph_visible = True
         self.heater = heater
         self.server_url = server_url
+        self.cursor = None
         self.initUI()
 
     def initUI(self):
@@ -52,8 +188,15 @@ class Box(QWidget):
 
         
         button1.setFixedSize(button_size, button_size)
+        self.window_box = QComboBox()
+        for label, seconds in HISTORY_WINDOWS:
+            self.window_box.addItem(label, seconds)
+        self.window_box.setCurrentIndex([seconds for _, seconds in HISTORY_WINDOWS].index(DEFAULT_WINDOW))
+        self.window_box.currentIndexChanged.connect(self.change_window)
+
         top_layout.addWidget(button1)
         top_layout.addWidget(self.label)
+        top_layout.addWidget(self.window_box)
 
         if self.heater:
             top_layout.addWidget(self.button2)
@@ -67,6 +210,18 @@ class Box(QWidget):
         self.fig, self.ax = plt.subplots()
         self.canvas = FigureCanvas(self.fig)
         self.layout.addWidget(self.canvas)
+
+        #Timestamps are plotted as numbers, only the tick labels are formatted
+        self.ax.set_ylim(5, 30)
+        self.ax.xaxis.set_major_formatter(FuncFormatter(self.format_time))
+        #The line is not drawn with the figure but blitted on the cached background
+        self.line, = self.ax.plot([], [], animated=True)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.last_frame = 0.0
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.render_frame)
         
         self.setFixedHeight(800)
         self.update_plot()
@@ -74,6 +229,8 @@ class Box(QWidget):
     def toggle_graph(self):
         self.graph_visible = not self.graph_visible
         self.canvas.setVisible(self.graph_visible)
+        if self.graph_visible:
+            self.update_plot()
         if hasattr(self, 'button2'):
             self.button2.setVisible(self.graph_visible)
             self.button2.setStyleSheet("background-color: darkRed;")
@@ -86,10 +243,11 @@ class Box(QWidget):
 
     def switch_heater_status(self):
         self.heater_on = not self.heater_on
+        #The command is sent on the thread pool, not to block the window
         if self.heater_on:
-            start_actuator(self.server_url, self.heater[0], self.heater[1])
+            run_task(start_actuator, self.server_url, self.heater[0], self.heater[1])
         else:
-            stop_actuator(self.server_url, self.heater[0], self.heater[1])
+            run_task(stop_actuator, self.server_url, self.heater[0], self.heater[1])
         self.change_button2_color()
 
     def change_button2_color(self):
@@ -102,28 +260,65 @@ class Box(QWidget):
             self.button2.setStyleSheet("background-color: darkRed;")
 
     def update_plot(self):
-        self.ax.clear()
-        if self.timestamps:
-            self.ax.plot(self.timestamps, self.values)
-        self.ax.set_ylim(5, 30)
-        self.canvas.draw()
+        #Updates are coalesced in at most MAX_FPS frames per second
+        if self.frame_timer.isActive():
+            return
+        delay = max(0.0, self.last_frame + 1.0 / MAX_FPS - time.monotonic())
+        self.frame_timer.start(int(delay * 1000))
+
+    def render_frame(self):
+        self.last_frame = time.monotonic()
+        if not self.graph_visible:
+            return
+        rescaled = self.rescale_x()
+        #Drawing cost depends on the width of the canvas, not on the readings in the window
+        left, right = self.ax.get_xlim()
+        times, values = self.history.since(left)
+        self.line.set_data(*decimate(times, values, left, right, max(int(self.ax.bbox.width), 1)))
+        if rescaled or self.background == None:
+            #Full redraw, on_draw blits the line on the new background
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.line)
+        self.canvas.blit(self.ax.bbox)
+
+    def rescale_x(self) -> bool:
+        """
+        Moves the x axis to show the last 'window' seconds
+        when the readings do not fit in it anymore, leaving
+        room on the right so that the next readings are only
+        blitted
+        """
+        if len(self.history) == 0:
+            return False
+        last = self.history.last_time()
+        left, right = self.ax.get_xlim()
+        headroom = self.window * AXIS_HEADROOM
+        if last <= right and abs((right - left) - (self.window + headroom)) < 1e-6:
+            return False
+        self.ax.set_xlim(last - self.window, last + headroom)
+        return True
+
+    def change_window(self, index: int):
+        self.window = self.window_box.itemData(index)
+        self.update_plot()
+
+    def format_time(self, x: float, pos) -> str:
+        fmt = "%H:%M:%S" if self.window < 86400 else "%d/%m %H:%M"
+        return datetime.datetime.fromtimestamp(x).strftime(fmt)
+
+    def on_draw(self, event):
+        #Called after every full draw of the figure (updates, resizes)
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
 
     def add_value(self, value):
-        current_time = datetime.datetime.now().strftime("%H:%M:%S")
-        self.values.append(value)
-        self.timestamps.append(current_time)
-        if len(self.values) > 10:
-            self.values.pop(0)
-            self.timestamps.pop(0)
+        self.history.extend([time.time()], [value])
         self.update_plot()
 
     def add_values(self, values: typing.List):
-        values = values[-10:]
-        self.values.extend([value['new_temp'] for value in values])
-        self.timestamps.extend([datetime.datetime.fromtimestamp(value['timestamp']).strftime("%H:%M:%S") for value in values])
-        if len(self.values) > 10:
-            self.values = self.values[-10:]
-            self.timestamps = self.timestamps[-10:]
+        self.history.extend([value['timestamp'] for value in values], [value['new_temp'] for value in values])
         self.update_plot()
         return
 
@@ -260,6 +455,11 @@ class MainWindow(QMainWindow):
                 raise ValueError("Found invalid connection")
 
         self.connections = connection_list
+        #Poll in flight, its boxes and heater boxes
+        self.poll: typing.Optional[TaskSignals] = None
+        self.poll_boxes: typing.List[typing.Tuple[typing.Tuple[str, str], Box]] = []
+        self.poll_heater_boxes: typing.List[Box] = []
+        self.skipped_polls = 0
         self.initUI(open_sensors)
 
     def initUI(self, open_sensors: typing.List[int]):
@@ -333,20 +533,58 @@ class MainWindow(QMainWindow):
         self.update_values()
 
     def update_values(self):
-        for sensor, box in self.boxes:
-            if self.server_url == '':
+        if self.server_url == '':
+            for _, box in self.boxes:
                 new_value = random.randint(5, 30)
                 box.add_value(new_value)
-            else:
-                values = get_sensor_data(self.server_url, sensor[0], sensor[1])
-                if values != None:
-                    print(f'{sensor[0]}/{sensor[1]} {values}')
-                    box.add_values(values)
-                if box.heater != None:
-                    status = get_actuator_status(self.server_url, box.heater[0], box.heater[1])
-                    if status != None:
-                        print(f'{box.heater[0]}/{box.heater[1]} {status}')
-                        box.update_heater_status(status['is_on'])
+            return
+
+        #Skip the tick while the previous poll is still running
+        if self.poll != None:
+            self.skipped_polls += 1
+            return
+        
+        self.poll_boxes = list(self.boxes)
+        self.poll_heater_boxes = [box for _, box in self.poll_boxes if box.heater != None]
+        sensors = [(sensor[0], sensor[1], box.cursor) for sensor, box in self.poll_boxes]
+        heaters = [box.heater for box in self.poll_heater_boxes]
+        poll = run_task(get_telemetry_batch, self.server_url, sensors, heaters)
+        #The signals object is the token of the poll, passed back with its result
+        poll.done.connect(lambda result: self.apply_values(poll, result))
+        self.poll = poll
+
+    def cancel_poll(self):
+        """
+        Drops the result of the poll in flight, so that
+        the next tick starts a new one
+        """
+        if self.poll != None:
+            self.poll.cancelled = True
+            self.poll = None
+
+    def apply_values(self, poll: TaskSignals, result):
+        #Runs on the main thread when the poll ends. The result of
+        #a cancelled poll may already be queued, it is ignored
+        if poll is not self.poll:
+            return
+        self.poll = None
+        if result == None:
+            return
+        
+        sensor_results, heater_results = result
+        for (sensor, box), entry in zip(self.poll_boxes, sensor_results):
+            if entry['status'] != 'E_OK':
+                continue
+            values = entry['sensor_data']
+            box.cursor = entry['next']
+            print(f'{sensor[0]}/{sensor[1]} {values}')
+            box.add_values(values)
+        for box, entry in zip(self.poll_heater_boxes, heater_results):
+            if entry['status'] != 'E_OK':
+                continue
+            status = entry['actuator_status']
+            print(f'{box.heater[0]}/{box.heater[1]} {status}')
+            box.update_heater_status(status['is_on'])
 
     def open_add_box_dialog(self):
         dialog = AddBoxDialog(self.sensors)
@@ -383,6 +621,9 @@ class MainWindow(QMainWindow):
                     last_row_layout.addWidget(new_box)
 
                 self.boxes.append((sensor_entry, new_box))
+                #Poll again right away, including the new box
+                self.cancel_poll()
+                self.update_values()
 
                 self.transparent_box_with_button = TransparentBoxWithButton('', self)
                 if len(self.boxes) % 2 == 1:
@@ -398,6 +639,11 @@ class MainWindow(QMainWindow):
                     self.row_widgets.append(row_widget)
                     self.layout.addWidget(row_widget)
 
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.cancel_poll()
+        super().closeEvent(event)
+
     def remove_all_transparent_boxes(self):
         if self.transparent_box_with_button != None:
             self.layout.removeWidget(self.transparent_box_with_button)
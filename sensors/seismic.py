@@ -1,51 +1,51 @@
 import paho.mqtt.client as mqtt
 
 import json
-import time
 import datetime
 import numpy as np
 
-from sensor_class import Sensor
-
-sensor = Sensor()
-
-running: bool = True
-stop: bool = False
+from sensor_class import Sensor, run_device
+from common.codec import PackedCodec
 
 MODE_0 = 0
 MODE_1 = 1
 
-current_mode: int = MODE_1
-
-def on_message(client, userdata, msg: mqtt.MQTTMessage):
-    global current_mode
-    message = str(msg.payload.decode('utf-8')).upper()
-    print(f'Received message: {message}')
-    if message == 'MODE_0':
-        current_mode = MODE_0
-    elif message == 'MODE_1': 
-        current_mode = MODE_1
-    else:
-        current_mode = MODE_0
-
-sensor.set_on_message(on_message)
-sensor.connect()
-sensor.start()
-
-while running:
-    time.sleep(5)
-    sensor.update_status(json.dumps({'mode': current_mode}))
-    if not stop:
-        timestamp = datetime.datetime.now().timestamp()
-        intensity = np.random.randint(0, 10) 
-        acc_x = np.random.randint(0, 5)
-        acc_y = np.random.randint(0, 5)
-        acc_z = np.random.randint(0, 5)
-        
-        if current_mode == MODE_0:
-            sensor.send_data(json.dumps({'intensity': intensity, 'mode': current_mode, 'timestamp': timestamp}))
+SCHEMA = [('timestamp', 'd'), ('mode', 'B'), ('intensity', 'B'), ('accelleration', '3B')]
+
+class SeismicSensor:
+    def __init__(self, sensor: Sensor):
+        self.sensor = sensor
+        self.period = 5.0
+        self.running = True
+        self.stop = False
+        self.current_mode = MODE_1
+        sensor.set_codec(PackedCodec(SCHEMA))
+        sensor.set_on_message(self.on_message)
+
+    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        message = str(msg.payload.decode('utf-8')).upper()
+        print(f'Received message: {message}', file=self.sensor.log_file, flush=True)
+        if message == 'MODE_0':
+            self.current_mode = MODE_0
+        elif message == 'MODE_1':
+            self.current_mode = MODE_1
         else:
-            sensor.send_data(json.dumps({'accelleration': [acc_x, acc_y, acc_z], 'mode': current_mode, 'timestamp': timestamp}))
+            self.current_mode = MODE_0
+
+    def step(self):
+        self.sensor.update_status(json.dumps({'mode': self.current_mode}))
+        if not self.stop:
+            timestamp = datetime.datetime.now().timestamp()
+            intensity = int(np.random.randint(0, 10))
+            acc_x, acc_y, acc_z = np.random.randint(0, 5, size=3).tolist()
+
+            if self.current_mode == MODE_0:
+                self.sensor.send_data({'intensity': intensity, 'mode': self.current_mode, 'timestamp': timestamp})
+            else:
+                self.sensor.send_data({'accelleration': [acc_x, acc_y, acc_z], 'mode': self.current_mode, 'timestamp': timestamp})
+
+def create(sensor: Sensor):
+    return SeismicSensor(sensor)
 
-sensor.stop()
-sensor.disconnect()
\ No newline at end of file
+if __name__ == '__main__':
+    run_device(create)
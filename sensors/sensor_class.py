@@ -2,9 +2,19 @@ import paho.mqtt.client as mqtt
 
 import os
 import sys
+import time
+import json
+import typing
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mqtt_connection import MqttConnection, get_connection
+from common.codec import Codec, JSON_CODEC
+from common.scheduler import PeriodicTask, get_scheduler
 
 class Sensor:
-    def __init__(self):
+    def __init__(self, module_name: typing.Optional[str] = None, connection: typing.Optional[MqttConnection] = None):
         if os.environ.get('MQTT_ADDRESS') == None or os.environ.get('MQTT_PORT') == None:
             print('Env. variables for MQTT do not exist', flush=True, file=sys.stdout)
             exit(1)
@@ -13,55 +23,218 @@ class Sensor:
             print('Env. variables SERVER_ID does not exist', flush=True, file=sys.stdout)
             exit(1)
 
-        if os.environ.get('MODULE_NAME') == None:
+        if module_name == None and os.environ.get('MODULE_NAME') == None:
             print('Env. variables MODULE_NAME does not exist', flush=True, file=sys.stdout)
             exit(1)
 
-        self.module_name = os.environ['MODULE_NAME']
+        self.module_name = module_name if module_name != None else os.environ['MODULE_NAME']
         self.server_id = os.environ.get('SERVER_ID')
         self.mqtt_client_id = f'{self.server_id}_{self.module_name}'
         self.mqtt_topic = f'{self.server_id}/{self.module_name}'
         self.mqtt_control_topic = f'{self.server_id}/{self.module_name}_control'
         self.mqtt_status_topic = f'{self.server_id}/{self.module_name}_status'
+        self.mqtt_codec_topic = f'{self.server_id}/{self.module_name}_codec'
         self.log_file = open(f'./logs/{self.server_id}_{self.module_name}_log.txt', 'w')
-        self.client = mqtt.Client(self.mqtt_client_id, clean_session=True)
+        #Sensors (and actuators) of the same process share
+        #one connection to the broker, see common/mqtt_connection.py
+        if connection == None:
+            connection = get_connection(self.mqtt_client_id, os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+        self.connection = connection
+        self.client = connection.client
+        self.on_message = None
         self.connected = False
-        return 
-    
+        self.task: typing.Optional[PeriodicTask] = None
+        self.last_missed_report = 0.0
+        self.last_status = None
+        self.codec: Codec = JSON_CODEC
+        self.batch_size = 0
+        self.batch_delay = 0.0
+        self.batch: typing.List[typing.Dict[str, typing.Any]] = []
+        self.batch_lock = threading.Lock()
+        self.batch_timer: typing.Optional[threading.Timer] = None
+        return
+
     def set_on_message(self, on_message):
-        self.client.on_message = on_message
-    
-    def connect(self):
-        def on_connect(client: mqtt.Client, userdata, flags, reason_code):
-            print('Connected', flush=True, file=self.log_file)
-            client.subscribe(self.mqtt_control_topic)
+        self.on_message = on_message
+
+    def _handle_control(self, client, userdata, msg: mqtt.MQTTMessage):
+        message = msg.payload.decode('utf-8').strip().upper()
+        #'PERIOD <seconds>' changes the sampling period at runtime
+        if message.startswith('PERIOD ') and self.task != None:
+            return self.set_period(message[len('PERIOD '):])
+        if self.on_message != None:
+            self.on_message(client, userdata, msg)
+        return 'E_OK'
+
+    def set_period(self, value: str) -> str:
+        """
+        Changes the sampling period, given as the text of
+        a 'PERIOD' control message. Values that are not
+        finite or outside the limits of the scheduler are
+        rejected and the period is left unchanged
 
-        self.client.on_connect = on_connect
-        self.client.connect(os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+        :param str value: Seconds between two samples
+        :return: 'E_OK' or 'E_PARAMS'
+        """
+        try:
+            self.task.set_period(float(value))
+        except ValueError:
+            print(f'Invalid period: {value}', file=self.log_file, flush=True)
+            return 'E_PARAMS'
+        print(f'Sampling period set to {self.task.period}s', file=self.log_file, flush=True)
+        return 'E_OK'
+
+    def schedule(self, callback: typing.Callable[[], typing.Any], period: float) -> PeriodicTask:
+        """
+        Runs 'callback' every 'period' seconds (from 1 ms
+        to minutes) on the process scheduler, with deadlines
+        on the monotonic clock so that sampling does not
+        drift. Missed deadlines are reported in the log and
+        the period can be changed with the 'PERIOD <seconds>'
+        control message
+
+        :param callback: Sampling function
+        :param float period: Seconds between two calls
+        """
+        if self.task != None:
+            self.task.cancel()
+        self.task = get_scheduler().schedule(callback, period, on_missed=self._report_missed)
+        return self.task
+
+    def _report_missed(self, task: PeriodicTask, count: int):
+        #At most one report per second, high rate sensors could flood the log
+        now = time.monotonic()
+        if now - self.last_missed_report < 1.0:
+            return
+        self.last_missed_report = now
+        print(f'Missed {task.missed} deadlines so far (period {task.period}s, max lateness {task.max_lateness:.6f}s)', 
+              file=self.log_file, flush=True)
+
+    def connect(self):
+        self.connection.acquire()
+        self.connection.subscribe(self.mqtt_control_topic, self._handle_control)
+        print('Connected', flush=True, file=self.log_file)
         self.connected = True
+        self._announce_codec()
 
     def start(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.loop_start()
+        self.connection.start()
 
     def stop(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.loop_stop()
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
 
     def disconnect(self):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.disconnect()
+        if self.task != None:
+            self.task.cancel()
+        self.flush()
+        #Clear the retained status and codec, the device is gone
+        self.client.publish(self.mqtt_status_topic, '', retain=True)
+        self.client.publish(self.mqtt_codec_topic, '', retain=True)
+        self.connection.unsubscribe(self.mqtt_control_topic)
+        self.connection.release()
+        self.connected = False
+
+    def enable_batching(self, max_size: int = 32, max_delay: float = 1.0):
+        """
+        Accumulates the readings passed to send_data and
+        publishes them as a single message, when 'max_size'
+        readings are pending or 'max_delay' seconds after
+        the first pending reading
+
+        :param int max_size: Number of readings that triggers a flush
+        :param float max_delay: Maximum seconds a reading waits in the batch
+        """
+        if max_size <= 0 or max_delay <= 0:
+            raise ValueError("Invalid batching parameters")
+        self.batch_size = max_size
+        self.batch_delay = max_delay
+
+    def set_codec(self, codec: Codec):
+        """
+        Selects how readings are encoded. The codec is
+        announced (retained) on the '<topic>_codec' topic so
+        that the main server decodes this topic accordingly
+        """
+        self.flush()
+        self.codec = codec
+        if self.connected:
+            self._announce_codec()
+
+    def _announce_codec(self):
+        self.client.publish(self.mqtt_codec_topic, json.dumps(self.codec.describe()), qos=1, retain=True)
 
     def send_data(self, data):
+        """
+        Publishes a reading, given either as a dict or
+        as a JSON string. Messages are stamped with their
+        publish time ('sent_at'), used by the server to
+        measure the latency of the readings
+
+        :param data: The reading
+        """
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.publish(self.mqtt_topic, data)
+        if isinstance(data, str):
+            data = json.loads(data)
+        if self.batch_size == 0:
+            self.client.publish(self.mqtt_topic, self.codec.pack_records([data], time.time()))
+            return
+        with self.batch_lock:
+            self.batch.append(data)
+            if len(self.batch) < self.batch_size:
+                if self.batch_timer == None:
+                    self.batch_timer = threading.Timer(self.batch_delay, self.flush)
+                    self.batch_timer.daemon = True
+                    self.batch_timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.batch_lock:
+            if self.batch_timer != None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            if len(self.batch) == 0:
+                return
+            records = self.batch
+            self.batch = []
+        #Stamped when the batch is published, not when its readings were queued
+        self.client.publish(self.mqtt_topic, self.codec.pack_records(records, time.time()))
 
     def update_status(self, status):
         if not self.connected:
             raise Exception("Not connected to broker")
-        self.client.publish(self.mqtt_status_topic, status)
-    
\ No newline at end of file
+        #Only changes are published, retained so that
+        #new subscribers still get the current status
+        if status == self.last_status:
+            return
+        self.last_status = status
+        self.client.publish(self.mqtt_status_topic, status, retain=True)
+
+def run_device(create: typing.Callable[[Sensor], typing.Any]):
+    """
+    Runs a sensor plugin in its own process, used when
+    the module is started as a script
+
+    :param create: The 'create' function of the sensor module
+    """
+    sensor = Sensor()
+    device = create(sensor)
+    sensor.connect()
+    sensor.start()
+    sensor.schedule(device.step, device.period)
+
+    while device.running:
+        time.sleep(0.1)
+
+    sensor.stop()
+    sensor.disconnect()
+
@@ -1,46 +1,44 @@
 import paho.mqtt.client as mqtt
 
 import json
-import time
 import datetime
 
-from sensor_class import Sensor
-
-sensor = Sensor()
-
-running: bool = True
-stop: bool = False
-
-def on_message(client, userdata, msg: mqtt.MQTTMessage):
-    global running, sensor, stop
-    message = str(msg.payload.decode('utf-8')).upper()
-    if message == "STOP":
-        print("Received stop command", file=sensor.log_file, flush=True)
-        stop = True
-    if message == "START":
-        print("Received start command", file=sensor.log_file, flush=True)
-        stop = False
-    if message == "DISCONNECT":
-        print("Received disconnect command", file=sensor.log_file)
-        running = False
-
-sensor.set_on_message(on_message)
-sensor.connect()
-sensor.start()
-
-step_increment = 1.0
-curr_temp = 10.0
-
-while running:
-    time.sleep(5)
-    sensor.update_status(json.dumps({'is_on': not stop}))
-    if not stop:
-        sensor.send_data(json.dumps({'new_temp': curr_temp, 'timestamp': datetime.datetime.now().timestamp()}))
-        if curr_temp >= 30.0:
-            step_increment = -1.0
-        elif curr_temp <= 10.0:
-            step_increment = 1.0
-        curr_temp += step_increment
-
-sensor.stop()
-sensor.disconnect()
\ No newline at end of file
+from sensor_class import Sensor, run_device
+
+class TempSensor:
+    def __init__(self, sensor: Sensor):
+        self.sensor = sensor
+        self.period = 5.0
+        self.running = True
+        self.stop = False
+        self.step_increment = 1.0
+        self.curr_temp = 10.0
+        sensor.set_on_message(self.on_message)
+
+    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        message = str(msg.payload.decode('utf-8')).upper()
+        if message == "STOP":
+            print("Received stop command", file=self.sensor.log_file, flush=True)
+            self.stop = True
+        if message == "START":
+            print("Received start command", file=self.sensor.log_file, flush=True)
+            self.stop = False
+        if message == "DISCONNECT":
+            print("Received disconnect command", file=self.sensor.log_file)
+            self.running = False
+
+    def step(self):
+        self.sensor.update_status(json.dumps({'is_on': not self.stop}))
+        if not self.stop:
+            self.sensor.send_data({'new_temp': self.curr_temp, 'timestamp': datetime.datetime.now().timestamp()})
+            if self.curr_temp >= 30.0:
+                self.step_increment = -1.0
+            elif self.curr_temp <= 10.0:
+                self.step_increment = 1.0
+            self.curr_temp += self.step_increment
+
+def create(sensor: Sensor):
+    return TempSensor(sensor)
+
+if __name__ == '__main__':
+    run_device(create)
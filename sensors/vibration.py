@@ -0,0 +1,55 @@
+import paho.mqtt.client as mqtt
+
+import json
+import math
+import time
+import numpy as np
+
+from sensor_class import Sensor, run_device
+from common.codec import PackedCodec
+
+SCHEMA = [('timestamp', 'd'), ('acceleration', '3f')]
+
+#200 Hz sampling, readings are sent in batches of 50 (4 messages per second)
+SAMPLING_PERIOD = 0.005
+BATCH_SIZE = 50
+BATCH_DELAY = 0.5
+
+class VibrationSensor:
+    def __init__(self, sensor: Sensor):
+        self.sensor = sensor
+        self.period = SAMPLING_PERIOD
+        self.running = True
+        self.stop = False
+        self.frequency = 25.0
+        self.start_time = time.monotonic()
+        sensor.set_codec(PackedCodec(SCHEMA))
+        sensor.enable_batching(BATCH_SIZE, BATCH_DELAY)
+        sensor.set_on_message(self.on_message)
+
+    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        message = str(msg.payload.decode('utf-8')).upper()
+        if message == "STOP":
+            print("Received stop command", file=self.sensor.log_file, flush=True)
+            self.stop = True
+        if message == "START":
+            print("Received start command", file=self.sensor.log_file, flush=True)
+            self.stop = False
+        if message == "DISCONNECT":
+            print("Received disconnect command", file=self.sensor.log_file)
+            self.running = False
+
+    def step(self):
+        self.sensor.update_status(json.dumps({'is_on': not self.stop}))
+        if not self.stop:
+            elapsed = time.monotonic() - self.start_time
+            amplitude = math.sin(2.0 * math.pi * self.frequency * elapsed)
+            noise = np.random.normal(0.0, 0.05, size=3).tolist()
+            acceleration = [amplitude + noise[0], 0.5 * amplitude + noise[1], 9.81 + noise[2]]
+            self.sensor.send_data({'acceleration': acceleration, 'timestamp': time.time()})
+
+def create(sensor: Sensor):
+    return VibrationSensor(sensor)
+
+if __name__ == '__main__':
+    run_device(create)
@@ -0,0 +1,191 @@
+import typing
+import re
+import math
+
+import numpy as np
+
+FUNCTIONS = ('mean', 'min', 'max', 'sum', 'count')
+
+#Default rollups, 1 minute buckets for a day and 1 hour buckets for a month
+DEFAULT_ROLLUPS = '60:1440,3600:720'
+
+WINDOW_FORMAT = re.compile(r'^([0-9]+(?:\.[0-9]+)?)([smhd]?)$')
+WINDOW_UNITS = {'': 1.0, 's': 1.0, 'm': 60.0, 'h': 3600.0, 'd': 86400.0}
+#Shorter windows would overflow the int64 window numbers of timestamps
+MIN_WINDOW = 0.001
+
+Aggregates = typing.Dict[str, typing.List[typing.Any]]
+#Window numbers, counts, sums, minimums and maximums of partial
+#aggregates, the arguments of reduce_groups before 'window'
+Partials = typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+def parse_window(window: str) -> float:
+    """
+    Parses a window length like '30', '60s', '5m', '1h' or '1d',
+    of at least MIN_WINDOW seconds
+
+    :return: The length in seconds
+    """
+    match = WINDOW_FORMAT.match(window)
+    if match == None:
+        raise ValueError(f'Invalid window {window}')
+    seconds = float(match.group(1)) * WINDOW_UNITS[match.group(2)]
+    if not math.isfinite(seconds) or seconds < MIN_WINDOW:
+        raise ValueError(f'Invalid window {window}')
+    return seconds
+
+def parse_rollups(spec: str) -> typing.List[typing.Tuple[float, int]]:
+    """
+    Parses a list of rollups like '60:1440,3600:720'
+    (resolution in seconds and buckets kept)
+    """
+    rollups: typing.List[typing.Tuple[float, int]] = []
+    for item in spec.split(','):
+        if item.strip() == '':
+            continue
+        resolution, _, capacity = item.partition(':')
+        rollups.append((parse_window(resolution.strip()), int(capacity)))
+    return rollups
+
+def reduce_groups(groups: np.ndarray, counts: np.ndarray, sums: np.ndarray, mins: np.ndarray, maxs: np.ndarray,
+                  window: float, fns: typing.Iterable[str]) -> Aggregates:
+    """
+    Merges partial aggregates (single readings or rollup
+    buckets) belonging to the same window. Returns one
+    column for the window start times and one for each
+    requested function
+
+    :param groups: Window number of each partial aggregate
+    :param counts: Readings in each partial aggregate
+    :param sums: Sum of the readings of each partial aggregate (one row per aggregate for list fields)
+    :param mins: Minimum of each partial aggregate
+    :param maxs: Maximum of each partial aggregate
+    :param float window: Window length in seconds
+    :param fns: Functions to compute, from FUNCTIONS
+    """
+    result: Aggregates = {'start': []}
+    for fn in fns:
+        result[fn] = []
+    if len(groups) == 0:
+        return result
+
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    starts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    window_counts = np.add.reduceat(counts[order], starts)
+    result['start'] = (groups[starts] * window).tolist()
+    for fn in fns:
+        if fn == 'count':
+            result[fn] = window_counts.tolist()
+        elif fn == 'sum' or fn == 'mean':
+            window_sums = np.add.reduceat(sums[order], starts, axis=0)
+            if fn == 'mean':
+                window_sums = window_sums / window_counts.reshape((-1,) + (1,) * (window_sums.ndim - 1))
+            result[fn] = window_sums.tolist()
+        elif fn == 'min':
+            result[fn] = np.minimum.reduceat(mins[order], starts, axis=0).tolist()
+        elif fn == 'max':
+            result[fn] = np.maximum.reduceat(maxs[order], starts, axis=0).tolist()
+    return result
+
+def reading_partials(timestamps: np.ndarray, values: np.ndarray, window: float) -> Partials:
+    """
+    Raw readings as partial aggregates of one reading,
+    missing values (NaN) must already be filtered out
+    """
+    if not math.isfinite(window) or window < MIN_WINDOW:
+        raise ValueError(f'Window must be at least {MIN_WINDOW} seconds')
+    groups = np.floor(timestamps / window).astype(np.int64)
+    return groups, np.ones(len(groups), dtype=np.int64), values, values, values
+
+def aggregate_readings(timestamps: np.ndarray, values: np.ndarray, window: float,
+                       fns: typing.Iterable[str]) -> Aggregates:
+    """
+    Windowed aggregates of raw readings, missing
+    values (NaN) must already be filtered out
+    """
+    return reduce_groups(*reading_partials(timestamps, values, window), window, fns)
+
+class Rollup:
+    """
+    Count, sum, minimum and maximum of the numeric fields
+    of a sensor over fixed 'resolution' seconds buckets,
+    updated as readings arrive. The last 'capacity' buckets
+    are kept in a ring, so rollups cover a much longer
+    period than the raw readings with a fixed memory.
+
+    List fields are not rolled up. Readings older than the
+    bucket currently stored in their slot are ignored
+    """
+    def __init__(self, resolution: float, capacity: int):
+        if resolution <= 0 or capacity <= 0:
+            raise ValueError('Rollup resolution and capacity must be positive')
+        self.resolution = resolution
+        self.capacity = capacity
+        self.buckets = np.full(capacity, -1, dtype=np.int64)
+        self.fields: typing.Dict[str, np.ndarray] = {}
+
+    def _field_array(self, name: str) -> np.ndarray:
+        arr = self.fields.get(name)
+        if arr is None:
+            #Rows: count, sum, min, max
+            arr = np.zeros((4, self.capacity), dtype=np.float64)
+            arr[2] = np.inf
+            arr[3] = -np.inf
+            self.fields[name] = arr
+        return arr
+
+    def add(self, timestamp: float, values: typing.Dict[str, typing.Any]):
+        bucket = int(timestamp // self.resolution)
+        pos = bucket % self.capacity
+        if self.buckets[pos] != bucket:
+            if self.buckets[pos] > bucket:
+                return
+            self.buckets[pos] = bucket
+            for arr in self.fields.values():
+                arr[:, pos] = (0.0, 0.0, np.inf, -np.inf)
+        for name, value in values.items():
+            if isinstance(value, list):
+                continue
+            arr = self._field_array(name)
+            arr[0, pos] += 1
+            arr[1, pos] += value
+            if value < arr[2, pos]:
+                arr[2, pos] = value
+            if value > arr[3, pos]:
+                arr[3, pos] = value
+
+    def covers(self, window: float, start: typing.Optional[float], end: typing.Optional[float]) -> bool:
+        """
+        Whether the query can be answered from this rollup:
+        windows and range bounds must fall on bucket boundaries
+        """
+        for value in (window, start, end):
+            if value == None:
+                continue
+            buckets = value / self.resolution
+            if abs(buckets - round(buckets)) > 1e-9:
+                return False
+        return True
+
+    def partials(self, field: str, window: float, start: typing.Optional[float], end: typing.Optional[float]) -> Partials:
+        """
+        Copy of the buckets of a field between 'start' and 'end',
+        grouped by window (see covers())
+        """
+        arr = self.fields.get(field)
+        if arr is None:
+            empty = np.empty(0)
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), empty, empty, empty
+        mask = (self.buckets >= 0) & (arr[0] > 0)
+        if start != None:
+            mask &= self.buckets >= round(start / self.resolution)
+        if end != None:
+            mask &= self.buckets < round(end / self.resolution)
+        #covers() checked that a window is a whole number of buckets
+        groups = self.buckets[mask] // round(window / self.resolution)
+        return groups, arr[0, mask].astype(np.int64), arr[1, mask], arr[2, mask], arr[3, mask]
+
+    def aggregate(self, field: str, window: float, fns: typing.Iterable[str],
+                  start: typing.Optional[float], end: typing.Optional[float]) -> Aggregates:
+        return reduce_groups(*self.partials(field, window, start, end), window, fns)
@@ -0,0 +1,388 @@
+import typing
+import json
+import logging
+
+from common.codec import PackedCodec
+from aggregation import FUNCTIONS, parse_window, reduce_groups
+from sensor_store import column_records
+from segment_store import segment_records
+from stream_hub import valid_filter
+from request_params import Args, int_param, float_param
+
+#Request parsing and response building of the main server API,
+#shared by main_server.py (Flask) and async_main_server.py (Quart).
+#The servers only read the request, do the calls to the room hosts
+#and turn the results into responses of their framework.
+#Readings are fetched from the state as arrays and turned into
+#records (or aggregated) here, so that with the shared backend
+#this work is done by the workers and not by the state server
+
+Reply = typing.Tuple[typing.Dict[str, typing.Any], int]
+
+#Readings read from the persistent store by a single request
+ARCHIVE_READ_LIMIT = 10000
+
+class ApiRequest:
+    """
+    What the handlers need of a request, the body
+    is only parsed when it is declared as JSON
+    """
+    def __init__(self, content_type: typing.Optional[str], payload: typing.Any, args: Args):
+        self.content_type = content_type
+        self.payload = payload
+        self.args = args
+
+    def is_json(self) -> bool:
+        return self.content_type == 'application/json'
+
+class RawReply:
+    """
+    A response whose body is not JSON
+    """
+    def __init__(self, body: typing.Any, mimetype: str, headers: typing.Optional[typing.Dict[str, str]] = None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or {}
+
+class DeviceAddition:
+    """
+    A validated request to add a device, to be
+    forwarded to 'url' on the room host
+    """
+    def __init__(self, host_id: str, kind: str, url: str, body: typing.Dict[str, typing.Any],
+                 module: str, instance_id: str, history: typing.Optional[int]):
+        self.host_id = host_id
+        self.kind = kind
+        self.url = url
+        self.body = body
+        self.module = module
+        self.instance_id = instance_id
+        self.history = history
+
+def sse_event(event: str, data: typing.Any) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+def stream_chunks(events: typing.List[typing.Tuple[str, typing.Any]], dropped: int, reported_drops: int) -> typing.Tuple[typing.List[str], int]:
+    """
+    Server-sent events for the events read by a stream client.
+    Returns the chunks to send and the drop count reported
+    """
+    chunks = []
+    if dropped != reported_drops:
+        reported_drops = dropped
+        chunks.append(sse_event('dropped', {'count': reported_drops}))
+    if len(events) == 0:
+        #Keeps the connection alive and detects closed clients
+        chunks.append(': heartbeat\n\n')
+    for event, data in events:
+        chunks.append(sse_event(event, data))
+    return chunks, reported_drops
+
+def fan_out_response(body: typing.Dict[str, typing.Any], errors: typing.Dict[str, str]) -> Reply:
+    body['status'] = 'E_OK' if len(errors) == 0 else 'E_PARTIAL'
+    body['errors'] = errors
+    return body, 200
+
+class ApiHandlers:
+    """
+    Handlers of the main server API working on a ServerState
+    (or a proxy of it). Each one returns the response body and
+    status code, or a RawReply
+    """
+    def __init__(self, state, logger: logging.Logger):
+        self.state = state
+        self.logger = logger
+
+    def _json_object(self, req: ApiRequest, route: str) -> typing.Optional[Reply]:
+        if not req.is_json():
+            self.logger.error(f'Invalid {route} content')
+            return {'status': 'E_CONTENT'}, 400
+        if type(req.payload) != type({}):
+            return {'status': 'E_LIST'}, 400
+        return None
+
+    def _device_payload(self, req: ApiRequest, host_id: str, kind: str, route: str) -> typing.Optional[Reply]:
+        """
+        Checks shared by the requests about a single device
+        of a host, identified by the '<kind>_id' field
+        """
+        if not req.is_json():
+            self.logger.error(f'Invalid {route} content')
+            return {'status': 'E_CONTENT'}, 400
+        if self.state.get_host(host_id) == None:
+            return {'status': 'E_HOST'}, 400
+        if type(req.payload) != type({}):
+            return {'status': 'E_LIST'}, 400
+        if req.payload.get(f'{kind}_id') == None:
+            return {'status': 'E_MISSING_ID'}, 400
+        return None
+
+    def _has_device(self, host_id: str, kind: str, device_id: str) -> bool:
+        if kind == 'sensor':
+            return self.state.has_sensor(host_id, device_id)
+        return self.state.has_actuator(host_id, device_id)
+
+    def add_devices(self, req: ApiRequest) -> Reply:
+        if not req.is_json():
+            self.logger.error(f'Invalid POST /devices content')
+            return {'status': 'E_CONTENT'}, 400
+        if type(req.payload) != type({}):
+            self.logger.error(f'Invalid POST /devices json type: {type(req.payload).__name__}')
+            return {'status': 'E_LIST'}, 400
+
+        self.state.add_hosts(req.payload)
+
+        self.logger.info('Updated devices')
+        return {'status': 'E_OK'}, 200
+
+    def get_devices(self) -> Reply:
+        return {'status': 'E_OK', 'devs': json.dumps(self.state.get_hosts())}, 200
+
+    def del_devices(self, req: ApiRequest) -> Reply:
+        if req.args.get('devs') == None:
+            self.logger.error(f'Invalid DELETE /devices param')
+            return {'status': 'E_CONTENT'}, 400
+
+        try:
+            devs = json.loads(req.args.get('devs'))
+            if type(devs) != type([]):
+                return {'status': 'E_PARAM'}, 200
+            self.state.remove_hosts(devs)
+        except:
+            return {'status': 'E_PARAM'}, 200
+        return {'status': 'E_OK'}, 200
+
+    def prepare_add_device(self, req: ApiRequest, host_id: str, kind: str) -> typing.Union[Reply, DeviceAddition]:
+        """
+        Validates a request to add a sensor or an actuator
+        ('kind'), returns the call to make to the room host
+        """
+        route = f'POST /dev/<id>/{kind}s'
+        if not req.is_json():
+            self.logger.error(f'Invalid {route} content')
+            return {'status': 'E_CONTENT'}, 400
+        payload = req.payload
+
+        if type(payload) != type({}):
+            self.logger.error(f'Invalid {route} json type: {type(payload).__name__}')
+            return {'status': 'E_PARAMS'}, 400
+
+        if payload.get('module') == None or payload.get('instance_id') == None:
+            self.logger.error(f'Missing {route} params')
+            return {'status': 'E_PARAMS'}, 400
+
+        history = payload.get('history') if kind == 'sensor' else None
+        if history != None and (type(history) != int or history <= 0):
+            self.logger.error(f'Invalid {route} history')
+            return {'status': 'E_PARAMS'}, 400
+
+        dev_ip = self.state.get_host(host_id)
+        if dev_ip == None:
+            self.logger.error(f'{route} invalid device')
+            return {'status': 'E_INV_DEV'}, 400
+
+        host_payload = {'module': payload['module'], 'instance_id': payload['instance_id']}
+        if payload.get('isolation') != None:
+            host_payload['isolation'] = payload['isolation']
+        return DeviceAddition(host_id, kind, f'http://{dev_ip}:5000/{kind}s', host_payload,
+                              payload['module'], payload['instance_id'], history)
+
+    def device_added(self, addition: DeviceAddition) -> Reply:
+        """
+        Records a device that the room host added
+        """
+        if addition.kind == 'sensor':
+            self.state.add_sensor(addition.host_id, addition.instance_id, addition.history)
+        else:
+            self.state.add_actuator(addition.host_id, addition.instance_id)
+
+        self.logger.info(f'Added new {addition.kind} of type {addition.module} to {addition.host_id}, with instance id {addition.instance_id}')
+        return {'status': 'OK'}, 200
+
+    def all_removed(self, kind: str, results: typing.Dict[str, typing.Any], errors: typing.Dict[str, str]) -> Reply:
+        """
+        Response of a delete_all request sent to every host,
+        forgets the devices of the hosts that removed them
+        """
+        for host_id in results.keys():
+            if kind == 'sensor':
+                self.state.remove_sensors(host_id)
+            else:
+                self.state.remove_actuators(host_id)
+        return fan_out_response({}, errors)
+
+    def all_listed(self, kind: str, results: typing.Dict[str, typing.Any], errors: typing.Dict[str, str]) -> Reply:
+        devices = {host_id: result[f'{kind}s'] for host_id, result in results.items()}
+        return fan_out_response({f'{kind}s': devices}, errors)
+
+    def device_command(self, req: ApiRequest, host_id: str, kind: str, command: str) -> Reply:
+        """
+        Sends START or STOP ('command') to a sensor or actuator
+        """
+        error = self._device_payload(req, host_id, kind, f'PUT /dev/<id>/{kind}_{command.lower()}')
+        if error != None:
+            return error
+        device_id = req.payload[f'{kind}_id']
+
+        if not self._has_device(host_id, kind, device_id):
+            return {'status': 'E_INV_ID'}, 400
+
+        mqtt_control_topic = f'{host_id}/{device_id}_control'
+        self.logger.info(mqtt_control_topic)
+        if not self.state.send_command(host_id, device_id, command):
+            self.logger.error(f'Publish to {mqtt_control_topic} failed')
+            return {'status': 'E_FAIL'}, 400
+        return {'status': 'E_OK'}, 200
+
+    def device_status(self, req: ApiRequest, host_id: str, kind: str) -> Reply:
+        error = self._device_payload(req, host_id, kind, f'GET /dev/<id>/{kind}_status')
+        if error != None:
+            return error
+        device_id = req.payload[f'{kind}_id']
+
+        if not self._has_device(host_id, kind, device_id):
+            return {'status': 'E_INV_ID'}, 400
+
+        status = self.state.get_status(f'{host_id}/{device_id}_status')
+        if status == None:
+            return {'status': 'E_NOT_AVAIL'}, 400
+
+        return {'status': 'E_OK', f'{kind}_status': status}, 200
+
+    def sensor_data(self, req: ApiRequest, host_id: str) -> typing.Union[Reply, RawReply]:
+        error = self._device_payload(req, host_id, 'sensor', 'GET /dev/<id>/sensor_data')
+        if error != None:
+            return error
+
+        try:
+            since = int_param(req.args, 'since', minimum=0)
+            limit = int_param(req.args, 'limit', minimum=1)
+        except ValueError:
+            return {'status': 'E_PARAMS'}, 400
+
+        if not self.state.has_sensor(host_id, req.payload['sensor_id']):
+            return {'status': 'E_INV_ID'}, 400
+
+        result = self.state.read_sensor_columns(host_id, req.payload['sensor_id'], since, limit)
+        if result == None:
+            return {'status': 'E_NOT_AVAIL'}, 400
+        columns, next_seq, missed, schema = result
+        records = column_records(columns)
+        if req.args.get('format') == PackedCodec.name:
+            codec = PackedCodec(schema)
+            headers = {'X-Codec': json.dumps(codec.describe()), 'X-Next': str(next_seq), 'X-Missed': str(missed)}
+            body = codec.pack([codec.encode(record) for record in records])
+            return RawReply(body, 'application/octet-stream', headers)
+        return {'status': 'E_OK', 'sensor_data': records, 'next': next_seq, 'missed': missed}, 200
+
+    def sensor_aggregate(self, req: ApiRequest, host_id: str) -> Reply:
+        error = self._device_payload(req, host_id, 'sensor', 'GET /dev/<id>/sensor_data/aggregate')
+        if error != None:
+            return error
+
+        field = req.args.get('field')
+        fns = req.args.get('fn', 'mean').split(',')
+        try:
+            window = parse_window(req.args.get('window', ''))
+            start = float_param(req.args, 'from')
+            end = float_param(req.args, 'to')
+        except ValueError:
+            return {'status': 'E_PARAMS'}, 400
+        if field == None or not all(fn in FUNCTIONS for fn in fns):
+            return {'status': 'E_PARAMS'}, 400
+
+        if not self.state.has_sensor(host_id, req.payload['sensor_id']):
+            return {'status': 'E_INV_ID'}, 400
+
+        result = self.state.aggregate_partials(host_id, req.payload['sensor_id'], field, window, start, end)
+        if result == None:
+            return {'status': 'E_NOT_AVAIL'}, 400
+        partials, source = result
+        aggregates = reduce_groups(*partials, window, fns)
+        return {'status': 'E_OK', 'field': field, 'window': window, 'source': source, 'aggregates': aggregates}, 200
+
+    def sensor_history(self, req: ApiRequest, host_id: str) -> Reply:
+        error = self._device_payload(req, host_id, 'sensor', 'GET /dev/<id>/sensor_data/history')
+        if error != None:
+            return error
+
+        try:
+            start = float_param(req.args, 'from')
+            end = float_param(req.args, 'to')
+            limit = int_param(req.args, 'limit', ARCHIVE_READ_LIMIT, minimum=1, maximum=ARCHIVE_READ_LIMIT)
+        except ValueError:
+            return {'status': 'E_PARAMS'}, 400
+
+        #Readings of removed sensors stay in the store until the retention expires
+        arrays = self.state.read_archive_arrays(host_id, req.payload['sensor_id'], start, end, limit)
+        if arrays == None:
+            return {'status': 'E_NOT_AVAIL'}, 400
+        records = [record for schema, array in arrays for record in segment_records(schema, array)]
+        return {'status': 'E_OK', 'sensor_data': records}, 200
+
+    def telemetry_batch(self, req: ApiRequest) -> Reply:
+        error = self._json_object(req, 'POST /telemetry/batch')
+        if error != None:
+            return error
+
+        sensor_entries = req.payload.get('sensors', [])
+        actuator_entries = req.payload.get('actuators', [])
+        if type(sensor_entries) != type([]) or type(actuator_entries) != type([]):
+            return {'status': 'E_LIST'}, 400
+
+        sensor_results, actuator_results = self.state.read_batch(sensor_entries, actuator_entries)
+        for result in sensor_results:
+            if 'columns' in result:
+                result['sensor_data'] = column_records(result.pop('columns'))
+        return {'status': 'E_OK', 'sensors': sensor_results, 'actuators': actuator_results}, 200
+
+    def stream_params(self, req: ApiRequest) -> typing.Tuple[typing.Optional[Reply], typing.List[str], int]:
+        """
+        Topic filters and queue size of a stream request,
+        with the error response when they are invalid
+        """
+        topics = req.args.get('topics', '#').split(',')
+        try:
+            max_queue = int_param(req.args, 'queue', 256, minimum=1)
+        except ValueError:
+            return ({'status': 'E_PARAMS'}, 400), topics, 0
+        if not all(valid_filter(topic) for topic in topics):
+            return ({'status': 'E_PARAMS'}, 400), topics, 0
+        return None, topics, max_queue
+
+    def add_controller(self, req: ApiRequest) -> Reply:
+        error = self._json_object(req, 'POST /controllers/add')
+        if error != None:
+            return error
+        if req.payload.get('module') == None:
+            return {'status': 'E_MODULE'}, 400
+        if req.payload.get('instance_id') == None:
+            return {'status': 'E_MISSING_ID'}, 400
+
+        status = self.state.add_controller(req.payload['module'], req.payload['instance_id'])
+        if status != 'E_OK':
+            return {'status': status}, 400
+        return {'status': 'E_OK'}, 200
+
+    def remove_controller(self, req: ApiRequest) -> Reply:
+        error = self._json_object(req, 'DELETE /controllers/remove')
+        if error != None:
+            return error
+        if req.payload.get('instance_id') == None:
+            return {'status': 'E_MISSING_ID'}, 400
+
+        if not self.state.remove_controller(req.payload['instance_id']):
+            return {'status': 'E_NOT_EXIST'}, 400
+        return {'status': 'E_OK'}, 200
+
+    def remove_all_controllers(self) -> Reply:
+        self.state.remove_all_controllers()
+        return {'status': 'E_OK'}, 200
+
+    def get_controllers(self) -> Reply:
+        return {'status': 'E_OK', 'controllers': self.state.get_controllers()}, 200
+
+    def metrics(self, extra_lines: typing.Optional[typing.List[str]] = None) -> RawReply:
+        #Prometheus text exposition format
+        lines = self.state.metric_lines() + (extra_lines or [])
+        return RawReply('\n'.join(lines) + '\n', 'text/plain; version=0.0.4')
@@ -0,0 +1,408 @@
+from quart import Quart
+from quart import request
+from quart import Response
+
+import paho.mqtt.client as mqtt
+import httpx
+
+import asyncio
+import typing
+import logging
+import sys
+import os
+import traceback
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mqtt_connection import MqttConnection
+from server_state import ServerState
+from aggregation import DEFAULT_ROLLUPS, parse_window, parse_rollups
+from host_client import HostError, HostStats
+from latency_metrics import render_gauges
+from segment_store import SegmentStore
+from api_handlers import ApiHandlers, ApiRequest, RawReply, DeviceAddition, stream_chunks
+
+#Asyncio version of main_server.py, serving the same API
+#on an ASGI server. Requests to the room hosts are awaited
+#instead of blocking a thread, MQTT messages received by
+#the paho network thread are put in a queue consumed by
+#the event loop, which is the only one updating the state
+
+app = Quart(__name__)
+
+app.logger.setLevel(logging.DEBUG)
+
+if os.environ.get('MQTT_ADDRESS') == None or os.environ.get('MQTT_PORT') == None:
+    app.logger.fatal(f'Env. variables for MQTT do not exist')
+    exit(1)
+
+connection = MqttConnection('MAIN_SERVER', os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+
+#A single event loop serves every client, so the state is always local to the process
+state = ServerState(int(os.environ.get('SENSOR_HISTORY', '1024')), app.logger,
+                    os.environ.get('MQTT_HOST_WILDCARDS') == '1',
+                    parse_rollups(os.environ.get('SENSOR_ROLLUPS', DEFAULT_ROLLUPS)))
+
+HOST_TIMEOUT = float(os.environ.get('HOST_TIMEOUT', '5'))
+HOST_RETRIES = int(os.environ.get('HOST_RETRIES', '2'))
+HOST_POOL_SIZE = int(os.environ.get('HOST_POOL_SIZE', '8'))
+
+#Messages waiting for the event loop, newer ones are dropped when it is full
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE', '10000'))
+#Messages ingested before yielding to the HTTP handlers
+INGEST_BATCH = 256
+
+event_loop: typing.Optional[asyncio.AbstractEventLoop] = None
+ingest_queue: typing.Optional[asyncio.Queue] = None
+ingest_task: typing.Optional[asyncio.Task] = None
+ingest_dropped = 0
+host_client: typing.Optional[httpx.AsyncClient] = None
+host_stats: typing.Dict[str, HostStats] = {}
+shutdown_event = asyncio.Event()
+
+def on_mqtt_message(client, userdata, message: mqtt.MQTTMessage):
+    #Runs on the paho network thread
+    event_loop.call_soon_threadsafe(enqueue_message, message.topic, message.payload, time.time())
+
+def enqueue_message(topic: str, payload: bytes, recv_time: float):
+    global ingest_dropped
+    try:
+        ingest_queue.put_nowait((topic, payload, recv_time))
+    except asyncio.QueueFull:
+        ingest_dropped += 1
+        if ingest_dropped % 1000 == 1:
+            app.logger.error(f'Ingest queue full, {ingest_dropped} messages dropped')
+
+def publish_command(topic: str, payload: str, qos: int) -> bool:
+    return connection.publish(topic, payload, qos=qos).rc == mqtt.MQTT_ERR_SUCCESS
+
+if os.environ.get('SENSOR_ARCHIVE_DIR') != None:
+    state.attach_archive(SegmentStore(os.environ['SENSOR_ARCHIVE_DIR'],
+                                      parse_window(os.environ.get('SENSOR_ARCHIVE_PARTITION', '1h')),
+                                      parse_window(os.environ.get('SENSOR_ARCHIVE_RETENTION', '7d'))))
+
+#The connection restores its subscriptions in bulk when it reconnects
+state.attach_mqtt(lambda topics: connection.subscribe_many(topics, on_mqtt_message), connection.unsubscribe_many, publish_command)
+
+async def ingest_messages():
+    while True:
+        messages = [await ingest_queue.get()]
+        while len(messages) < INGEST_BATCH and not ingest_queue.empty():
+            messages.append(ingest_queue.get_nowait())
+        for topic, payload, recv_time in messages:
+            try:
+                state.ingest(topic, payload, recv_time)
+            except:
+                app.logger.error(traceback.format_exc())
+        #get() does not suspend when messages are queued
+        await asyncio.sleep(0)
+
+async def host_call(method: str, url: str, **kwargs) -> httpx.Response:
+    stats = host_stats.setdefault(url.split('/')[2], HostStats())
+    stats.requests += 1
+    stats.in_flight += 1
+    start = time.monotonic()
+    try:
+        return await host_client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        stats.errors += 1
+        raise
+    finally:
+        stats.in_flight -= 1
+        stats.total_time += time.monotonic() - start
+
+async def fetch_host_devices(host_id: str):
+    host = state.get_host(host_id)
+    if host == None:
+        return None
+    try:
+        sensor_res, actuator_res = await asyncio.gather(host_call('GET', f'http://{host}:5000/sensors/get_all'),
+                                                        host_call('GET', f'http://{host}:5000/actuators/get_all'))
+    except httpx.HTTPError:
+        app.logger.error(f'Reconciliation of {host_id} failed')
+        return None
+    if sensor_res.status_code != 200 or actuator_res.status_code != 200:
+        return None
+    return sensor_res.json()['sensors'], actuator_res.json()['actuators']
+
+def fetch_host_devices_sync(host_id: str):
+    #Called by the registry reconciliation thread
+    future = asyncio.run_coroutine_threadsafe(fetch_host_devices(host_id), event_loop)
+    try:
+        return future.result(HOST_TIMEOUT * (HOST_RETRIES + 2))
+    except:
+        future.cancel()
+        return None
+
+async def host_request(method: str, url: str):
+    res = await host_call(method, url)
+    if res.status_code != 200:
+        try:
+            status = res.json().get('status', 'E_HOST_FAIL')
+        except ValueError:
+            status = 'E_HOST_FAIL'
+        raise HostError(status)
+    return res.json()
+
+async def fan_out(method: str, path: str) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, str]]:
+    """
+    Sends the same request to every room host concurrently.
+    Returns the parsed responses of the hosts that answered
+    and the error status of the others
+
+    :param str method: HTTP method
+    :param str path: Path on the room host server, e.g. '/sensors/get_all'
+    """
+    hosts = state.get_hosts()
+    responses = await asyncio.gather(*[host_request(method, f'http://{host}:5000{path}') for host in hosts.values()],
+                                     return_exceptions=True)
+    results: typing.Dict[str, typing.Any] = {}
+    errors: typing.Dict[str, str] = {}
+    for host_id, response in zip(hosts.keys(), responses):
+        if isinstance(response, HostError):
+            errors[host_id] = response.status
+        elif isinstance(response, httpx.TimeoutException):
+            errors[host_id] = 'E_TIMEOUT'
+        elif isinstance(response, httpx.HTTPError):
+            errors[host_id] = 'E_UNREACHABLE'
+        elif isinstance(response, BaseException):
+            raise response
+        else:
+            results[host_id] = response
+    if len(errors) > 0:
+        app.logger.error(f'{method} {path} failed on {errors}')
+    return results, errors
+
+@app.before_serving
+async def startup():
+    global event_loop, ingest_queue, ingest_task, host_client
+    event_loop = asyncio.get_running_loop()
+    ingest_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    ingest_task = asyncio.create_task(ingest_messages())
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=HOST_POOL_SIZE * 8)
+    host_client = httpx.AsyncClient(timeout=HOST_TIMEOUT,
+                                    transport=httpx.AsyncHTTPTransport(retries=HOST_RETRIES, limits=limits))
+    #connect() blocks until the broker answers
+    await asyncio.to_thread(connection.acquire)
+    connection.start()
+    app.logger.info(f'Connected to Mqtt broker')
+    state.start_reconciliation(fetch_host_devices_sync, float(os.environ.get('REGISTRY_RECONCILE_INTERVAL', '30')))
+
+@app.after_serving
+async def cleanup():
+    ingest_task.cancel()
+    connection.release()
+    await host_client.aclose()
+
+api = ApiHandlers(state, app.logger)
+
+async def read_request() -> ApiRequest:
+    content_type = request.headers.get('Content-Type')
+    payload = await request.get_json() if content_type == 'application/json' else None
+    return ApiRequest(content_type, payload, request.args)
+
+def reply(result):
+    if isinstance(result, RawReply):
+        return Response(result.body, mimetype=result.mimetype, headers=result.headers)
+    return result
+
+async def add_device(host_id: str, kind: str):
+    addition = api.prepare_add_device(await read_request(), host_id, kind)
+    if not isinstance(addition, DeviceAddition):
+        return addition
+    try:
+        res = await host_call('POST', addition.url, json=addition.body)
+    except httpx.HTTPError:
+        return {'status': 'E_UNREACHABLE'}, 400
+
+    if res.status_code != 200:
+        return res.json(), 400
+    return api.device_added(addition)
+
+@app.route("/heartbeat")
+async def heartbeat():
+    return {'status': 'E_OK'}, 200
+
+@app.post("/devices")
+async def add_devices():
+    return api.add_devices(await read_request())
+
+@app.get("/devices")
+async def get_devices():
+    return api.get_devices()
+
+@app.delete("/devices")
+async def del_devices():
+    return api.del_devices(await read_request())
+
+########################################################################################
+########################################################################################
+
+
+
+@app.post("/dev/<string:id>/sensors")
+async def add_sensor(id):
+    return await add_device(id, 'sensor')
+
+@app.delete("/dev/sensors/delete_all")
+async def remove_all_sensors():
+    return api.all_removed('sensor', *await fan_out('DELETE', '/sensors/delete_all'))
+
+@app.get("/dev/sensors/get_all")
+async def get_all_sensors():
+    return api.all_listed('sensor', *await fan_out('GET', '/sensors/get_all'))
+
+@app.put("/dev/<string:host_id>/sensor_stop")
+async def stop_sensor(host_id: str):
+    return api.device_command(await read_request(), host_id, 'sensor', 'STOP')
+
+@app.put("/dev/<string:host_id>/sensor_start")
+async def start_sensor(host_id: str):
+    return api.device_command(await read_request(), host_id, 'sensor', 'START')
+
+
+
+###########################################################################################
+###########################################################################################
+
+
+@app.post("/dev/<string:host_id>/actuators")
+async def add_actuator(host_id: str):
+    return await add_device(host_id, 'actuator')
+
+@app.get("/dev/actuators/get_all")
+async def get_all_actuators():
+    return api.all_listed('actuator', *await fan_out('GET', '/actuators/get_all'))
+
+@app.delete("/dev/actuators/delete_all")
+async def remove_all_actuators():
+    return api.all_removed('actuator', *await fan_out('DELETE', '/actuators/delete_all'))
+
+@app.put("/dev/<string:host_id>/actuator_stop")
+async def stop_actuator(host_id: str):
+    return api.device_command(await read_request(), host_id, 'actuator', 'STOP')
+
+@app.put("/dev/<string:host_id>/actuator_start")
+async def start_actuator(host_id: str):
+    return api.device_command(await read_request(), host_id, 'actuator', 'START')
+
+###########################################################################################
+###########################################################################################
+
+@app.get("/dev/<string:host_id>/sensor_status")
+async def get_sensor_status(host_id: str):
+    return api.device_status(await read_request(), host_id, 'sensor')
+
+@app.get("/dev/<string:host_id>/actuator_status")
+async def get_actuator_status(host_id: str):
+    return api.device_status(await read_request(), host_id, 'actuator')
+
+@app.get("/dev/<string:host_id>/sensor_data")
+async def get_sensor_data(host_id: str):
+    return reply(api.sensor_data(await read_request(), host_id))
+
+@app.get("/dev/<string:host_id>/sensor_data/aggregate")
+async def get_sensor_aggregate(host_id: str):
+    #Aggregating a long history is CPU bound, keep it off the event loop
+    return await asyncio.to_thread(api.sensor_aggregate, await read_request(), host_id)
+
+@app.get("/dev/<string:host_id>/sensor_data/history")
+async def get_sensor_history(host_id: str):
+    #Reads from the segment files, keep them off the event loop
+    return await asyncio.to_thread(api.sensor_history, await read_request(), host_id)
+
+@app.post("/telemetry/batch")
+async def get_telemetry_batch():
+    return api.telemetry_batch(await read_request())
+
+@app.get("/stream")
+async def stream_events():
+    error, topics, max_queue = api.stream_params(await read_request())
+    if error != None:
+        return error
+
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    client = state.stream_hub.subscribe(topics, max_queue, lambda: loop.call_soon_threadsafe(wakeup.set))
+
+    async def generate():
+        try:
+            reported_drops = 0
+            yield ': connected\n\n'
+            while True:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), 15.0)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                chunks, reported_drops = stream_chunks(client.get(0.0), client.dropped, reported_drops)
+                yield ''.join(chunks)
+        finally:
+            state.stream_hub.unsubscribe(client)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.timeout = None
+    return response
+
+###########################################################################################
+###########################################################################################
+
+@app.post("/controllers/add")
+async def add_controller():
+    return api.add_controller(await read_request())
+
+@app.delete("/controllers/remove")
+async def remove_controller():
+    return api.remove_controller(await read_request())
+
+@app.delete("/controllers/remove_all")
+async def remove_all_controllers():
+    return api.remove_all_controllers()
+
+@app.get("/controllers/get_all")
+async def get_all_controllers():
+    return api.get_controllers()
+
+
+###########################################################################################
+###########################################################################################
+
+@app.get("/stats/host_pool")
+async def get_host_pool_stats():
+    hosts = {host: {'requests': stats.requests, 'errors': stats.errors,
+                    'in_flight': stats.in_flight, 'total_time': stats.total_time}
+             for host, stats in host_stats.items()}
+    return {'status': 'E_OK', 'worker': os.getpid(), 'hosts': hosts}, 200
+
+@app.get("/stats/ingest")
+async def get_ingest_stats():
+    stats = state.ingest_stats()
+    stats['pipeline'] = {'workers': 1, 'depth': ingest_queue.qsize(), 'capacity': INGEST_QUEUE_SIZE, 'dropped': ingest_dropped}
+    return {'status': 'E_OK', 'ingest': stats}, 200
+
+@app.get("/metrics")
+async def get_metrics():
+    return reply(api.metrics(render_gauges('mininet_ingest', {
+        'queue_depth': ('gauge', 'Messages waiting for the event loop', ingest_queue.qsize()),
+        'dropped_total': ('counter', 'Messages dropped because the ingest queue was full', ingest_dropped)})))
+
+@app.post("/shutdown")
+async def shutdown():
+    shutdown_event.set()
+    return {'status': 'OK'}, 200
+
+@app.errorhandler(Exception)
+async def handle_exception(exc):
+    backtrace = traceback.format_exc()
+    app.logger.error(backtrace)
+    return {'status': 'E_INTERNAL_ERROR'}, 500
+
+if __name__ == '__main__':
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+
+    config = Config()
+    config.bind = [f'0.0.0.0:{os.environ.get("SERVER_PORT", "5000")}']
+    asyncio.run(serve(app, config, shutdown_trigger=shutdown_event.wait))
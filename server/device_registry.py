@@ -0,0 +1,197 @@
+import threading
+import typing
+import time
+
+STATUS_SUFFIX = '_status'
+DIRTY_BACKOFF = 5.0
+
+HostListing = typing.Tuple[typing.List[str], typing.List[str]]
+
+class RegistryChange:
+    """
+    Devices added to and removed from a host by a reconciliation
+    """
+    def __init__(self, added_sensors: typing.Set[str], removed_sensors: typing.Set[str],
+                 added_actuators: typing.Set[str], removed_actuators: typing.Set[str]):
+        self.added_sensors = added_sensors
+        self.removed_sensors = removed_sensors
+        self.added_actuators = added_actuators
+        self.removed_actuators = removed_actuators
+
+    def empty(self) -> bool:
+        return len(self.added_sensors) == 0 and len(self.removed_sensors) == 0 and \
+            len(self.added_actuators) == 0 and len(self.removed_actuators) == 0
+
+ChangeCallback = typing.Callable[[str, RegistryChange], typing.Any]
+
+class DeviceRegistry:
+    """
+    In-process view of the sensors and actuators
+    attached to every room host. It is updated by the
+    main server whenever it adds/removes devices and
+    periodically reconciled with the room hosts, so that
+    request handlers never need to ask a host whether
+    a device exists
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sensors: typing.Dict[str, typing.Set[str]] = {}
+        self.actuators: typing.Dict[str, typing.Set[str]] = {}
+        self.generations: typing.Dict[str, int] = {}
+        self.dirty_hosts: typing.Set[str] = set()
+        self.last_reconciled: typing.Dict[str, float] = {}
+        self.wakeup = threading.Event()
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def _touch(self, host_id: str):
+        self.generations[host_id] = self.generations.get(host_id, 0) + 1
+
+    def add_sensor(self, host_id: str, sensor_id: str):
+        with self.lock:
+            self.sensors.setdefault(host_id, set()).add(sensor_id)
+            self._touch(host_id)
+
+    def add_actuator(self, host_id: str, actuator_id: str):
+        with self.lock:
+            self.actuators.setdefault(host_id, set()).add(actuator_id)
+            self._touch(host_id)
+
+    def remove_sensor(self, host_id: str, sensor_id: str):
+        with self.lock:
+            self.sensors.get(host_id, set()).discard(sensor_id)
+            self._touch(host_id)
+
+    def remove_actuator(self, host_id: str, actuator_id: str):
+        with self.lock:
+            self.actuators.get(host_id, set()).discard(actuator_id)
+            self._touch(host_id)
+
+    def clear_sensors(self, host_id: str):
+        with self.lock:
+            self.sensors.pop(host_id, None)
+            self._touch(host_id)
+
+    def clear_actuators(self, host_id: str):
+        with self.lock:
+            self.actuators.pop(host_id, None)
+            self._touch(host_id)
+
+    def remove_host(self, host_id: str):
+        self.clear_sensors(host_id)
+        self.clear_actuators(host_id)
+        with self.lock:
+            self.dirty_hosts.discard(host_id)
+
+    def has_sensor(self, host_id: str, sensor_id: str) -> bool:
+        return sensor_id in self.sensors.get(host_id, ())
+
+    def has_actuator(self, host_id: str, actuator_id: str) -> bool:
+        return actuator_id in self.actuators.get(host_id, ())
+
+    def get_sensors(self, host_id: str) -> typing.List[str]:
+        with self.lock:
+            return sorted(self.sensors.get(host_id, set()))
+
+    def get_actuators(self, host_id: str) -> typing.List[str]:
+        with self.lock:
+            return sorted(self.actuators.get(host_id, set()))
+
+    def generation(self, host_id: str) -> int:
+        with self.lock:
+            return self.generations.get(host_id, 0)
+
+    def replace(self, host_id: str, listing: HostListing, generation: int) -> typing.Optional[RegistryChange]:
+        """
+        Replaces the devices known for a host with the
+        ones reported by the host itself. The update is
+        discarded if the registry was modified for that
+        host after 'generation' was read, since the listing
+        could be older than the local change
+
+        :param str host_id: Host that was queried
+        :param listing: Sensors and actuators reported by the host
+        :param int generation: Value of generation(host_id) before the query
+        :return: The devices added and removed, None if the update was discarded
+        """
+        sensors, actuators = set(listing[0]), set(listing[1])
+        with self.lock:
+            if self.generations.get(host_id, 0) != generation:
+                return None
+            old_sensors = self.sensors.get(host_id, set())
+            old_actuators = self.actuators.get(host_id, set())
+            change = RegistryChange(sensors - old_sensors, old_sensors - sensors,
+                                    actuators - old_actuators, old_actuators - actuators)
+            self.sensors[host_id] = sensors
+            self.actuators[host_id] = actuators
+            self.dirty_hosts.discard(host_id)
+            self._touch(host_id)
+            return change
+
+    def seen_status(self, topic: str):
+        """
+        Records a status message. Status messages from
+        devices the registry does not know about mark the
+        host for an early reconciliation, unless the host
+        was reconciled in the last DIRTY_BACKOFF seconds.
+        The server only receives such messages when it
+        subscribes to the host wildcards, otherwise unknown
+        devices are found by the periodic reconciliation
+        """
+        host_id, _, name = topic.partition('/')
+        if not name.endswith(STATUS_SUFFIX):
+            return
+        device_id = name[:-len(STATUS_SUFFIX)]
+        if self.has_sensor(host_id, device_id) or self.has_actuator(host_id, device_id):
+            return
+        if time.monotonic() - self.last_reconciled.get(host_id, 0.0) < DIRTY_BACKOFF:
+            return
+        with self.lock:
+            self.dirty_hosts.add(host_id)
+        self.wakeup.set()
+
+    def reconcile(self, hosts: typing.Iterable[str], fetch: typing.Callable[[str], typing.Optional[HostListing]],
+                  on_change: typing.Optional[ChangeCallback] = None):
+        for host_id in hosts:
+            generation = self.generation(host_id)
+            self.last_reconciled[host_id] = time.monotonic()
+            listing = fetch(host_id)
+            if listing == None:
+                continue
+            change = self.replace(host_id, listing, generation)
+            if change != None and not change.empty() and on_change != None:
+                on_change(host_id, change)
+
+    def start_reconciliation(self,
+                             get_hosts: typing.Callable[[], typing.Iterable[str]],
+                             fetch: typing.Callable[[str], typing.Optional[HostListing]],
+                             interval: float,
+                             on_change: typing.Optional[ChangeCallback] = None):
+        """
+        Starts a daemon thread that reconciles every host
+        each 'interval' seconds, and the hosts marked by
+        seen_status as soon as possible
+
+        :param get_hosts: Returns the ids of the current hosts
+        :param fetch: Queries a host for its (sensors, actuators), None on failure
+        :param float interval: Seconds between full reconciliations
+        :param on_change: Called with the devices added and removed from a host
+        """
+        if self.thread != None:
+            return
+
+        def run():
+            next_full = time.monotonic() + interval
+            while True:
+                self.wakeup.wait(max(0.0, next_full - time.monotonic()))
+                self.wakeup.clear()
+                hosts = list(get_hosts())
+                if time.monotonic() >= next_full:
+                    self.reconcile(hosts, fetch, on_change)
+                    next_full = time.monotonic() + interval
+                else:
+                    with self.lock:
+                        dirty = [host_id for host_id in hosts if host_id in self.dirty_hosts]
+                    self.reconcile(dirty, fetch, on_change)
+
+        self.thread = threading.Thread(target=run, name='registry_reconcile', daemon=True)
+        self.thread.start()
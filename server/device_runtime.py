@@ -0,0 +1,113 @@
+import ast
+import importlib.util
+import threading
+import typing
+import types
+import os
+import sys
+
+from common.scheduler import PeriodicTask, get_scheduler
+from common.mqtt_connection import get_connection
+
+DEVICE_DIRS = {'sensors': './sensors', 'actuators': './actuators'}
+
+for device_dir in DEVICE_DIRS.values():
+    if device_dir not in sys.path:
+        sys.path.append(device_dir)
+
+from sensor_class import Sensor
+from actuator_class import Actuator
+
+class DeviceHandle:
+    """
+    In-process counterpart of the Popen object used
+    for devices running in their own interpreter
+    """
+    def __init__(self, runtime: 'DeviceRuntime', instance_id: str, device: typing.Any, base: typing.Any):
+        self.runtime = runtime
+        self.instance_id = instance_id
+        self.device = device
+        self.base = base
+        self.task: typing.Optional[PeriodicTask] = None
+        self.terminated = False
+        #Held while a step runs, terminate() waits for it before disconnecting
+        self.lock = threading.Lock()
+
+    def poll(self) -> typing.Optional[int]:
+        #Like Popen.poll, None while the device is running
+        return 0 if self.terminated else None
+
+    def tick(self):
+        with self.lock:
+            if self.terminated:
+                return
+            self.device.step()
+            running = getattr(self.device, 'running', True)
+        if not running:
+            self.terminate()
+
+    def terminate(self):
+        #No new steps are started, then the one in progress (if any) ends first
+        if self.task != None:
+            self.task.cancel()
+        with self.lock:
+            if self.terminated:
+                return
+            self.terminated = True
+            self.base.disconnect()
+            if hasattr(self.device, 'close'):
+                self.device.close()
+            self.base.log_file.close()
+
+class DeviceRuntime:
+    """
+    Runs sensors and actuators as plugins inside the
+    room host server: every device module is imported
+    once, each instance is driven by a shared scheduler
+    and all of them use the same MQTT connection.
+
+    A device module can be loaded as a plugin if it defines
+    a top-level 'create(base)' function, returning an object
+    with a 'step()' method and a 'period' attribute
+    """
+    def __init__(self, server_id: str, address: str, port: int, workers: int = 4):
+        self.connection = get_connection(f'{server_id}_runtime', address, port)
+        self.connection.acquire()
+        self.connection.start()
+        self.scheduler = get_scheduler(workers=workers)
+        self.modules: typing.Dict[str, types.ModuleType] = {}
+        self.lock = threading.Lock()
+
+    def supports(self, kind: str, module: str) -> bool:
+        path = os.path.join(DEVICE_DIRS[kind], f'{module}.py')
+        with open(path) as source:
+            tree = ast.parse(source.read(), path)
+        return any(isinstance(node, ast.FunctionDef) and node.name == 'create' for node in tree.body)
+
+    def load_module(self, kind: str, module: str) -> types.ModuleType:
+        key = f'{kind}.{module}'
+        with self.lock:
+            loaded = self.modules.get(key)
+            if loaded != None:
+                return loaded
+            path = os.path.join(DEVICE_DIRS[kind], f'{module}.py')
+            spec = importlib.util.spec_from_file_location(f'{kind}_{module}', path)
+            loaded = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(loaded)
+            self.modules[key] = loaded
+            return loaded
+
+    def add(self, kind: str, module: str, instance_id: str) -> DeviceHandle:
+        plugin = self.load_module(kind, module)
+        if kind == 'sensors':
+            base = Sensor(module_name=instance_id, connection=self.connection)
+        else:
+            base = Actuator(module_name=instance_id, connection=self.connection)
+
+        device = plugin.create(base)
+        base.connect()
+        handle = DeviceHandle(self, instance_id, device, base)
+        #Through the device, so that stop() cancels the task (and the
+        #period of sensors can be changed remotely)
+        handle.task = base.schedule(handle.tick, device.period)
+        return handle
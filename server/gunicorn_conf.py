@@ -0,0 +1,31 @@
+import subprocess
+import secrets
+import typing
+import sys
+import os
+
+#Gunicorn configuration of the main server with the shared
+#state backend ('gunicorn -c ./server/gunicorn_conf.py ...').
+#The master starts the state server before forking the workers,
+#so the state survives the recycling of any worker
+
+STATE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state_server.py')
+
+state_server: typing.Optional[subprocess.Popen] = None
+
+def on_starting(server):
+    global state_server
+    os.environ['STATE_BACKEND'] = 'shared'
+    #Random key for this run, the workers inherit it with the environment of the master
+    if os.environ.get('STATE_AUTHKEY', '') == '':
+        os.environ['STATE_AUTHKEY'] = secrets.token_hex(32)
+    state_server = subprocess.Popen([sys.executable, STATE_SERVER])
+
+def on_exit(server):
+    if state_server == None:
+        return
+    state_server.terminate()
+    try:
+        state_server.wait(10)
+    except subprocess.TimeoutExpired:
+        state_server.kill()
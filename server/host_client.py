@@ -0,0 +1,105 @@
+import threading
+import typing
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class HostError(Exception):
+    """
+    A room host answered with an error status
+    """
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total_time = 0.0
+
+class HostClient:
+    """
+    HTTP client used by the main server to talk with
+    the room hosts. Connections are kept alive in a pool
+    for each host, every request has a timeout and failed
+    connections are retried with backoff. Read timeouts are
+    never retried and the connection attempts share the
+    timeout, so a request takes at most about twice 'timeout'
+    whatever the number of retries
+    """
+    def __init__(self, timeout: float, retries: int, pool_size: int, max_hosts: int = 64):
+        #(connect, read) timeouts of each request
+        self.timeout = (timeout / (retries + 1), timeout)
+        #read=False raises read errors as they are (requests.Timeout), without retrying
+        retry = Retry(total=retries, connect=retries, read=False, status=0, backoff_factor=0.1)
+        self.adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.stats: typing.Dict[str, HostStats] = {}
+        self.lock = threading.Lock()
+
+    def _host_stats(self, url: str) -> HostStats:
+        host = url.split('/')[2]
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats == None:
+                stats = HostStats()
+                self.stats[host] = stats
+            return stats
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        stats = self._host_stats(url)
+        with self.lock:
+            stats.requests += 1
+            stats.in_flight += 1
+        start = time.monotonic()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                stats.errors += 1
+            raise
+        finally:
+            with self.lock:
+                stats.in_flight -= 1
+                stats.total_time += time.monotonic() - start
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def metrics(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Per host request counters together with the state of
+        its connection pool: connections opened so far, requests
+        sent on them and idle connections ready to be reused
+        """
+        result: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        with self.lock:
+            for host, stats in self.stats.items():
+                result[host] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'in_flight': stats.in_flight,
+                    'total_time': stats.total_time
+                }
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool == None:
+                continue
+            host = f'{pool.host}:{pool.port}'
+            entry = result.setdefault(host, {})
+            entry['connections_opened'] = pool.num_connections
+            entry['pool_requests'] = pool.num_requests
+            entry['idle_connections'] = sum(1 for conn in list(pool.pool.queue) if conn != None) if pool.pool != None else 0
+        return result
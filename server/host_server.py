@@ -2,14 +2,20 @@ from flask.app import Flask
 from flask.app import request
 
 import os
+import sys
 import logging
 import typing
+import threading
 from subprocess import Popen
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from device_runtime import DeviceRuntime, DeviceHandle
+
 app = Flask(__name__)
 
-sensors: typing.Dict[str, Popen] = {}
-actuators: typing.Dict[str, Popen] = {}
+sensors: typing.Dict[str, typing.Union[Popen, DeviceHandle]] = {}
+actuators: typing.Dict[str, typing.Union[Popen, DeviceHandle]] = {}
 
 app.logger.setLevel(logging.DEBUG)
 
@@ -21,6 +27,42 @@ if os.environ.get('SERVER_ID') == None:
     app.logger.fatal(f'Env. variables SERVER_ID does not exist')
     exit(1)
 
+#Devices run as plugins inside this server by default,
+#'process' starts every device in its own interpreter
+DEVICE_ISOLATION = os.environ.get('DEVICE_ISOLATION', 'inprocess')
+
+if DEVICE_ISOLATION not in ('inprocess', 'process'):
+    app.logger.fatal(f'Invalid DEVICE_ISOLATION {DEVICE_ISOLATION}')
+    exit(1)
+
+runtime: typing.Optional[DeviceRuntime] = None
+runtime_lock = threading.Lock()
+
+def get_runtime() -> DeviceRuntime:
+    global runtime
+    with runtime_lock:
+        if runtime == None:
+            runtime = DeviceRuntime(os.environ['SERVER_ID'], os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']),
+                                    workers=int(os.environ.get('DEVICE_WORKERS', '4')))
+        return runtime
+
+def start_device(kind: str, py_module: str, instance_id: str, isolation: str) -> typing.Union[Popen, DeviceHandle]:
+    if isolation == 'inprocess' and get_runtime().supports(kind, py_module):
+        return get_runtime().add(kind, py_module, instance_id)
+    
+    new_env = {}
+    new_env.update(os.environ)
+    new_env['MODULE_NAME'] = instance_id
+    return Popen(f'python3 ./{kind}/{py_module}.py', shell=True, env=new_env)
+
+def prune(devices: typing.Dict[str, typing.Union[Popen, DeviceHandle]]):
+    """
+    Forgets the devices that terminated by themselves
+    (e.g. after a DISCONNECT command)
+    """
+    for instance_id in [instance_id for instance_id, device in devices.items() if device.poll() != None]:
+        devices.pop(instance_id, None)
+
 @app.route("/heartbeat")
 def heartbeat():
     return {'status': 'E_OK'}, 200
@@ -29,6 +71,7 @@ def heartbeat():
 
 @app.post("/sensors")
 def add_sensor():
+    prune(sensors)
     if request.headers.get('Content-Type') != 'application/json':
         app.logger.error(f'Invalid POST /sensors content')
         return {'status': 'E_CONTENT'}, 400
@@ -52,16 +95,17 @@ def add_sensor():
     if not os.path.exists(f'./sensors/{py_module}.py'):
         return {'status': 'E_MODULE'}, 400
     
-    new_env = {}
-    new_env.update(os.environ)
-    new_env['MODULE_NAME'] = instance_id
-    proc = Popen(f'python3 ./sensors/{py_module}.py', shell=True, env=new_env)
-    sensors[instance_id] = proc
+    isolation = payload.get('isolation', DEVICE_ISOLATION)
+    if isolation not in ('inprocess', 'process'):
+        return {'status': 'E_PARAMS'}, 400
+    
+    sensors[instance_id] = start_device('sensors', py_module, instance_id, isolation)
     
     return {'status': 'E_OK'}, 200
 
 @app.delete("/sensors/<string:id>")
 def remove_sensor(id):
+    prune(sensors)
     if sensors.get(id) == None:
         app.logger.error(f'Sensor {id} does not exist')
         return {'status': 'E_NOT_EXIST'}, 400
@@ -80,11 +124,13 @@ def remove_all_sensors():
 
 @app.get("/sensors/get_all")
 def get_sensors():
+    prune(sensors)
     sensor_names = [name for name in sensors.keys()]
     return {'status': 'E_OK', 'sensors': sensor_names}, 200
 
 @app.get("/sensors/<string:sensor_id>/exists")
 def find_sensor(sensor_id: str):
+    prune(sensors)
     if sensors.get(sensor_id) != None:
         return {'status': 'E_FOUND'}, 200
     return {'status': 'E_NOT_FOUND'}, 200
@@ -93,6 +139,7 @@ def find_sensor(sensor_id: str):
 
 @app.post("/actuators")
 def add_actuator():
+    prune(actuators)
     if request.headers.get('Content-Type') != 'application/json':
         app.logger.error(f'Invalid POST /actuators content')
         return {'status': 'E_CONTENT'}, 400
@@ -116,16 +163,17 @@ def add_actuator():
     if not os.path.exists(f'./actuators/{py_module}.py'):
         return {'status': 'E_MODULE'}, 400
     
-    new_env = {}
-    new_env.update(os.environ)
-    new_env['MODULE_NAME'] = instance_id
-    proc = Popen(f'python3 ./actuators/{py_module}.py', shell=True, env=new_env)
-    actuators[instance_id] = proc
+    isolation = payload.get('isolation', DEVICE_ISOLATION)
+    if isolation not in ('inprocess', 'process'):
+        return {'status': 'E_PARAMS'}, 400
+    
+    actuators[instance_id] = start_device('actuators', py_module, instance_id, isolation)
     
     return {'status': 'E_OK'}, 200
 
 @app.delete("/actuators/<string:id>")
 def remove_actuator(id):
+    prune(actuators)
     if actuators.get(id) == None:
         app.logger.error(f'Actuator {id} does not exist')
         return {'status': 'E_NOT_EXIST'}, 400
@@ -144,11 +192,13 @@ def remove_all_actuators():
 
 @app.get("/actuators/get_all")
 def get_actuators():
+    prune(actuators)
     actuator_names = [name for name in actuators.keys()]
     return {'status': 'E_OK', 'actuators': actuator_names}, 200
 
 @app.get("/actuators/<string:actuator_id>/exists")
 def find_actuator(actuator_id: str):
+    prune(actuators)
     if actuators.get(actuator_id) != None:
         return {'status': 'E_FOUND'}, 200
     return {'status': 'E_NOT_FOUND'}, 200
\ No newline at end of file
@@ -0,0 +1,88 @@
+import threading
+import typing
+import queue
+import time
+import logging
+import traceback
+
+#Suffixes of the topics of a device besides its data topic
+DEVICE_SUFFIXES = ('_status', '_codec', '_control')
+
+MessageHandler = typing.Callable[[str, bytes, float], typing.Any]
+
+def device_key(topic: str) -> str:
+    for suffix in DEVICE_SUFFIXES:
+        if topic.endswith(suffix):
+            return topic[:-len(suffix)]
+    return topic
+
+class IngestShard:
+    def __init__(self, max_queue: int):
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.thread: typing.Optional[threading.Thread] = None
+
+class IngestPipeline:
+    """
+    Decouples the MQTT network thread from the processing
+    of the messages. submit() only stores the raw payload
+    and its receive time in a bounded queue, never blocking:
+    when the queue is full the message is dropped and counted.
+    A pool of worker threads decodes and stores the messages.
+
+    Each device is always handled by the same worker, so the
+    messages of a device (codec, data, status) keep their order
+    """
+    def __init__(self, handler: MessageHandler, workers: int, max_queue: int, logger: logging.Logger):
+        if workers <= 0 or max_queue <= 0:
+            raise ValueError('Ingest workers and queue size must be positive')
+        self.handler = handler
+        self.logger = logger
+        #Each shard gets an equal part of the queue size
+        self.shards = [IngestShard(max(max_queue // workers, 1)) for _ in range(workers)]
+        for index, shard in enumerate(self.shards):
+            shard.thread = threading.Thread(target=self._run, args=(shard,), name=f'ingest_{index}', daemon=True)
+            shard.thread.start()
+
+    def submit(self, topic: str, payload: bytes):
+        """
+        Queues a message, called by the MQTT network thread
+        """
+        shard = self.shards[hash(device_key(topic)) % len(self.shards)]
+        try:
+            shard.queue.put_nowait((topic, payload, time.time()))
+        except queue.Full:
+            shard.dropped += 1
+            if shard.dropped % 1000 == 1:
+                self.logger.error(f'Ingest queue full, {shard.dropped} messages dropped')
+
+    def _run(self, shard: IngestShard):
+        while True:
+            message = shard.queue.get()
+            if message == None:
+                return
+            topic, payload, recv_time = message
+            try:
+                self.handler(topic, payload, recv_time)
+            except:
+                shard.errors += 1
+                self.logger.error(traceback.format_exc())
+            shard.processed += 1
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        shards = [{'depth': shard.queue.qsize(), 'capacity': shard.queue.maxsize, 'dropped': shard.dropped,
+                   'processed': shard.processed, 'errors': shard.errors} for shard in self.shards]
+        return {'workers': len(shards), 'depth': sum(shard['depth'] for shard in shards),
+                'dropped': sum(shard['dropped'] for shard in shards),
+                'processed': sum(shard['processed'] for shard in shards), 'shards': shards}
+
+    def close(self):
+        """
+        Stops the workers after the queued messages are processed
+        """
+        for shard in self.shards:
+            shard.queue.put(None)
+        for shard in self.shards:
+            shard.thread.join()
@@ -0,0 +1,93 @@
+import threading
+import typing
+
+KIND_DATA = 'data'
+KIND_STATUS = 'status'
+KIND_CODEC = 'codec'
+KIND_CONTROL = 'control'
+
+RouteHandler = typing.Callable[[str, bytes, float], typing.Any]
+
+class Route:
+    def __init__(self, kind: str, handler: RouteHandler):
+        self.kind = kind
+        self.handler = handler
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+
+class IngestRouter:
+    """
+    Dispatches the received MQTT messages to the handler
+    registered for their exact topic, looked up in a dict.
+    Messages without a route (e.g. received through the host
+    wildcards) go to the default handler.
+
+    Counters of a route are only updated by the worker
+    ingesting its device, so they are not protected by the
+    lock; unrouted messages of different devices are counted
+    by many workers and take the lock
+    """
+    def __init__(self, default: typing.Optional[RouteHandler] = None):
+        self.lock = threading.Lock()
+        self.routes: typing.Dict[str, Route] = {}
+        self.default = default
+        self.unrouted = 0
+        #Counters of the routes that were removed, by kind
+        self.retired: typing.Dict[str, typing.Dict[str, int]] = {}
+
+    def register(self, topic: str, kind: str, handler: RouteHandler):
+        """
+        Adds a route, replacing the one with the same topic
+
+        :param str topic: Topic, without wildcards
+        :param str kind: One of the KIND_* constants
+        :param handler: Called with (topic, payload, receive time)
+        """
+        if '+' in topic or '#' in topic:
+            raise ValueError(f'Routes need an exact topic, not {topic}')
+        route = Route(kind, handler)
+        with self.lock:
+            self.routes[topic] = route
+
+    def unregister(self, topic: str):
+        with self.lock:
+            route = self.routes.pop(topic, None)
+            if route != None:
+                totals = self.retired.setdefault(route.kind, {'messages': 0, 'bytes': 0, 'errors': 0})
+                totals['messages'] += route.messages
+                totals['bytes'] += route.bytes
+                totals['errors'] += route.errors
+
+    def dispatch(self, topic: str, payload: bytes, recv_time: float):
+        route = self.routes.get(topic)
+        if route == None:
+            with self.lock:
+                self.unrouted += 1
+            if self.default != None:
+                self.default(topic, payload, recv_time)
+            return
+        route.messages += 1
+        route.bytes += len(payload)
+        try:
+            route.handler(topic, payload, recv_time)
+        except:
+            route.errors += 1
+            raise
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Message counters of every route and totals for each kind
+        """
+        with self.lock:
+            routes = list(self.routes.items())
+            kinds = {kind: dict(totals) for kind, totals in self.retired.items()}
+            unrouted = self.unrouted
+        per_route: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for topic, route in routes:
+            per_route[topic] = {'kind': route.kind, 'messages': route.messages, 'bytes': route.bytes, 'errors': route.errors}
+            totals = kinds.setdefault(route.kind, {'messages': 0, 'bytes': 0, 'errors': 0})
+            totals['messages'] += route.messages
+            totals['bytes'] += route.bytes
+            totals['errors'] += route.errors
+        return {'routes': per_route, 'kinds': kinds, 'unrouted': unrouted}
@@ -0,0 +1,98 @@
+import threading
+import typing
+
+import numpy as np
+
+#Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PUBLISH_INGEST = 'mininet_publish_to_ingest_seconds'
+INGEST_READ = 'mininet_ingest_to_read_seconds'
+INGEST_QUEUE_WAIT = 'mininet_ingest_queue_wait_seconds'
+
+DESCRIPTIONS = {
+    PUBLISH_INGEST: 'Time from the publish of a reading by the sensor to its ingestion by the server',
+    INGEST_READ: 'Time from the ingestion of a reading to its first read by a client',
+    INGEST_QUEUE_WAIT: 'Time a received message waited for an ingest worker',
+}
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.bounds = np.array(buckets, dtype=np.float64)
+        #One more bucket for the values over the last bound
+        self.counts = np.zeros(len(buckets) + 1, dtype=np.int64)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, values: np.ndarray):
+        #Clock differences between hosts could give negative latencies
+        values = np.maximum(values, 0.0)
+        self.counts += np.bincount(np.searchsorted(self.bounds, values), minlength=len(self.counts))
+        self.sum += float(values.sum())
+        self.count += len(values)
+
+class LatencyMetrics:
+    """
+    Latency histograms, one for each metric and topic
+    (an empty topic for the metrics of the whole server),
+    rendered in the Prometheus text format
+    """
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms: typing.Dict[typing.Tuple[str, str], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, metric: str, topic: str, seconds: typing.Union[float, typing.Sequence[float], np.ndarray]):
+        values = np.atleast_1d(np.asarray(seconds, dtype=np.float64))
+        if len(values) == 0:
+            return
+        with self.lock:
+            histogram = self.histograms.get((metric, topic))
+            if histogram == None:
+                histogram = Histogram(self.buckets)
+                self.histograms[(metric, topic)] = histogram
+            histogram.observe(values)
+
+    def remove_topic(self, topic: str):
+        with self.lock:
+            for key in [key for key in self.histograms if key[1] == topic]:
+                del self.histograms[key]
+
+    def render(self) -> typing.List[str]:
+        """
+        Lines of the histograms in the Prometheus text format
+        """
+        with self.lock:
+            snapshot = [(metric, topic, histogram.counts.cumsum().tolist(), histogram.sum, histogram.count)
+                        for (metric, topic), histogram in sorted(self.histograms.items())]
+        lines: typing.List[str] = []
+        for metric in sorted(set(metric for metric, _, _, _, _ in snapshot)):
+            lines.append(f'# HELP {metric} {DESCRIPTIONS.get(metric, metric)}')
+            lines.append(f'# TYPE {metric} histogram')
+            for name, topic, cumulative, total, count in snapshot:
+                if name != metric:
+                    continue
+                labels = f'topic="{escape_label(topic)}",' if topic != '' else ''
+                for bound, value in zip(list(self.buckets) + ['+Inf'], cumulative):
+                    lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {value}')
+                labels = f'{{{labels[:-1]}}}' if labels != '' else ''
+                lines.append(f'{metric}_sum{labels} {total}')
+                lines.append(f'{metric}_count{labels} {count}')
+        return lines
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_gauges(prefix: str, values: typing.Dict[str, typing.Tuple[str, str, float]]) -> typing.List[str]:
+    """
+    Lines of single value metrics in the Prometheus text format
+
+    :param str prefix: Prefix of the metric names
+    :param values: Name suffix -> (type, description, value)
+    """
+    lines: typing.List[str] = []
+    for name, (kind, description, value) in values.items():
+        lines.append(f'# HELP {prefix}_{name} {description}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        lines.append(f'{prefix}_{name} {value}')
+    return lines
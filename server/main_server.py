@@ -1,5 +1,6 @@
 from flask.app import Flask
 from flask.app import request
+from flask import Response
 
 from flask_mqtt import Mqtt
 from flask_mqtt import MQTT_ERR_SUCCESS
@@ -12,12 +13,20 @@ import logging
 import sys
 import os
 import traceback
-import copy
+import time
 
-from subprocess import Popen
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_backend import create_state
+from aggregation import DEFAULT_ROLLUPS, parse_window, parse_rollups
+from host_client import HostClient, HostError
+from segment_store import SegmentStore
+from api_handlers import ApiHandlers, ApiRequest, RawReply, DeviceAddition, stream_chunks
+
 app = Flask(__name__)
 
 sys.stderr = sys.stdout
@@ -40,32 +49,136 @@ app.config['MQTT_CLIENT_ID'] = 'MAIN_SERVER'
 app.config['MQTT_BROKER_URL'] = os.environ['MQTT_ADDRESS']
 app.config['MQTT_BROKER_PORT'] = int(os.environ['MQTT_PORT'])
 
-mqtt = Mqtt(app)
+mqtt = Mqtt()
 
-devices: typing.Dict[str, str] = {}
+#With the shared backend the state server (server/state_server.py) owns the state and
+#connects to the broker, the workers of gunicorn only get a proxy to it
+state, owns_state = create_state(int(os.environ.get('SENSOR_HISTORY', '1024')), app.logger,
+                                 os.environ.get('MQTT_HOST_WILDCARDS') == '1',
+                                 parse_rollups(os.environ.get('SENSOR_ROLLUPS', DEFAULT_ROLLUPS)))
 
-curr_statuses: typing.Dict[str, str] = {}
-sensors_data: typing.Dict[str, typing.List[str]] = {}
+#Requests to the room hosts reuse pooled keep-alive connections
+HOST_TIMEOUT = float(os.environ.get('HOST_TIMEOUT', '5'))
+host_client = HostClient(HOST_TIMEOUT,
+                         retries=int(os.environ.get('HOST_RETRIES', '2')),
+                         pool_size=int(os.environ.get('HOST_POOL_SIZE', '8')))
+
+def fetch_host_devices(host_id: str):
+    host = state.get_host(host_id)
+    if host == None:
+        return None
+    try:
+        sensor_res = host_client.get(f'http://{host}:5000/sensors/get_all')
+        actuator_res = host_client.get(f'http://{host}:5000/actuators/get_all')
+    except requests.RequestException:
+        app.logger.error(f'Reconciliation of {host_id} failed')
+        return None
+    if sensor_res.status_code != 200 or actuator_res.status_code != 200:
+        return None
+    return sensor_res.json()['sensors'], actuator_res.json()['actuators']
+
+#With the shared backend a blocking wait for stream events would hold
+#a thread of the state server for each client, the workers poll instead
+STREAM_WAIT = 15.0 if owns_state else 0.0
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '0.1'))
+STREAM_HEARTBEAT = 15.0
+
+#Requests sent to every room host run concurrently, each with its own timeout
+fan_out_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('FAN_OUT_WORKERS', '16')), thread_name_prefix='fan_out')
+
+def host_request(method: str, url: str):
+    res = host_client.request(method, url)
+    if res.status_code != 200:
+        try:
+            status = res.json().get('status', 'E_HOST_FAIL')
+        except ValueError:
+            status = 'E_HOST_FAIL'
+        raise HostError(status)
+    return res.json()
+
+def fan_out(method: str, path: str) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, str]]:
+    """
+    Sends the same request to every room host concurrently.
+    Returns the parsed responses of the hosts that answered
+    and the error status of the others
+
+    :param str method: HTTP method
+    :param str path: Path on the room host server, e.g. '/sensors/get_all'
+    """
+    futures = {host_id: fan_out_pool.submit(host_request, method, f'http://{host}:5000{path}') 
+               for host_id, host in state.get_hosts().items()}
+    results: typing.Dict[str, typing.Any] = {}
+    errors: typing.Dict[str, str] = {}
+    for host_id, future in futures.items():
+        try:
+            results[host_id] = future.result()
+        except HostError as exc:
+            errors[host_id] = exc.status
+        except requests.Timeout:
+            errors[host_id] = 'E_TIMEOUT'
+        except requests.RequestException:
+            errors[host_id] = 'E_UNREACHABLE'
+    if len(errors) > 0:
+        app.logger.error(f'{method} {path} failed on {errors}')
+    return results, errors
 
 @mqtt.on_connect()
 def handle_connect(client, userdata, flags, rc):
     app.logger.info(f'Connected to Mqtt broker')
+    if rc == MQTT_ERR_SUCCESS:
+        state.restore_subscriptions()
 
 @mqtt.on_message()
 def handle_publish(client, userdata, message: MQTTMessage):
-    global curr_statuses
-    payload_msg = message.payload.decode()
-    topic = message.topic
-    if topic.find('status') != -1:
-        #This is a status message
-        curr_statuses[message.topic] = payload_msg
-        return
-    #This is a data message
-    if sensors_data.get(message.topic) == None:
-        sensors_data[message.topic] = [payload_msg]
-    else:
-        sensors_data[message.topic].append(payload_msg)
-    return
+    #Runs on the network thread of paho, the messages are processed by the ingest workers
+    state.submit(message.topic, message.payload)
+
+def publish_command(topic: str, payload: str, qos: int) -> bool:
+    result, _ = mqtt.publish(topic, payload, qos=qos)
+    return result == MQTT_ERR_SUCCESS
+
+#Subscriptions are tracked by the state and restored in bulk by handle_connect,
+#not by Flask-MQTT that would drop the ones made while disconnected
+def subscribe_topics(topics: typing.List[str]):
+    mqtt.client.subscribe([(topic, 0) for topic in topics])
+
+def unsubscribe_topics(topics: typing.List[str]):
+    mqtt.client.unsubscribe(topics)
+
+if owns_state:
+    if os.environ.get('SENSOR_ARCHIVE_DIR') != None:
+        state.attach_archive(SegmentStore(os.environ['SENSOR_ARCHIVE_DIR'],
+                                          parse_window(os.environ.get('SENSOR_ARCHIVE_PARTITION', '1h')),
+                                          parse_window(os.environ.get('SENSOR_ARCHIVE_RETENTION', '7d'))))
+    state.start_ingest_workers(int(os.environ.get('INGEST_WORKERS', '2')), int(os.environ.get('INGEST_QUEUE', '10000')))
+    state.attach_mqtt(subscribe_topics, unsubscribe_topics, publish_command)
+    mqtt.init_app(app)
+    state.start_reconciliation(fetch_host_devices, float(os.environ.get('REGISTRY_RECONCILE_INTERVAL', '30')))
+
+api = ApiHandlers(state, app.logger)
+
+def read_request() -> ApiRequest:
+    content_type = request.headers.get('Content-Type')
+    payload = request.get_json() if content_type == 'application/json' else None
+    return ApiRequest(content_type, payload, request.args)
+
+def reply(result):
+    if isinstance(result, RawReply):
+        return Response(result.body, mimetype=result.mimetype, headers=result.headers)
+    return result
+
+def add_device(host_id: str, kind: str):
+    addition = api.prepare_add_device(read_request(), host_id, kind)
+    if not isinstance(addition, DeviceAddition):
+        return addition
+    try:
+        res = host_client.post(addition.url, headers={'Content-Type': 'application/json'}, data=json.dumps(addition.body))
+    except requests.RequestException:
+        return {'status': 'E_UNREACHABLE'}, 400
+
+    if res.status_code != 200:
+        return res.json(), 400
+    return api.device_added(addition)
 
 @app.route("/heartbeat")
 def heartbeat():
@@ -73,42 +186,15 @@ def heartbeat():
 
 @app.post("/devices")
 def add_devices():
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid POST /devices content')
-        return {'status': 'E_CONTENT'}, 400
-    parsed = request.get_json()
-
-    if type(parsed) != type({}):
-        app.logger.error(f'Invalid POST /devices json type: {type(parsed).__name__}')
-        return {'status': 'E_LIST'}, 400
-
-    for host in parsed.keys():
-        if devices.get(host) == None:
-            devices[host] = parsed.get(host)
-
-    app.logger.info('Updated devices')
-    return {'status': 'E_OK'}, 200
+    return api.add_devices(read_request())
 
 @app.get("/devices")
 def get_devices():
-    return {'status': 'E_OK', 'devs': json.dumps(devices)}, 200
+    return api.get_devices()
 
 @app.delete("/devices")
 def del_devices():
-    if request.args.get('devs') == None:
-        app.logger.error(f'Invalid DELETE /devices param')
-        return {'status': 'E_CONTENT'}, 400
-
-    try:
-        dev_str = request.args.get('devs', type=str)
-        devs = json.loads(dev_str)
-        if type(devs) != type([]):
-            return {'status': 'E_PARAM'}
-        for dev in devs:
-            devices.pop(dev, None)
-    except:
-        return {'status': 'E_PARAM'}
-    return {'status': 'E_OK'}
+    return api.del_devices(read_request())
 
 ########################################################################################
 ########################################################################################
@@ -117,130 +203,23 @@ def del_devices():
 
 @app.post("/dev/<string:id>/sensors")
 def add_sensor(id):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid POST /dev/<id>/sensors content')
-        return {'status': 'E_CONTENT'}, 400
-    
-    payload: typing.Dict[str, typing.Any] = request.get_json()
-
-    if type(payload) != type({}):
-        app.logger.error(f'Invalid POST /dev/<id>/sensors json type: {type(payload).__name__}')
-        return {'status': 'E_PARAMS'}, 400
-    
-    if payload.get('module') == None or payload.get('instance_id') == None:
-        app.logger.error(f'Missing POST /dev/<id>/sensors params')
-        return {'status': 'E_PARAMS'}, 400
-    
-    py_module = payload['module']
-    instance_id = payload['instance_id']
-
-    if devices.get(id) == None:
-        app.logger.error(f'POST /dev/<id>/sensors invalid device')
-        return {'status': 'E_INV_DEV'}, 400
-    
-    dev_ip = devices[id]
-    dev_url = f'http://{dev_ip}:5000/sensors'
-
-    data = json.dumps({'module': py_module, 'instance_id': instance_id})
-    res = requests.post(dev_url, headers={'Content-Type': 'application/json'}, data=data)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    mqtt_data_topic = f'{id}/{instance_id}'
-    mqtt_status_topic = f'{id}/{instance_id}_status'
-
-    mqtt.subscribe(mqtt_data_topic)
-    mqtt.subscribe(mqtt_status_topic)
-    
-    app.logger.info(f'Added new sensor of type {py_module} to {id}, with instance id {instance_id}')
-    return {'status': 'OK'}, 200
+    return add_device(id, 'sensor')
 
 @app.delete("/dev/sensors/delete_all")
 def remove_all_sensors():
-    for _, host in devices.items():
-        sensor_url = f'http://{host}:5000/sensors/delete_all'
-        res = requests.delete(sensor_url)
-        if res.status_code != 200:
-            return res.json(), 400
-    mqtt.unsubscribe_all()
-    return {'status': 'E_OK'}, 200
+    return api.all_removed('sensor', *fan_out('DELETE', '/sensors/delete_all'))
 
 @app.get("/dev/sensors/get_all")
 def get_all_sensors():
-    sensor_list: typing.Dict[str, typing.List] = {}
-    for host_id, host in devices.items():
-        sensor_list[host_id] = []
-        sensor_url = f'http://{host}:5000/sensors/get_all'
-        res = requests.get(sensor_url)
-        if res.status_code != 200:
-            return res.json(), 400
-        sensor_list[host_id].extend(res.json()['sensors'])
-    return {'status': 'E_OK', 'sensors': sensor_list}, 200
+    return api.all_listed('sensor', *fan_out('GET', '/sensors/get_all'))
 
 @app.put("/dev/<string:host_id>/sensor_stop")
 def stop_sensor(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid PUT /dev/<id>/sensor_stop content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('sensor_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/sensors/{payload["sensor_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    mqtt_control_topic = f'{host_id}/{payload["sensor_id"]}_control'
-    app.logger.info(mqtt_control_topic)
-    result, _ = mqtt.publish(mqtt_control_topic, "STOP", qos=1)
-    if result != MQTT_ERR_SUCCESS:
-        app.logger.error(f'Publish to {mqtt_control_topic} failed')
-        return {'status': 'E_FAIL'}, 400
-    return {'status': 'E_OK'}, 200
+    return api.device_command(read_request(), host_id, 'sensor', 'STOP')
 
 @app.put("/dev/<string:host_id>/sensor_start")
 def start_sensor(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid PUT /dev/<id>/sensor_start content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('sensor_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/sensors/{payload["sensor_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    mqtt_control_topic = f'{host_id}/{payload["sensor_id"]}_control'
-    app.logger.info(mqtt_control_topic)
-    result, _ = mqtt.publish(mqtt_control_topic, "START", qos=1)
-    if result != MQTT_ERR_SUCCESS:
-        app.logger.error(f'Publish to {mqtt_control_topic} failed')
-        return {'status': 'E_FAIL'}, 400
-    return {'status': 'E_OK'}, 200
+    return api.device_command(read_request(), host_id, 'sensor', 'START')
 
 
 
@@ -250,292 +229,113 @@ def start_sensor(host_id: str):
 
 @app.post("/dev/<string:host_id>/actuators")
 def add_actuator(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid POST /dev/<id>/actuators content')
-        return {'status': 'E_CONTENT'}, 400
-    
-    payload: typing.Dict[str, typing.Any] = request.get_json()
-
-    if type(payload) != type({}):
-        app.logger.error(f'Invalid POST /dev/<id>/actuators json type: {type(payload).__name__}')
-        return {'status': 'E_PARAMS'}, 400
-    
-    if payload.get('module') == None or payload.get('instance_id') == None:
-        app.logger.error(f'Missing POST /dev/<id>/actuators params')
-        return {'status': 'E_PARAMS'}, 400
-    
-    py_module = payload['module']
-    instance_id = payload['instance_id']
-
-    if devices.get(host_id) == None:
-        app.logger.error(f'POST /dev/<id>/actuators invalid device')
-        return {'status': 'E_INV_DEV'}, 400
-    
-    dev_ip = devices[host_id]
-    dev_url = f'http://{dev_ip}:5000/actuators'
-
-    data = json.dumps({'module': py_module, 'instance_id': instance_id})
-    res = requests.post(dev_url, headers={'Content-Type': 'application/json'}, data=data)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    mqtt_status_topic = f'{host_id}/{instance_id}_status'
-    mqtt.subscribe(mqtt_status_topic)
-    
-    app.logger.info(f'Added new actuator of type {py_module} to {host_id}, with instance id {instance_id}')
-    return {'status': 'OK'}, 200
-
+    return add_device(host_id, 'actuator')
 
 @app.get("/dev/actuators/get_all")
 def get_all_actuators():
-    actuator_list: typing.Dict[str, typing.List] = {}
-    for host_id, host in devices.items():
-        actuator_list[host_id] = []
-        sensor_url = f'http://{host}:5000/actuators/get_all'
-        res = requests.get(sensor_url)
-        if res.status_code != 200:
-            return res.json(), 400
-        actuator_list[host_id].extend(res.json()['actuators'])
-    return {'status': 'E_OK', 'actuators': actuator_list}, 200
+    return api.all_listed('actuator', *fan_out('GET', '/actuators/get_all'))
 
 @app.delete("/dev/actuators/delete_all")
 def remove_all_actuators():
-    for _, host in devices.items():
-        actuator_url = f'http://{host}:5000/actuators/delete_all'
-        res = requests.delete(actuator_url)
-        if res.status_code != 200:
-            return res.json(), 400
-    mqtt.unsubscribe_all()
-    return {'status': 'E_OK'}, 200
+    return api.all_removed('actuator', *fan_out('DELETE', '/actuators/delete_all'))
 
 @app.put("/dev/<string:host_id>/actuator_stop")
 def stop_actuator(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid PUT /dev/<id>/actuator_stop content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('actuator_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/actuators/{payload["actuator_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    mqtt_control_topic = f'{host_id}/{payload["actuator_id"]}_control'
-    app.logger.info(mqtt_control_topic)
-    result, _ = mqtt.publish(mqtt_control_topic, "STOP", qos=1)
-    if result != MQTT_ERR_SUCCESS:
-        app.logger.error(f'Publish to {mqtt_control_topic} failed')
-        return {'status': 'E_FAIL'}, 400
-    return {'status': 'E_OK'}, 200
+    return api.device_command(read_request(), host_id, 'actuator', 'STOP')
 
 @app.put("/dev/<string:host_id>/actuator_start")
 def start_actuator(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid PUT /dev/<id>/actuator_start content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('actuator_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/actuators/{payload["actuator_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    mqtt_control_topic = f'{host_id}/{payload["actuator_id"]}_control'
-    app.logger.info(mqtt_control_topic)
-    result, _ = mqtt.publish(mqtt_control_topic, "START", qos=1)
-    if result != MQTT_ERR_SUCCESS:
-        app.logger.error(f'Publish to {mqtt_control_topic} failed')
-        return {'status': 'E_FAIL'}, 400
-    return {'status': 'E_OK'}, 200
+    return api.device_command(read_request(), host_id, 'actuator', 'START')
 
 ###########################################################################################
 ###########################################################################################
 
 @app.get("/dev/<string:host_id>/sensor_status")
 def get_sensor_status(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid GET /dev/<id>/sensor_status content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('sensor_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/sensors/{payload["sensor_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    topic_name = f'{host_id}/{payload["sensor_id"]}_status'
-    if curr_statuses.get(topic_name) == None:
-        return {'status': 'E_NOT_AVAIL'}, 400
-    
-    return {'status': 'E_OK', 'sensor_status': curr_statuses[topic_name]}, 200
+    return api.device_status(read_request(), host_id, 'sensor')
 
 @app.get("/dev/<string:host_id>/actuator_status")
 def get_actuator_status(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid GET /dev/<id>/actuator_status content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('actuator_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/actuators/{payload["actuator_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    topic_name = f'{host_id}/{payload["actuator_id"]}_status'
-    if curr_statuses.get(topic_name) == None:
-        return {'status': 'E_NOT_AVAIL'}, 400
-    
-    return {'status': 'E_OK', 'actuator_status': curr_statuses[topic_name]}, 200
+    return api.device_status(read_request(), host_id, 'actuator')
 
 @app.get("/dev/<string:host_id>/sensor_data")
 def get_sensor_data(host_id: str):
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid GET /dev/<id>/sensor_data content')
-        return {'status': 'E_CONTENT'}, 400
-    if devices.get(host_id) == None:
-        return {'status': 'E_HOST'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('sensor_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    host_url = f'http://{devices[host_id]}:5000/sensors/{payload["sensor_id"]}/exists'
-    res = requests.get(host_url)
-
-    if res.status_code != 200:
-        return res.json(), 400
-    
-    if res.json()["status"] != 'E_FOUND':
-        return {'status': 'E_INV_ID'}, 400
-    
-    topic_name = f'{host_id}/{payload["sensor_id"]}'
-    if sensors_data.get(topic_name) == None:
-        return {'status': 'E_NOT_AVAIL'}, 400
-    data = copy.deepcopy( sensors_data[topic_name] )
-    sensors_data[topic_name].clear()
-    return {'status': 'E_OK', 'sensor_data': data}, 200
+    return reply(api.sensor_data(read_request(), host_id))
+
+@app.get("/dev/<string:host_id>/sensor_data/aggregate")
+def get_sensor_aggregate(host_id: str):
+    return api.sensor_aggregate(read_request(), host_id)
+
+@app.get("/dev/<string:host_id>/sensor_data/history")
+def get_sensor_history(host_id: str):
+    return api.sensor_history(read_request(), host_id)
+
+@app.post("/telemetry/batch")
+def get_telemetry_batch():
+    return api.telemetry_batch(read_request())
+
+@app.get("/stream")
+def stream_events():
+    error, topics, max_queue = api.stream_params(read_request())
+    if error != None:
+        return error
+    
+    stream_id = state.stream_subscribe(topics, max_queue)
+
+    def generate():
+        try:
+            reported_drops = 0
+            last_sent = time.monotonic()
+            yield ': connected\n\n'
+            while True:
+                events, dropped = state.stream_get(stream_id, STREAM_WAIT)
+                if len(events) == 0 and dropped == reported_drops and time.monotonic() - last_sent < STREAM_HEARTBEAT:
+                    time.sleep(STREAM_POLL_INTERVAL)
+                    continue
+                chunks, reported_drops = stream_chunks(events, dropped, reported_drops)
+                last_sent = time.monotonic()
+                yield ''.join(chunks)
+        finally:
+            state.stream_unsubscribe(stream_id)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 ###########################################################################################
 ###########################################################################################
 
-controllers: typing.Dict[str, Popen] = {}
-
 @app.post("/controllers/add")
 def add_controller():
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid POST /controllers/add content')
-        return {'status': 'E_CONTENT'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('module') == None:
-        return {'status': 'E_MODULE'}, 400
-    if payload.get('instance_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    if controllers.get(payload['instance_id']) != None:
-        return {'status': 'E_EXISTS'}, 400
-    
-    py_module = payload['module']
-    if not os.path.exists(f'./controllers/{py_module}.py'):
-        return {'status': 'E_MODULE'}, 400
-    
-    new_env = {}
-    new_env.update(os.environ)
-    new_env['MODULE_NAME'] = payload['instance_id']
-    controllers[payload['instance_id']] = Popen(f'python3 ./controllers/{py_module}.py', shell=True, env=new_env)
-    return {'status': 'E_OK'}, 200
+    return api.add_controller(read_request())
 
 @app.delete("/controllers/remove")
 def remove_controller():
-    if request.headers.get('Content-Type') != 'application/json':
-        app.logger.error(f'Invalid DELETE /controllers/remove content')
-        return {'status': 'E_CONTENT'}, 400
-    
-    payload = request.get_json()
-
-    if type(payload) != type({}):
-        return {'status': 'E_LIST'}, 400
-    if payload.get('instance_id') == None:
-        return {'status': 'E_MISSING_ID'}, 400
-    
-    if controllers.get(payload['instance_id']) == None:
-        return {'status': 'E_NOT_EXIST'}, 400
-    
-    controllers[payload['instance_id']].terminate()
-    del controllers[payload['instance_id']]
-    return {'status': 'E_OK'}, 200
+    return api.remove_controller(read_request())
 
 @app.delete("/controllers/remove_all")
 def remove_all_controllers():
-    for controller in controllers.values():
-        controller.terminate()
-    controllers.clear()
-    return {'status': 'E_OK'}, 200
+    return api.remove_all_controllers()
 
 @app.get("/controllers/get_all")
 def get_all_controllers():
-    names = [name for name in controllers.keys()]
-    return {'status': 'E_OK', 'controllers': names}, 200
+    return api.get_controllers()
 
 
 ###########################################################################################
 ###########################################################################################
 
+@app.get("/stats/host_pool")
+def get_host_pool_stats():
+    #Each worker has its own pool, the stats are the ones of the worker that answers
+    return {'status': 'E_OK', 'worker': os.getpid(), 'hosts': host_client.metrics()}, 200
+
+@app.get("/stats/ingest")
+def get_ingest_stats():
+    return {'status': 'E_OK', 'ingest': state.ingest_stats()}, 200
+
+@app.get("/metrics")
+def get_metrics():
+    return reply(api.metrics())
+
 @app.post("/shutdown")
 def shutdown():
     func = request.environ.get('werkzeug.server.shutdown')
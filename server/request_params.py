@@ -0,0 +1,37 @@
+import typing
+import math
+
+#Query parameters of the main server (Flask and Quart both give a MultiDict of strings)
+Args = typing.Mapping[str, str]
+
+def int_param(args: Args, name: str, default: typing.Optional[int] = None,
+              minimum: typing.Optional[int] = None, maximum: typing.Optional[int] = None) -> typing.Optional[int]:
+    """
+    Parses an integer query parameter. Raises ValueError
+    when it is malformed or out of [minimum, maximum],
+    instead of silently ignoring it
+
+    :return: The value, 'default' when the parameter is missing
+    """
+    value = args.get(name)
+    if value == None:
+        return default
+    parsed = int(value)
+    if (minimum != None and parsed < minimum) or (maximum != None and parsed > maximum):
+        raise ValueError(f'Parameter {name} out of range')
+    return parsed
+
+def float_param(args: Args, name: str, default: typing.Optional[float] = None) -> typing.Optional[float]:
+    """
+    Parses a finite float query parameter (e.g. a timestamp),
+    raises ValueError when it is malformed
+
+    :return: The value, 'default' when the parameter is missing
+    """
+    value = args.get(name)
+    if value == None:
+        return default
+    parsed = float(value)
+    if not math.isfinite(parsed):
+        raise ValueError(f'Parameter {name} must be finite')
+    return parsed
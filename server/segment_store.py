@@ -0,0 +1,448 @@
+import threading
+import typing
+import queue
+import mmap
+import json
+import os
+import struct
+import time
+import bisect
+import atexit
+import urllib.parse
+import traceback
+import sys
+
+import numpy as np
+
+from common.codec import PackedCodec
+
+SEGMENT_MAGIC = b'IOTSEG\x01\x00'
+SEGMENT_SUFFIX = '.seg'
+#The sparse index has an entry every INDEX_STRIDE records
+INDEX_STRIDE = 256
+MAX_FIELDS = 32
+DEFAULT_QUEUE_SIZE = 100000
+BATCH_SIZE = 4096
+#Seconds without readings after which the file of a segment is closed
+IDLE_TIMEOUT = 60.0
+
+Schema = typing.List[typing.Tuple[str, str]]
+#Records of a segment (numpy structured array) with their schema
+RecordArray = typing.Tuple[Schema, np.ndarray]
+
+def record_dtype(schema: Schema) -> np.dtype:
+    """
+    Numpy dtype with the same layout of the records
+    packed by a PackedCodec with the given schema
+    """
+    fields = [('mask', '<u4')]
+    for name, fmt in schema:
+        base = '<i8' if fmt[-1] == 'q' else '<f8'
+        if len(fmt) > 1:
+            fields.append((name, base, (int(fmt[:-1]),)))
+        else:
+            fields.append((name, base))
+    return np.dtype(fields)
+
+def is_numeric(value) -> bool:
+    if isinstance(value, list):
+        return len(value) > 0 and all(isinstance(elem, (int, float)) for elem in value)
+    return isinstance(value, (int, float))
+
+def field_format(value) -> str:
+    if isinstance(value, list):
+        code = 'q' if all(isinstance(elem, int) for elem in value) else 'd'
+        return f'{len(value)}{code}'
+    return 'q' if isinstance(value, int) else 'd'
+
+def merge_format(fmt: typing.Optional[str], value) -> typing.Optional[str]:
+    """
+    Format of a field that can store both its current
+    values and the new one, integer fields become float
+    fields when they receive a float
+    """
+    if value == None:
+        return fmt
+    new_fmt = field_format(value)
+    if fmt == None or fmt[:-1] != new_fmt[:-1]:
+        return new_fmt
+    return fmt[:-1] + 'd' if 'd' in (fmt[-1], new_fmt[-1]) else fmt
+
+class Segment:
+    """
+    An append-only file holding the fixed size records of
+    a topic received in one time partition. The file starts
+    with a header describing the schema of its records,
+    readers map it in memory and use a sparse index of the
+    running maximum timestamp to skip the records older
+    than the start of the query
+    """
+    def __init__(self, path: str, partition: float, schema: Schema, header_size: int, count: int):
+        self.path = path
+        self.partition = partition
+        self.schema = schema
+        self.dtype = record_dtype(schema)
+        self.header_size = header_size
+        self.count = count
+        self.min_ts = np.inf
+        self.max_ts = -np.inf
+        self.index: typing.List[float] = []
+        self.mapped: typing.Optional[mmap.mmap] = None
+        self.mapped_count = 0
+        self.lock = threading.Lock()
+
+    def update_index(self, timestamps: np.ndarray, first: int):
+        """
+        Adds the timestamps of the records appended from
+        position 'first' to the bounds and to the sparse index
+        """
+        if len(timestamps) == 0:
+            return
+        running = np.maximum.accumulate(np.concatenate(([self.max_ts], timestamps)))[1:]
+        self.min_ts = min(self.min_ts, float(timestamps.min()))
+        self.max_ts = float(running[-1])
+        #Positions (relative to 'first') of the last record of each stride
+        ends = np.arange(INDEX_STRIDE - 1 - first % INDEX_STRIDE, len(timestamps), INDEX_STRIDE)
+        self.index.extend(running[ends].tolist())
+
+    def _records(self) -> np.ndarray:
+        with self.lock:
+            count = self.count
+            if self.mapped == None or self.mapped_count != count:
+                with open(self.path, 'rb') as file:
+                    self.mapped = mmap.mmap(file.fileno(), self.header_size + count * self.dtype.itemsize, access=mmap.ACCESS_READ)
+                self.mapped_count = count
+            return np.frombuffer(self.mapped, dtype=self.dtype, count=count, offset=self.header_size)
+
+    def read(self, start: typing.Optional[float], end: typing.Optional[float], limit: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        return segment_records(self.schema, self.read_array(start, end, limit))
+
+    def read_array(self, start: typing.Optional[float], end: typing.Optional[float], limit: int) -> np.ndarray:
+        """
+        Copy of the records with timestamp in [start, end)
+        """
+        if self.count == 0 or limit <= 0:
+            return np.empty(0, dtype=self.dtype)
+        first = bisect.bisect_left(self.index, start) * INDEX_STRIDE if start != None else 0
+        records = self._records()[first:]
+        timestamps = records['timestamp']
+        selected = np.ones(len(records), dtype=bool)
+        if start != None:
+            selected &= timestamps >= start
+        if end != None:
+            selected &= timestamps < end
+        return records[selected][:limit]
+
+def segment_records(schema: Schema, records: np.ndarray) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Readings of the records read from a segment,
+    fields missing in a record are left out
+    """
+    columns = []
+    for i, (name, _) in enumerate(schema):
+        present = ((records['mask'] >> i) & 1).astype(bool).tolist()
+        columns.append((name, records[name].tolist(), present))
+    result: typing.List[typing.Dict[str, typing.Any]] = []
+    for row in range(len(records)):
+        record = {}
+        for name, values, present in columns:
+            if present[row]:
+                record[name] = values[row]
+        result.append(record)
+    return result
+
+class SegmentWriter:
+    def __init__(self, segment: Segment, file: typing.BinaryIO):
+        self.segment = segment
+        self.file = file
+        self.codec = PackedCodec(segment.schema)
+        self.formats = dict(segment.schema)
+        self.last_write = time.monotonic()
+
+class SegmentStore:
+    """
+    Persistent history of the sensor readings. Each topic
+    has its own directory of segment files, a new segment
+    is started for every 'partition' seconds of receive time
+    (or when the fields of the readings change), segments
+    older than 'retention' seconds are deleted.
+
+    append() only queues the reading, a writer thread packs
+    the queued readings and writes them in batches. The file
+    of a segment is closed when its partition ends, when its
+    topic is idle for IDLE_TIMEOUT seconds or is removed
+    """
+    def __init__(self, directory: str, partition: float, retention: float, max_queue: int = DEFAULT_QUEUE_SIZE,
+                 flush_interval: float = 1.0):
+        self.directory = directory
+        self.partition = partition
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.segments: typing.Dict[str, typing.List[Segment]] = {}
+        self.writers: typing.Dict[str, SegmentWriter] = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.running = True
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.thread = threading.Thread(target=self._run, name='segment_writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def topic_directory(self, topic: str) -> str:
+        return os.path.join(self.directory, urllib.parse.quote(topic, safe=''))
+
+    def _load(self):
+        for entry in sorted(os.listdir(self.directory)):
+            topic = urllib.parse.unquote(entry)
+            path = os.path.join(self.directory, entry)
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                if not name.endswith(SEGMENT_SUFFIX):
+                    continue
+                try:
+                    segment = self._open_segment(os.path.join(path, name))
+                except (OSError, ValueError):
+                    print(f'Invalid segment {name} of {topic}', flush=True, file=sys.stdout)
+                    continue
+                self.segments.setdefault(topic, []).append(segment)
+
+    def _open_segment(self, path: str) -> Segment:
+        with open(path, 'rb') as file:
+            prefix = file.read(len(SEGMENT_MAGIC) + 4)
+            if len(prefix) != len(SEGMENT_MAGIC) + 4 or prefix[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise ValueError('Invalid segment header')
+            length, = struct.unpack('<I', prefix[len(SEGMENT_MAGIC):])
+            header = json.loads(file.read(length))
+        schema = [(field[0], field[1]) for field in header['schema']]
+        header_size = len(SEGMENT_MAGIC) + 4 + length
+        #A record partially written before a crash is ignored
+        count = (os.path.getsize(path) - header_size) // record_dtype(schema).itemsize
+        segment = Segment(path, header['partition'], schema, header_size, max(count, 0))
+        segment.update_index(segment._records()['timestamp'].copy(), 0)
+        return segment
+
+    def _new_writer(self, topic: str, partition: float, schema: Schema) -> SegmentWriter:
+        directory = self.topic_directory(topic)
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            number = len(self.segments.get(topic, []))
+        header = json.dumps({'topic': topic, 'partition': partition, 'schema': [list(field) for field in schema]}).encode()
+        while True:
+            path = os.path.join(directory, f'{int(partition)}_{number:06d}{SEGMENT_SUFFIX}')
+            try:
+                file = open(path, 'xb')
+                break
+            except FileExistsError:
+                number += 1
+        file.write(SEGMENT_MAGIC + struct.pack('<I', len(header)) + header)
+        file.flush()
+        segment = Segment(path, partition, schema, len(SEGMENT_MAGIC) + 4 + len(header), 0)
+        with self.lock:
+            self.segments.setdefault(topic, []).append(segment)
+        writer = SegmentWriter(segment, file)
+        self.writers[topic] = writer
+        return writer
+
+    def _writer_for(self, topic: str, partition: float, values: typing.Dict[str, typing.Any]) -> SegmentWriter:
+        """
+        Returns the writer of the current segment of the topic,
+        starting a new segment when the partition changed or
+        the reading does not fit in the schema of the current one
+        """
+        writer = self.writers.get(topic)
+        if writer != None and writer.segment.partition == partition:
+            full = len(writer.formats) >= MAX_FIELDS
+            if all(writer.formats.get(name) == merge_format(writer.formats.get(name), value)
+                   for name, value in values.items() if not full or name in writer.formats):
+                return writer
+        schema: Schema = [('timestamp', 'd')]
+        if writer != None:
+            schema = [(name, merge_format(fmt, values.get(name))) for name, fmt in writer.segment.schema]
+        known = set(name for name, _ in schema)
+        for name, value in values.items():
+            if name not in known and len(schema) < MAX_FIELDS:
+                schema.append((name, field_format(value)))
+        return self._new_writer(topic, partition, schema)
+
+    def append(self, topic: str, timestamp: float, values: typing.Dict[str, typing.Any]):
+        try:
+            self.queue.put_nowait((topic, timestamp, values, time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def remove_topic(self, topic: str):
+        """
+        Closes the current segment of a removed topic after
+        the readings already queued, its segments are kept
+        until they expire
+        """
+        #Queued like the readings, the writers belong to the writer thread.
+        #When the queue is full the segment is closed once idle
+        try:
+            self.queue.put_nowait((topic, 0.0, None, time.time()))
+        except queue.Full:
+            pass
+
+    def _close_writer(self, topic: str):
+        writer = self.writers.pop(topic, None)
+        if writer != None:
+            writer.file.close()
+
+    def close_idle_writers(self):
+        """
+        Closes the segments whose partition ended or that
+        received no readings for IDLE_TIMEOUT seconds
+        """
+        partition = (time.time() // self.partition) * self.partition
+        idle_limit = time.monotonic() - IDLE_TIMEOUT
+        for topic, writer in list(self.writers.items()):
+            if writer.segment.partition < partition or writer.last_write < idle_limit:
+                self._close_writer(topic)
+
+    def _write_batch(self, batch: typing.List[typing.Tuple[str, float, typing.Optional[typing.Dict[str, typing.Any]], float]]):
+        pending: typing.Dict[str, typing.Tuple[SegmentWriter, typing.List[bytes], typing.List[float]]] = {}
+        for topic, timestamp, values, recv_time in batch:
+            if values == None:
+                #Topic removed
+                if topic in pending:
+                    self._flush_pending(pending.pop(topic))
+                self._close_writer(topic)
+                continue
+            partition = (recv_time // self.partition) * self.partition
+            values = {name: value for name, value in values.items() if is_numeric(value)}
+            writer = self.writers.get(topic)
+            next_writer = self._writer_for(topic, partition, values)
+            if next_writer is not writer and writer != None:
+                if topic in pending:
+                    self._flush_pending(pending.pop(topic))
+                writer.file.close()
+            entry = pending.setdefault(topic, (next_writer, [], []))
+            record = dict(values)
+            record['timestamp'] = timestamp
+            try:
+                entry[1].append(next_writer.codec.encode(record))
+            except (ValueError, struct.error):
+                #Fields that did not fit in the schema
+                continue
+            entry[2].append(timestamp)
+        for entry in pending.values():
+            self._flush_pending(entry)
+
+    def _flush_pending(self, entry: typing.Tuple[SegmentWriter, typing.List[bytes], typing.List[float]]):
+        writer, records, timestamps = entry
+        if len(records) == 0:
+            return
+        writer.file.write(b''.join(records))
+        writer.file.flush()
+        writer.last_write = time.monotonic()
+        segment = writer.segment
+        segment.update_index(np.array(timestamps, dtype=np.float64), segment.count)
+        with segment.lock:
+            segment.count += len(records)
+        self.written += len(records)
+
+    def _run(self):
+        next_retention = time.monotonic()
+        while self.running or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if len(batch) > 0:
+                    self._write_batch(batch)
+                self.close_idle_writers()
+                if time.monotonic() >= next_retention:
+                    self.apply_retention()
+                    next_retention = time.monotonic() + 60.0
+            except:
+                print(traceback.format_exc(), flush=True, file=sys.stdout)
+
+    def apply_retention(self):
+        """
+        Deletes the segments whose partition ended more
+        than 'retention' seconds ago, closing them first
+        if they are still open
+        """
+        limit = time.time() - self.retention
+        for topic, writer in list(self.writers.items()):
+            if writer.segment.partition + self.partition < limit:
+                self._close_writer(topic)
+        expired: typing.List[Segment] = []
+        with self.lock:
+            for topic, segments in self.segments.items():
+                keep = []
+                for segment in segments:
+                    if segment.partition + self.partition < limit:
+                        expired.append(segment)
+                    else:
+                        keep.append(segment)
+                self.segments[topic] = keep
+        for segment in expired:
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+
+    def read(self, topic: str, start: typing.Optional[float], end: typing.Optional[float],
+             limit: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Reads the stored readings of a topic with timestamp
+        in [start, end), in the order they were received
+
+        :param str topic: Sensor data topic
+        :param float start: First timestamp, None for no bound
+        :param float end: Timestamp after the last one, None for no bound
+        :param int limit: Maximum number of readings
+        """
+        records: typing.List[typing.Dict[str, typing.Any]] = []
+        for schema, array in self.read_arrays(topic, start, end, limit):
+            records.extend(segment_records(schema, array))
+        return records
+
+    def read_arrays(self, topic: str, start: typing.Optional[float], end: typing.Optional[float],
+                    limit: int) -> typing.List[RecordArray]:
+        """
+        Same as read(), with the records of each segment as
+        a structured array (see segment_records)
+        """
+        with self.lock:
+            segments = list(self.segments.get(topic, []))
+        arrays: typing.List[RecordArray] = []
+        count = 0
+        for segment in segments:
+            if count >= limit:
+                break
+            if segment.count == 0 or (start != None and segment.max_ts < start) or (end != None and segment.min_ts >= end):
+                continue
+            array = segment.read_array(start, end, limit - count)
+            if len(array) > 0:
+                arrays.append((segment.schema, array))
+                count += len(array)
+        return arrays
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            segments = [segment for topic_segments in self.segments.values() for segment in topic_segments]
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped, 'written': self.written,
+                'segments': len(segments), 'records': sum(segment.count for segment in segments)}
+
+    def close(self):
+        """
+        Writes the queued readings and stops the writer
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        for writer in self.writers.values():
+            writer.file.close()
@@ -0,0 +1,367 @@
+import threading
+import typing
+import time
+
+import numpy as np
+
+from aggregation import Rollup, Aggregates, Partials, reading_partials, reduce_groups
+
+DEFAULT_CAPACITY = 1024
+
+RollupSpec = typing.List[typing.Tuple[float, int]]
+#Timestamps, field arrays and integer field names of a range of
+#readings, much cheaper to pickle than the records themselves
+Columns = typing.Tuple[np.ndarray, typing.Dict[str, np.ndarray], typing.List[str]]
+
+class TopicSeries:
+    """
+    Fixed capacity ring buffer holding the readings
+    of a single sensor topic. Timestamps and every
+    numeric field are kept in their own float64 array,
+    list fields (e.g. acceleration vectors) are kept
+    in 2D arrays with one row per reading.
+
+    Readings are identified by a monotonically increasing
+    sequence number, the reading with sequence 'seq' lives
+    at index 'seq % capacity' until it is overwritten.
+    Every reading also updates the rollups of the series,
+    and its ingestion time is kept to measure how long it
+    waits before being read
+    """
+    def __init__(self, capacity: int, rollups: typing.Optional[RollupSpec] = None):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self.next_seq = 0
+        self.oldest_seq = 0
+        self.timestamps = np.full(capacity, np.nan, dtype=np.float64)
+        self.ingest_times = np.full(capacity, np.nan, dtype=np.float64)
+        #Readings before this sequence were already read once
+        self.read_seq = 0
+        self.fields: typing.Dict[str, np.ndarray] = {}
+        self.int_fields: typing.Set[str] = set()
+        #Finest resolution first
+        self.rollups = [Rollup(resolution, buckets) for resolution, buckets in sorted(rollups or [])]
+        self.lock = threading.Lock()
+
+    def first_seq(self) -> int:
+        return max(self.oldest_seq, self.next_seq - self.capacity)
+
+    def _field_array(self, name: str, value) -> typing.Optional[np.ndarray]:
+        arr = self.fields.get(name)
+        if arr is None:
+            if isinstance(value, list):
+                arr = np.full((self.capacity, len(value)), np.nan, dtype=np.float64)
+            else:
+                arr = np.full(self.capacity, np.nan, dtype=np.float64)
+            self.fields[name] = arr
+            if _is_int_value(value):
+                self.int_fields.add(name)
+        if isinstance(value, list) != (arr.ndim == 2):
+            return None
+        if arr.ndim == 2 and arr.shape[1] != len(value):
+            return None
+        return arr
+
+    def append(self, timestamp: float, values: typing.Dict[str, typing.Any]) -> int:
+        with self.lock:
+            seq = self.next_seq
+            pos = seq % self.capacity
+            self.timestamps[pos] = timestamp
+            self.ingest_times[pos] = time.time()
+            for arr in self.fields.values():
+                arr[pos] = np.nan
+            for name, value in values.items():
+                arr = self._field_array(name, value)
+                if arr is None:
+                    continue
+                arr[pos] = value
+                if name in self.int_fields and not _is_int_value(value):
+                    self.int_fields.discard(name)
+            for rollup in self.rollups:
+                rollup.add(timestamp, values)
+            self.next_seq = seq + 1
+            return seq
+
+    def resize(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive")
+        with self.lock:
+            if capacity == self.capacity:
+                return
+            start = max(self.first_seq(), self.next_seq - capacity)
+            order = np.arange(start, self.next_seq) % self.capacity
+            new_pos = np.arange(start, self.next_seq) % capacity
+
+            timestamps = np.full(capacity, np.nan, dtype=np.float64)
+            timestamps[new_pos] = self.timestamps[order]
+            self.timestamps = timestamps
+
+            ingest_times = np.full(capacity, np.nan, dtype=np.float64)
+            ingest_times[new_pos] = self.ingest_times[order]
+            self.ingest_times = ingest_times
+
+            for name, arr in self.fields.items():
+                new_arr = np.full((capacity,) + arr.shape[1:], np.nan, dtype=np.float64)
+                new_arr[new_pos] = arr[order]
+                self.fields[name] = new_arr
+            self.oldest_seq = start
+            self.capacity = capacity
+
+    def schema(self) -> typing.List[typing.Tuple[str, str]]:
+        """
+        Packed codec schema matching the records
+        returned by this series
+        """
+        with self.lock:
+            schema = [('timestamp', 'd')]
+            for name, arr in self.fields.items():
+                code = 'q' if name in self.int_fields else 'd'
+                schema.append((name, f'{arr.shape[1]}{code}' if arr.ndim == 2 else code))
+            return schema
+
+    def segments(self, start: int, end: int) -> typing.List[typing.Tuple[int, slice]]:
+        """
+        Splits the sequence range [start, end) in at most
+        two contiguous slices of the underlying arrays, so
+        that readers can take views instead of copies.
+        Must be called with the lock held
+
+        :param int start: First sequence number (clamped to the oldest available)
+        :param int end: One past the last sequence number (clamped to next_seq)
+        """
+        start = max(start, self.first_seq())
+        end = min(end, self.next_seq)
+        if start >= end:
+            return []
+        first = start % self.capacity
+        count = end - start
+        if first + count <= self.capacity:
+            return [(start, slice(first, first + count))]
+        head = self.capacity - first
+        return [(start, slice(first, self.capacity)), (start + head, slice(0, count - head))]
+
+    def view(self, start: int, end: int) -> typing.List[typing.Tuple[int, np.ndarray, typing.Dict[str, np.ndarray]]]:
+        """
+        Zero copy read of the sequence range [start, end).
+        The returned arrays are views on the ring buffer and
+        are only stable while the caller holds the lock
+        """
+        return [(seq, self.timestamps[sl], {name: arr[sl] for name, arr in self.fields.items()})
+                for seq, sl in self.segments(start, end)]
+
+    def records(self, start: int, end: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        with self.lock:
+            return self._records(start, end)
+
+    def _records(self, start: int, end: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        #Must be called with the lock held
+        return column_records(self._columns(start, end))
+
+    def _columns(self, start: int, end: int) -> Columns:
+        #Must be called with the lock held, the arrays are copies
+        sections = self.view(start, end)
+        timestamps = np.concatenate([np.empty(0)] + [timestamps for _, timestamps, _ in sections])
+        fields = {name: np.concatenate([np.empty((0,) + arr.shape[1:])] + [fields[name] for _, _, fields in sections])
+                  for name, arr in self.fields.items()}
+        return timestamps, fields, sorted(self.int_fields)
+
+    def aggregate(self, field: str, window: float, fns: typing.List[str],
+                  start: typing.Optional[float] = None, end: typing.Optional[float] = None) -> typing.Optional[typing.Tuple[Aggregates, str]]:
+        """
+        Aggregates of a field over consecutive windows of
+        'window' seconds, see aggregate_partials
+
+        :param fns: Functions to compute, from aggregation.FUNCTIONS
+        """
+        result = self.aggregate_partials(field, window, start, end)
+        if result == None:
+            return None
+        partials, source = result
+        return reduce_groups(*partials, window, fns), source
+
+    def aggregate_partials(self, field: str, window: float, start: typing.Optional[float] = None,
+                           end: typing.Optional[float] = None) -> typing.Optional[typing.Tuple[Partials, str]]:
+        """
+        Aggregates of a field over consecutive windows of
+        'window' seconds, aligned to multiples of 'window'.
+        Without 'start' the range is the one of the raw readings
+        kept in the ring, whatever the window. With 'start' the
+        coarsest rollup matching the query is used, which can
+        reach further back, when there is none the raw readings
+        are aggregated. Returns the partial aggregates, to merge
+        with aggregation.reduce_groups, and their source ('rollup'
+        or 'raw'), None if the field does not exist
+
+        :param str field: Field name
+        :param float window: Window length in seconds
+        :param float start: Only readings from this timestamp
+        :param float end: Only readings before this timestamp
+        """
+        with self.lock:
+            arr = self.fields.get(field)
+            if arr is None:
+                return None
+            #Rollups keep much more history than the ring, without a start
+            #the range would depend on whether the window is aligned
+            if arr.ndim == 1 and start != None:
+                for rollup in reversed(self.rollups):
+                    if rollup.covers(window, start, end):
+                        return rollup.partials(field, window, start, end), 'rollup'
+            sections = self.view(self.first_seq(), self.next_seq)
+            timestamps = np.concatenate([np.empty(0)] + [timestamps for _, timestamps, _ in sections])
+            values = np.concatenate([np.empty((0,) + arr.shape[1:])] + [fields[field] for _, _, fields in sections])
+        present = ~np.isnan(values) if values.ndim == 1 else ~np.isnan(values).any(axis=1)
+        if start != None:
+            present &= timestamps >= start
+        if end != None:
+            present &= timestamps < end
+        return reading_partials(timestamps[present], values[present], window), 'raw'
+
+    def first_reads(self, end: int) -> np.ndarray:
+        """
+        Ingestion times of the readings before 'end' that
+        were never read before, marking them as read
+        """
+        with self.lock:
+            start = max(self.read_seq, self.first_seq())
+            self.read_seq = max(self.read_seq, end)
+            return np.concatenate([np.empty(0)] + [self.ingest_times[sl] for _, sl in self.segments(start, end)])
+
+    def read(self, since: typing.Optional[int], limit: typing.Optional[int] = None) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], int, int]:
+        """
+        Non destructive read of the readings newer than a cursor.
+        Returns the readings, the cursor to use for the next
+        read and how many readings after the cursor were
+        already overwritten
+
+        :param int since: Cursor returned by a previous read, None to read everything available
+        :param int limit: Maximum number of readings returned
+        """
+        columns, end, missed = self.read_columns(since, limit)
+        return column_records(columns), end, missed
+
+    def read_columns(self, since: typing.Optional[int], limit: typing.Optional[int] = None) -> typing.Tuple[Columns, int, int]:
+        """
+        Same as read(), with the readings as columns
+        (see column_records)
+        """
+        #Cursor, missed count and records from the same snapshot of the ring
+        with self.lock:
+            first = self.first_seq()
+            end = self.next_seq
+            start = first if since == None else min(max(since, first), end)
+            missed = 0 if since == None else max(0, min(first, end) - since)
+            if limit != None:
+                end = min(end, start + limit)
+            end = max(start, end)
+            return self._columns(start, end), end, missed
+
+class SensorStore:
+    """
+    Collection of TopicSeries, one for each
+    sensor data topic
+    """
+    def __init__(self, default_capacity: int = DEFAULT_CAPACITY, rollups: typing.Optional[RollupSpec] = None):
+        self.default_capacity = default_capacity
+        self.rollups = rollups
+        self.series: typing.Dict[str, TopicSeries] = {}
+        self.capacities: typing.Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def configure(self, topic: str, capacity: typing.Optional[int]):
+        if capacity == None:
+            capacity = self.default_capacity
+        with self.lock:
+            self.capacities[topic] = capacity
+            series = self.series.get(topic)
+        if series != None:
+            series.resize(capacity)
+
+    def get(self, topic: str) -> typing.Optional[TopicSeries]:
+        return self.series.get(topic)
+
+    def _get_or_create(self, topic: str) -> TopicSeries:
+        series = self.series.get(topic)
+        if series != None:
+            return series
+        with self.lock:
+            series = self.series.get(topic)
+            if series == None:
+                series = TopicSeries(self.capacities.get(topic, self.default_capacity), self.rollups)
+                self.series[topic] = series
+            return series
+
+    def append(self, topic: str, timestamp: float, values: typing.Dict[str, typing.Any]) -> int:
+        return self._get_or_create(topic).append(timestamp, values)
+
+    def remove(self, topic: str):
+        with self.lock:
+            self.series.pop(topic, None)
+            self.capacities.pop(topic, None)
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+            self.capacities.clear()
+
+def decode_object(parsed: typing.Any, recv_time: typing.Optional[float] = None) -> typing.Tuple[float, typing.Dict[str, typing.Any]]:
+    """
+    Splits a decoded sensor reading in its timestamp
+    (falling back to the receive time) and its numeric
+    fields (and lists of numbers), other fields are dropped
+
+    :param parsed: Reading decoded by the codec of the topic
+    :param float recv_time: Timestamp used when the reading has none
+    """
+    if type(parsed) != type({}):
+        raise ValueError(f'Sensor reading is not an object: {type(parsed).__name__}')
+
+    timestamp = parsed.pop('timestamp', None)
+    if not _is_number(timestamp):
+        timestamp = recv_time if recv_time != None else time.time()
+
+    values: typing.Dict[str, typing.Any] = {}
+    for name, value in parsed.items():
+        if _is_number(value):
+            values[name] = value
+        elif isinstance(value, list) and len(value) > 0 and all(_is_number(elem) for elem in value):
+            values[name] = value
+    return float(timestamp), values
+
+def column_records(columns: Columns) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Readings of the columns returned by TopicSeries.read_columns,
+    fields missing in a reading (NaN) are left out
+    """
+    timestamps, fields, int_fields = columns
+    decoded = {name: _to_python(arr, name in int_fields) for name, arr in fields.items()}
+    records: typing.List[typing.Dict[str, typing.Any]] = []
+    for i, timestamp in enumerate(timestamps.tolist()):
+        record = {}
+        for name, column in decoded.items():
+            value = column[i]
+            if value is not None:
+                record[name] = value
+        record['timestamp'] = timestamp
+        records.append(record)
+    return records
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_int_value(value) -> bool:
+    if isinstance(value, list):
+        return all(isinstance(elem, int) for elem in value)
+    return isinstance(value, int)
+
+def _to_python(arr: np.ndarray, as_int: bool) -> typing.List[typing.Any]:
+    if arr.ndim == 1:
+        present = ~np.isnan(arr)
+    else:
+        present = ~np.isnan(arr).any(axis=1)
+    if as_int:
+        values = np.where(np.isnan(arr), 0, arr).astype(np.int64).tolist()
+    else:
+        values = arr.tolist()
+    return [value if ok else None for value, ok in zip(values, present.tolist())]
@@ -0,0 +1,538 @@
+import threading
+import typing
+import json
+import time
+import logging
+import os
+import itertools
+
+from subprocess import Popen
+
+from common.codec import Codec, PackedCodec, JSON_CODEC, codec_from_description, is_packed, packed_sent_at
+from sensor_store import SensorStore, TopicSeries, RollupSpec, Columns, decode_object, column_records
+from aggregation import Aggregates, Partials, reduce_groups
+from device_registry import DeviceRegistry, HostListing, RegistryChange
+from stream_hub import StreamHub, StreamClient
+from ingest_router import IngestRouter, KIND_DATA, KIND_STATUS, KIND_CODEC, KIND_CONTROL
+from subscription_manager import SubscriptionManager, TopicsCallback
+from segment_store import SegmentStore, RecordArray, segment_records
+from ingest_pipeline import IngestPipeline
+from latency_metrics import LatencyMetrics, PUBLISH_INGEST, INGEST_READ, INGEST_QUEUE_WAIT, render_gauges
+
+Publisher = typing.Callable[[str, str, int], bool]
+
+class ServerState:
+    """
+    State of the main server (room hosts, devices, last
+    statuses, codecs, sensor readings and controllers)
+    together with the MQTT ingestion that updates it.
+    HTTP handlers and MQTT messages may run on different
+    threads, or in other processes through a shared state
+    backend, so everything is only accessed through these
+    methods and their results are plain values
+    """
+    def __init__(self, history: int, logger: logging.Logger, host_wildcards: bool = False,
+                 rollups: typing.Optional[RollupSpec] = None):
+        self.lock = threading.Lock()
+        self.devices: typing.Dict[str, str] = {}
+        self.curr_statuses: typing.Dict[str, str] = {}
+        self.topic_codecs: typing.Dict[str, Codec] = {}
+        self.sensors_data = SensorStore(history, rollups)
+        self.registry = DeviceRegistry()
+        self.stream_hub = StreamHub()
+        self.stream_clients: typing.Dict[int, StreamClient] = {}
+        self.stream_ids = itertools.count()
+        self.controllers: typing.Dict[str, Popen] = {}
+        self.logger = logger
+        self.router = IngestRouter(self.ingest_unrouted)
+        self.host_wildcards = host_wildcards
+        self.device_routes: typing.Dict[str, typing.List[typing.Tuple[str, str]]] = {}
+        self.subscriptions: typing.Optional[SubscriptionManager] = None
+        self.mqtt_publish: typing.Optional[Publisher] = None
+        self.archive: typing.Optional[SegmentStore] = None
+        self.pipeline: typing.Optional[IngestPipeline] = None
+        self.metrics = LatencyMetrics()
+
+    def attach_mqtt(self, subscribe: TopicsCallback, unsubscribe: TopicsCallback, publish: Publisher):
+        """
+        Sets the MQTT client of the process that owns the
+        state, used for the subscriptions of new devices
+        and for their commands
+
+        :param subscribe: Subscribes to a list of topics
+        :param unsubscribe: Unsubscribes from a list of topics
+        :param publish: Publishes (topic, payload, qos), returns whether it succeeded
+        """
+        self.subscriptions = SubscriptionManager(subscribe, unsubscribe, self.host_wildcards)
+        self.mqtt_publish = publish
+
+    def attach_archive(self, archive: SegmentStore):
+        """
+        Sets the persistent store of the readings, only the
+        process that owns the state (and ingests) writes it
+        """
+        self.archive = archive
+
+    def start_ingest_workers(self, workers: int, max_queue: int):
+        """
+        Moves the processing of the messages passed to
+        submit() to a pool of worker threads
+        """
+        self.pipeline = IngestPipeline(self.ingest, workers, max_queue, self.logger)
+
+    def restore_subscriptions(self):
+        if self.subscriptions != None:
+            self.subscriptions.restore()
+
+    def add_hosts(self, hosts: typing.Dict[str, str]):
+        with self.lock:
+            for host_id, address in hosts.items():
+                if self.devices.get(host_id) == None:
+                    self.devices[host_id] = address
+
+    def remove_hosts(self, host_ids: typing.List[str]):
+        with self.lock:
+            for host_id in host_ids:
+                self.devices.pop(host_id, None)
+        for host_id in host_ids:
+            self.registry.remove_host(host_id)
+
+    def get_host(self, host_id: str) -> typing.Optional[str]:
+        with self.lock:
+            return self.devices.get(host_id)
+
+    def get_hosts(self) -> typing.Dict[str, str]:
+        with self.lock:
+            return dict(self.devices)
+
+    def get_status(self, topic: str) -> typing.Optional[str]:
+        with self.lock:
+            return self.curr_statuses.get(topic)
+
+    def has_sensor(self, host_id: str, sensor_id: str) -> bool:
+        return self.registry.has_sensor(host_id, sensor_id)
+
+    def has_actuator(self, host_id: str, actuator_id: str) -> bool:
+        return self.registry.has_actuator(host_id, actuator_id)
+
+    def subscribe_device(self, host_id: str, device_id: str, routes: typing.List[typing.Tuple[str, str]]):
+        """
+        Registers the routes of a device and acquires
+        its subscriptions
+
+        :param routes: List of (topic, kind) of the device, control topics are only routed
+        """
+        handlers = {KIND_DATA: self.ingest_data, KIND_STATUS: self.ingest_status,
+                    KIND_CODEC: self.ingest_codec, KIND_CONTROL: self.ingest_control}
+        with self.lock:
+            if self.device_routes.get(f'{host_id}/{device_id}') != None:
+                return
+            self.device_routes[f'{host_id}/{device_id}'] = routes
+        for topic, kind in routes:
+            self.router.register(topic, kind, handlers[kind])
+        self.subscriptions.acquire_device(host_id, [topic for topic, kind in routes if kind != KIND_CONTROL])
+
+    def unsubscribe_device(self, host_id: str, device_id: str):
+        with self.lock:
+            routes = self.device_routes.pop(f'{host_id}/{device_id}', None)
+            if routes == None:
+                return
+        for topic, _ in routes:
+            self.router.unregister(topic)
+        self.subscriptions.release_device(host_id, [topic for topic, kind in routes if kind != KIND_CONTROL])
+
+    def add_sensor(self, host_id: str, sensor_id: str, history: typing.Optional[int]):
+        """
+        Registers a sensor started on a host and subscribes
+        to its data, status and codec topics
+
+        :param history: Readings kept for the sensor, None for the default
+        """
+        self.sensors_data.configure(f'{host_id}/{sensor_id}', history)
+        self.registry.add_sensor(host_id, sensor_id)
+        self.subscribe_sensor(host_id, sensor_id)
+
+    def subscribe_sensor(self, host_id: str, sensor_id: str):
+        data_topic = f'{host_id}/{sensor_id}'
+        self.subscribe_device(host_id, sensor_id, [(data_topic, KIND_DATA), (f'{data_topic}_status', KIND_STATUS),
+                                                   (f'{data_topic}_codec', KIND_CODEC), (f'{data_topic}_control', KIND_CONTROL)])
+
+    def add_actuator(self, host_id: str, actuator_id: str):
+        self.registry.add_actuator(host_id, actuator_id)
+        self.subscribe_actuator(host_id, actuator_id)
+
+    def subscribe_actuator(self, host_id: str, actuator_id: str):
+        self.subscribe_device(host_id, actuator_id, [(f'{host_id}/{actuator_id}_status', KIND_STATUS),
+                                                     (f'{host_id}/{actuator_id}_control', KIND_CONTROL)])
+
+    def remove_sensors(self, host_id: str):
+        """
+        Forgets every sensor of a host whose sensors
+        were removed, together with their readings,
+        codecs and statuses
+        """
+        for sensor_id in self.registry.get_sensors(host_id):
+            self.forget_sensor(host_id, sensor_id)
+        self.registry.clear_sensors(host_id)
+
+    def forget_sensor(self, host_id: str, sensor_id: str):
+        data_topic = f'{host_id}/{sensor_id}'
+        self.unsubscribe_device(host_id, sensor_id)
+        self.sensors_data.remove(data_topic)
+        self.metrics.remove_topic(data_topic)
+        if self.archive != None:
+            self.archive.remove_topic(data_topic)
+        with self.lock:
+            self.topic_codecs.pop(data_topic, None)
+            self.curr_statuses.pop(f'{data_topic}_status', None)
+
+    def remove_actuators(self, host_id: str):
+        for actuator_id in self.registry.get_actuators(host_id):
+            self.forget_actuator(host_id, actuator_id)
+        self.registry.clear_actuators(host_id)
+
+    def forget_actuator(self, host_id: str, actuator_id: str):
+        self.unsubscribe_device(host_id, actuator_id)
+        with self.lock:
+            self.curr_statuses.pop(f'{host_id}/{actuator_id}_status', None)
+
+    def start_reconciliation(self, fetch: typing.Callable[[str], typing.Optional[HostListing]], interval: float):
+        """
+        Starts the periodic reconciliation of the registry
+        with the room hosts, see DeviceRegistry.start_reconciliation
+        """
+        self.registry.start_reconciliation(lambda: list(self.get_hosts().keys()), fetch, interval, self.apply_change)
+
+    def apply_change(self, host_id: str, change: RegistryChange):
+        """
+        Subscribes to the devices found by a reconciliation
+        and forgets the ones that disappeared from the host,
+        like add_sensor/remove_sensors do for the API
+        """
+        self.logger.info(f'Reconciled {host_id}: +{sorted(change.added_sensors | change.added_actuators)} '
+                         f'-{sorted(change.removed_sensors | change.removed_actuators)}')
+        for sensor_id in change.removed_sensors:
+            self.forget_sensor(host_id, sensor_id)
+        for actuator_id in change.removed_actuators:
+            self.forget_actuator(host_id, actuator_id)
+        for sensor_id in change.added_sensors:
+            self.subscribe_sensor(host_id, sensor_id)
+        for actuator_id in change.added_actuators:
+            self.subscribe_actuator(host_id, actuator_id)
+
+    def send_command(self, host_id: str, device_id: str, command: str) -> bool:
+        return self.mqtt_publish(f'{host_id}/{device_id}_control', command, 1)
+
+    def read_sensor(self, host_id: str, sensor_id: str, since: typing.Optional[int],
+                    limit: typing.Optional[int]):
+        """
+        Reads the readings of a sensor from the 'since' cursor
+
+        :return: (records, next cursor, missed readings, packed schema) or None if there is no data
+        """
+        result = self.read_sensor_columns(host_id, sensor_id, since, limit)
+        if result == None:
+            return None
+        columns, next_seq, missed, schema = result
+        return column_records(columns), next_seq, missed, schema
+
+    def read_sensor_columns(self, host_id: str, sensor_id: str, since: typing.Optional[int],
+                            limit: typing.Optional[int]) -> typing.Optional[typing.Tuple[Columns, int, int, typing.List[typing.Tuple[str, str]]]]:
+        """
+        Same as read_sensor, with the readings as columns. Used
+        through the shared backend, where the records are built
+        by the worker (sensor_store.column_records)
+        """
+        series = self.sensors_data.get(f'{host_id}/{sensor_id}')
+        if series == None:
+            return None
+        columns, next_seq, missed = series.read_columns(since, limit)
+        self.observe_read(f'{host_id}/{sensor_id}', series, next_seq)
+        return columns, next_seq, missed, series.schema()
+
+    def observe_read(self, topic: str, series: TopicSeries, end: int):
+        #Each reading is measured once, at its first read by any client
+        ingest_times = series.first_reads(end)
+        if len(ingest_times) > 0:
+            self.metrics.observe(INGEST_READ, topic, time.time() - ingest_times)
+
+    def aggregate_sensor(self, host_id: str, sensor_id: str, field: str, window: float, fns: typing.List[str],
+                         start: typing.Optional[float], end: typing.Optional[float]) -> typing.Optional[typing.Tuple[Aggregates, str]]:
+        """
+        Windowed aggregates of a field of a sensor, see TopicSeries.aggregate
+
+        :return: (aggregates, source) or None if there is no data for the field
+        """
+        result = self.aggregate_partials(host_id, sensor_id, field, window, start, end)
+        if result == None:
+            return None
+        partials, source = result
+        return reduce_groups(*partials, window, fns), source
+
+    def aggregate_partials(self, host_id: str, sensor_id: str, field: str, window: float,
+                           start: typing.Optional[float], end: typing.Optional[float]) -> typing.Optional[typing.Tuple[Partials, str]]:
+        """
+        Partial aggregates of a field of a sensor, merged by the
+        caller with aggregation.reduce_groups, see TopicSeries.aggregate_partials
+        """
+        series = self.sensors_data.get(f'{host_id}/{sensor_id}')
+        if series == None:
+            return None
+        return series.aggregate_partials(field, window, start, end)
+
+    def read_archive(self, host_id: str, sensor_id: str, start: typing.Optional[float], end: typing.Optional[float],
+                     limit: int) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        Reads the stored readings of a sensor with timestamp in [start, end)
+
+        :return: The readings or None if there is no persistent store
+        """
+        arrays = self.read_archive_arrays(host_id, sensor_id, start, end, limit)
+        if arrays == None:
+            return None
+        return [record for schema, array in arrays for record in segment_records(schema, array)]
+
+    def read_archive_arrays(self, host_id: str, sensor_id: str, start: typing.Optional[float], end: typing.Optional[float],
+                            limit: int) -> typing.Optional[typing.List[RecordArray]]:
+        """
+        Same as read_archive, with the records of each segment
+        as a structured array (see segment_store.segment_records)
+        """
+        if self.archive == None:
+            return None
+        return self.archive.read_arrays(f'{host_id}/{sensor_id}', start, end, limit)
+
+    def stream_subscribe(self, filters: typing.List[str], max_queue: int) -> int:
+        client = self.stream_hub.subscribe(filters, max_queue)
+        stream_id = next(self.stream_ids)
+        with self.lock:
+            self.stream_clients[stream_id] = client
+        return stream_id
+
+    def stream_get(self, stream_id: int, timeout: float) -> typing.Tuple[typing.List[typing.Tuple[str, typing.Any]], int]:
+        """
+        Waits for the events of a stream client
+
+        :return: The queued events and the events dropped so far
+        """
+        with self.lock:
+            client = self.stream_clients[stream_id]
+        return client.get(timeout), client.dropped
+
+    def stream_unsubscribe(self, stream_id: int):
+        with self.lock:
+            client = self.stream_clients.pop(stream_id, None)
+        if client != None:
+            self.stream_hub.unsubscribe(client)
+
+    def add_controller(self, py_module: str, instance_id: str) -> str:
+        """
+        Starts a controller script
+
+        :return: Status of the request
+        """
+        with self.lock:
+            if self.controllers.get(instance_id) != None:
+                return 'E_EXISTS'
+            if not os.path.exists(f'./controllers/{py_module}.py'):
+                return 'E_MODULE'
+            new_env = {}
+            new_env.update(os.environ)
+            new_env['MODULE_NAME'] = instance_id
+            self.controllers[instance_id] = Popen(f'python3 ./controllers/{py_module}.py', shell=True, env=new_env)
+            return 'E_OK'
+
+    def remove_controller(self, instance_id: str) -> bool:
+        with self.lock:
+            controller = self.controllers.pop(instance_id, None)
+        if controller == None:
+            return False
+        controller.terminate()
+        return True
+
+    def remove_all_controllers(self):
+        with self.lock:
+            controllers = list(self.controllers.values())
+            self.controllers.clear()
+        for controller in controllers:
+            controller.terminate()
+
+    def get_controllers(self) -> typing.List[str]:
+        with self.lock:
+            return [name for name in self.controllers.keys()]
+
+    def submit(self, topic: str, payload: bytes):
+        """
+        Hands a message received by the MQTT client to the
+        ingest workers, or ingests it if they were not started
+        """
+        if self.pipeline != None:
+            self.pipeline.submit(topic, payload)
+        else:
+            self.ingest(topic, payload)
+
+    def ingest(self, topic: str, payload: bytes, recv_time: typing.Optional[float] = None):
+        """
+        Handles a message received on one of the
+        subscribed topics
+
+        :param str topic: Topic of the message
+        :param bytes payload: Raw payload
+        :param float recv_time: Time the message was received, now if None
+        """
+        if recv_time != None:
+            self.metrics.observe(INGEST_QUEUE_WAIT, '', time.time() - recv_time)
+        else:
+            recv_time = time.time()
+        self.router.dispatch(topic, payload, recv_time)
+
+    def ingest_stats(self) -> typing.Dict[str, typing.Any]:
+        stats = self.router.stats()
+        stats['subscriptions'] = self.subscriptions.stats() if self.subscriptions != None else {}
+        if self.archive != None:
+            stats['archive'] = self.archive.stats()
+        if self.pipeline != None:
+            stats['pipeline'] = self.pipeline.stats()
+        return stats
+
+    def metric_lines(self) -> typing.List[str]:
+        """
+        Latency histograms and ingest counters in the
+        Prometheus text format
+        """
+        lines = self.metrics.render()
+        if self.pipeline != None:
+            stats = self.pipeline.stats()
+            lines.extend(render_gauges('mininet_ingest', {
+                'queue_depth': ('gauge', 'Messages waiting for an ingest worker', stats['depth']),
+                'processed_total': ('counter', 'Messages processed by the ingest workers', stats['processed']),
+                'dropped_total': ('counter', 'Messages dropped because the ingest queue was full', stats['dropped'])}))
+        return lines
+
+    def ingest_unrouted(self, topic: str, payload: bytes, recv_time: float):
+        #Status of a device that was not added through this server
+        if topic.endswith('_status'):
+            self.registry.seen_status(topic)
+
+    def ingest_control(self, topic: str, payload: bytes, recv_time: float):
+        #Commands sent by this server, received back through the host wildcards
+        pass
+
+    def ingest_codec(self, codec_topic: str, payload: bytes, recv_time: float):
+        #Codec announced by a sensor for its data topic
+        topic = codec_topic[:-len('_codec')]
+        if len(payload) == 0:
+            with self.lock:
+                self.topic_codecs.pop(topic, None)
+            return
+        try:
+            codec = codec_from_description(json.loads(payload))
+        except ValueError:
+            self.logger.error(f'Invalid codec for {topic}')
+            return
+        with self.lock:
+            self.topic_codecs[topic] = codec
+
+    def ingest_status(self, topic: str, payload: bytes, recv_time: float):
+        payload_msg = payload.decode()
+        with self.lock:
+            #An empty status message clears the retained status
+            if payload_msg == '':
+                self.curr_statuses.pop(topic, None)
+                return
+            changed = self.curr_statuses.get(topic) != payload_msg
+            self.curr_statuses[topic] = payload_msg
+        self.registry.seen_status(topic)
+        if changed and self.stream_hub.has_clients():
+            self.stream_hub.publish(topic, 'status', {'topic': topic, 'status': payload_msg})
+
+    def ingest_data(self, topic: str, payload: bytes, recv_time: float):
+        with self.lock:
+            codec = self.topic_codecs.get(topic, JSON_CODEC)
+        if is_packed(payload) and not isinstance(codec, PackedCodec):
+            self.logger.error(f'Packed data message on {topic} without schema')
+            return
+        readings: typing.List[typing.Tuple[float, typing.Dict[str, typing.Any]]] = []
+        sent_times: typing.List[float] = []
+        try:
+            for record in codec.decode(payload):
+                #Publish time stamped by the sensor, not a field of the reading
+                sent_at = record.pop('sent_at', None) if type(record) == type({}) else None
+                readings.append(decode_object(record, recv_time))
+                if type(sent_at) in (int, float):
+                    sent_times.append(sent_at)
+        except ValueError:
+            self.logger.error(f'Invalid data message on {topic}')
+            return
+        #Packed messages carry the publish time in their header
+        sent_at = packed_sent_at(payload)
+        if sent_at != None:
+            sent_times = [sent_at] * len(readings)
+        if len(sent_times) > 0:
+            self.metrics.observe(PUBLISH_INGEST, topic, [recv_time - sent_at for sent_at in sent_times])
+        for timestamp, values in readings:
+            seq = self.sensors_data.append(topic, timestamp, values)
+            if self.archive != None:
+                self.archive.append(topic, timestamp, values)
+            if self.stream_hub.has_clients():
+                reading = dict(values)
+                reading['timestamp'] = timestamp
+                self.stream_hub.publish(topic, 'data', {'topic': topic, 'seq': seq, 'reading': reading})
+
+    def read_batch(self, sensor_entries: typing.List[typing.Any],
+                   actuator_entries: typing.List[typing.Any]) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        Results of the entries of a telemetry batch in a single call,
+        the readings are returned as 'columns' (see batch_sensor_entry)
+        """
+        return ([self.batch_sensor_entry(entry, True) for entry in sensor_entries],
+                [self.batch_actuator_entry(entry) for entry in actuator_entries])
+
+    def batch_sensor_entry(self, entry, compact: bool = False) -> typing.Dict[str, typing.Any]:
+        """
+        Result of a sensor entry of a telemetry batch, with 'compact'
+        the readings are returned as 'columns' instead of 'sensor_data'
+        """
+        if type(entry) != type({}) or entry.get('host_id') == None or entry.get('sensor_id') == None:
+            return {'status': 'E_PARAMS'}
+        result = {'host_id': entry['host_id'], 'sensor_id': entry['sensor_id']}
+        since = entry.get('since')
+        limit = entry.get('limit')
+        if (since != None and (type(since) != int or since < 0)) or (limit != None and (type(limit) != int or limit <= 0)):
+            result['status'] = 'E_PARAMS'
+            return result
+        if self.get_host(entry['host_id']) == None:
+            result['status'] = 'E_HOST'
+            return result
+        if not self.registry.has_sensor(entry['host_id'], entry['sensor_id']):
+            result['status'] = 'E_INV_ID'
+            return result
+        series = self.sensors_data.get(f'{entry["host_id"]}/{entry["sensor_id"]}')
+        if series == None:
+            result['status'] = 'E_NOT_AVAIL'
+            return result
+        columns, next_seq, missed = series.read_columns(since, limit)
+        self.observe_read(f'{entry["host_id"]}/{entry["sensor_id"]}', series, next_seq)
+        result.update({'status': 'E_OK', 'next': next_seq, 'missed': missed})
+        if compact:
+            result['columns'] = columns
+        else:
+            result['sensor_data'] = column_records(columns)
+        return result
+
+    def batch_actuator_entry(self, entry) -> typing.Dict[str, typing.Any]:
+        if type(entry) != type({}) or entry.get('host_id') == None or entry.get('actuator_id') == None:
+            return {'status': 'E_PARAMS'}
+        result = {'host_id': entry['host_id'], 'actuator_id': entry['actuator_id']}
+        if self.get_host(entry['host_id']) == None:
+            result['status'] = 'E_HOST'
+            return result
+        if not self.registry.has_actuator(entry['host_id'], entry['actuator_id']):
+            result['status'] = 'E_INV_ID'
+            return result
+        status = self.get_status(f'{entry["host_id"]}/{entry["actuator_id"]}_status')
+        if status == None:
+            result['status'] = 'E_NOT_AVAIL'
+            return result
+        result.update({'status': 'E_OK', 'actuator_status': status})
+        return result
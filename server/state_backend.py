@@ -0,0 +1,87 @@
+import typing
+import logging
+import os
+import time
+
+from multiprocessing.managers import BaseManager
+
+from server_state import ServerState
+from sensor_store import RollupSpec
+
+DEFAULT_ADDRESS = '127.0.0.1:5100'
+
+class StateManager(BaseManager):
+    """
+    Serves the ServerState of the owner process on a
+    local socket, other processes get a proxy whose
+    method calls are executed by the owner
+    """
+    pass
+
+def parse_address(address: str) -> typing.Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+def state_authkey() -> bytes:
+    #The manager unpickles what it receives, so there is no default key
+    authkey = os.environ.get('STATE_AUTHKEY', '')
+    if authkey == '':
+        raise ValueError('STATE_AUTHKEY must be set with the shared state backend')
+    return authkey.encode()
+
+def create_state(history: int, logger: logging.Logger, host_wildcards: bool = False,
+                 rollups: typing.Optional[RollupSpec] = None) -> typing.Tuple[ServerState, bool]:
+    """
+    Creates the state backend selected by the 'STATE_BACKEND'
+    env. variable:
+    - 'local' (default): the state lives in this process
+    - 'shared': the state is owned by the state server
+      (server/state_server.py, started by the gunicorn master)
+      and this process gets a proxy to it
+
+    Returns the state and whether this process owns it, only
+    the owner must connect to the broker and ingest messages
+
+    :param int history: Default number of readings kept for each sensor
+    :param logger: Logger of the server
+    :param bool host_wildcards: Subscribe to '<host>/#' instead of the topics of each device
+    :param rollups: (resolution, buckets) of the rollups kept for each sensor
+    """
+    backend = os.environ.get('STATE_BACKEND', 'local')
+    if backend == 'local':
+        return ServerState(history, logger, host_wildcards, rollups), True
+    if backend != 'shared':
+        raise ValueError(f'Unknown state backend {backend}')
+    return connect_state(logger), False
+
+def connect_state(logger: logging.Logger) -> ServerState:
+    """
+    Connects to the state server on 'STATE_ADDRESS', waiting
+    up to 'STATE_CONNECT_TIMEOUT' seconds for it to start
+    """
+    address = parse_address(os.environ.get('STATE_ADDRESS', DEFAULT_ADDRESS))
+    StateManager.register('get_state')
+    manager = StateManager(address=address, authkey=state_authkey())
+    deadline = time.monotonic() + float(os.environ.get('STATE_CONNECT_TIMEOUT', '30'))
+    while True:
+        try:
+            manager.connect()
+            break
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.2)
+    logger.info(f'Using the state served on {address}')
+    return manager.get_state()
+
+def serve_state(state: ServerState, logger: logging.Logger):
+    """
+    Serves 'state' on 'STATE_ADDRESS' to the other processes,
+    never returns
+    """
+    address = parse_address(os.environ.get('STATE_ADDRESS', DEFAULT_ADDRESS))
+    StateManager.register('get_state', callable=lambda: state)
+    manager = StateManager(address=address, authkey=state_authkey())
+    server = manager.get_server()
+    logger.info(f'Serving the state on {address}')
+    server.serve_forever()
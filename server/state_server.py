@@ -0,0 +1,87 @@
+import paho.mqtt.client as mqtt
+
+import typing
+import logging
+import sys
+import os
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_state import ServerState
+from state_backend import serve_state
+from aggregation import DEFAULT_ROLLUPS, parse_window, parse_rollups
+from host_client import HostClient
+from segment_store import SegmentStore
+
+#Owner of the shared state backend (STATE_BACKEND=shared).
+#Runs in its own process, started by the gunicorn master
+#(see server/gunicorn_conf.py), so that the state outlives
+#the workers: it connects to the broker, ingests messages
+#and serves the state to the workers, which only hold proxies
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger('state_server')
+
+if os.environ.get('MQTT_ADDRESS') == None or os.environ.get('MQTT_PORT') == None:
+    logger.fatal(f'Env. variables for MQTT do not exist')
+    exit(1)
+
+state = ServerState(int(os.environ.get('SENSOR_HISTORY', '1024')), logger,
+                    os.environ.get('MQTT_HOST_WILDCARDS') == '1',
+                    parse_rollups(os.environ.get('SENSOR_ROLLUPS', DEFAULT_ROLLUPS)))
+
+HOST_TIMEOUT = float(os.environ.get('HOST_TIMEOUT', '5'))
+host_client = HostClient(HOST_TIMEOUT,
+                         retries=int(os.environ.get('HOST_RETRIES', '2')),
+                         pool_size=int(os.environ.get('HOST_POOL_SIZE', '8')))
+
+def fetch_host_devices(host_id: str):
+    host = state.get_host(host_id)
+    if host == None:
+        return None
+    try:
+        sensor_res = host_client.get(f'http://{host}:5000/sensors/get_all')
+        actuator_res = host_client.get(f'http://{host}:5000/actuators/get_all')
+    except requests.RequestException:
+        logger.error(f'Reconciliation of {host_id} failed')
+        return None
+    if sensor_res.status_code != 200 or actuator_res.status_code != 200:
+        return None
+    return sensor_res.json()['sensors'], actuator_res.json()['actuators']
+
+client = mqtt.Client('MAIN_SERVER', clean_session=True)
+
+def handle_connect(client, userdata, flags, rc):
+    logger.info(f'Connected to Mqtt broker')
+    if rc == mqtt.MQTT_ERR_SUCCESS:
+        state.restore_subscriptions()
+
+def handle_publish(client, userdata, message: mqtt.MQTTMessage):
+    #Runs on the network thread of paho, the messages are processed by the ingest workers
+    state.submit(message.topic, message.payload)
+
+def publish_command(topic: str, payload: str, qos: int) -> bool:
+    result = client.publish(topic, payload, qos=qos)
+    return result.rc == mqtt.MQTT_ERR_SUCCESS
+
+def subscribe_topics(topics: typing.List[str]):
+    client.subscribe([(topic, 0) for topic in topics])
+
+def unsubscribe_topics(topics: typing.List[str]):
+    client.unsubscribe(topics)
+
+if __name__ == '__main__':
+    if os.environ.get('SENSOR_ARCHIVE_DIR') != None:
+        state.attach_archive(SegmentStore(os.environ['SENSOR_ARCHIVE_DIR'],
+                                          parse_window(os.environ.get('SENSOR_ARCHIVE_PARTITION', '1h')),
+                                          parse_window(os.environ.get('SENSOR_ARCHIVE_RETENTION', '7d'))))
+    state.start_ingest_workers(int(os.environ.get('INGEST_WORKERS', '2')), int(os.environ.get('INGEST_QUEUE', '10000')))
+    state.attach_mqtt(subscribe_topics, unsubscribe_topics, publish_command)
+    client.on_connect = handle_connect
+    client.on_message = handle_publish
+    client.connect(os.environ['MQTT_ADDRESS'], int(os.environ['MQTT_PORT']))
+    client.loop_start()
+    state.start_reconciliation(fetch_host_devices, float(os.environ.get('REGISTRY_RECONCILE_INTERVAL', '30')))
+    serve_state(state, logger)
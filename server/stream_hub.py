@@ -0,0 +1,82 @@
+import threading
+import typing
+import collections
+
+from paho.mqtt.client import topic_matches_sub
+
+DEFAULT_QUEUE_SIZE = 256
+
+class StreamClient:
+    """
+    A client of the push stream. Events matching one
+    of its topic filters are put in a bounded queue,
+    when the queue is full the oldest event is dropped
+    so that a slow client never blocks the publisher
+    """
+    def __init__(self, filters: typing.List[str], max_queue: int,
+                 on_put: typing.Optional[typing.Callable[[], typing.Any]] = None):
+        self.filters = filters
+        self.queue: typing.Deque[typing.Tuple[str, typing.Any]] = collections.deque(maxlen=max_queue)
+        self.dropped = 0
+        self.cond = threading.Condition()
+        #Called after each event is queued, lets async consumers wait without a thread
+        self.on_put = on_put
+
+    def matches(self, topic: str) -> bool:
+        return any(topic_matches_sub(sub, topic) for sub in self.filters)
+
+    def put(self, event: str, data: typing.Any):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((event, data))
+            self.cond.notify()
+        if self.on_put != None:
+            self.on_put()
+
+    def get(self, timeout: float) -> typing.List[typing.Tuple[str, typing.Any]]:
+        """
+        Waits up to 'timeout' seconds for events and
+        returns all the queued ones
+        """
+        with self.cond:
+            if len(self.queue) == 0:
+                self.cond.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            return events
+
+class StreamHub:
+    def __init__(self):
+        self.clients: typing.List[StreamClient] = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, filters: typing.List[str], max_queue: int = DEFAULT_QUEUE_SIZE,
+                  on_put: typing.Optional[typing.Callable[[], typing.Any]] = None) -> StreamClient:
+        client = StreamClient(filters, max_queue, on_put)
+        with self.lock:
+            self.clients = self.clients + [client]
+        return client
+
+    def unsubscribe(self, client: StreamClient):
+        with self.lock:
+            self.clients = [curr for curr in self.clients if curr is not client]
+
+    def has_clients(self) -> bool:
+        return len(self.clients) > 0
+
+    def publish(self, topic: str, event: str, data: typing.Any):
+        for client in self.clients:
+            if client.matches(topic):
+                client.put(event, data)
+
+def valid_filter(sub: str) -> bool:
+    if sub == '':
+        return False
+    levels = sub.split('/')
+    for i, level in enumerate(levels):
+        if level == '#' and i != len(levels) - 1:
+            return False
+        if level not in ('#', '+') and ('#' in level or '+' in level):
+            return False
+    return True
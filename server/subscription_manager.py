@@ -0,0 +1,81 @@
+import threading
+import typing
+
+TopicsCallback = typing.Callable[[typing.List[str]], typing.Any]
+
+class SubscriptionManager:
+    """
+    Reference counted MQTT subscriptions of the main server.
+    Each device acquires the topics it needs and the broker
+    is only asked to subscribe (unsubscribe) when a topic
+    is acquired for the first time (released for the last
+    time), so removing some devices never drops the messages
+    of the others. New topics are sent with a single
+    SUBSCRIBE, and all of them are restored in bulk after
+    a reconnection.
+
+    With host wildcards the devices of a host share a
+    single '<host>/#' subscription
+    """
+    def __init__(self, subscribe: TopicsCallback, unsubscribe: TopicsCallback, host_wildcards: bool = False):
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.host_wildcards = host_wildcards
+        self.refcounts: typing.Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def device_topics(self, host_id: str, topics: typing.List[str]) -> typing.List[str]:
+        if self.host_wildcards:
+            return [f'{host_id}/#']
+        return topics
+
+    def acquire(self, topics: typing.List[str]):
+        new_topics: typing.List[str] = []
+        with self.lock:
+            for topic in topics:
+                count = self.refcounts.get(topic, 0)
+                self.refcounts[topic] = count + 1
+                if count == 0:
+                    new_topics.append(topic)
+            if len(new_topics) > 0:
+                self.subscribe(new_topics)
+
+    def release(self, topics: typing.List[str]):
+        old_topics: typing.List[str] = []
+        with self.lock:
+            for topic in topics:
+                count = self.refcounts.get(topic, 0)
+                if count <= 1:
+                    if self.refcounts.pop(topic, None) != None:
+                        old_topics.append(topic)
+                else:
+                    self.refcounts[topic] = count - 1
+            if len(old_topics) > 0:
+                self.unsubscribe(old_topics)
+
+    def acquire_device(self, host_id: str, topics: typing.List[str]):
+        """
+        Subscribes to the topics of a device, or to
+        the wildcard of its host
+
+        :param str host_id: Host of the device
+        :param topics: Topics received from the device
+        """
+        self.acquire(self.device_topics(host_id, topics))
+
+    def release_device(self, host_id: str, topics: typing.List[str]):
+        self.release(self.device_topics(host_id, topics))
+
+    def restore(self):
+        """
+        Subscribes again to every topic with a single
+        request, to be called when the client reconnects
+        """
+        with self.lock:
+            topics = list(self.refcounts.keys())
+            if len(topics) > 0:
+                self.subscribe(topics)
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.lock:
+            return dict(self.refcounts)